@@ -0,0 +1,580 @@
+"""
+Benchmark de latencia y carga para la API de rutas.
+
+Modos:
+    python benchmark_routes.py micro --output resultados.json
+    python benchmark_routes.py load --requests 200 --concurrency 8 --output resultados.json
+    python benchmark_routes.py all --compare baseline.json
+    python benchmark_routes.py startup --repeat 5 --output arranque.json
+
+Usa un conjunto fijo de pares origen/destino generado con una semilla, y dobles en
+memoria de Redis y PostgreSQL (no hace falta tener los servicios corriendo).
+Reporta p50/p95/p99, throughput y memoria asignada por operación, y guarda los
+resultados en JSON para compararlos con una ejecución anterior.
+
+El modo startup arranca la aplicación real en procesos nuevos y mide el tiempo de
+importación de main.py, el arranque hasta estar lista, la primera ruta y la memoria
+residente máxima (con Redis y PostgreSQL si están disponibles; si no, en modo degradado).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+import main
+from graph_snapshot import load_graph
+from populate_traffic_data import simulate_traffic_for_edge
+from routing_graph import GraphArrays
+from traffic_store import EdgeIndex, SharedTrafficStore, SlotWeights, slot_index
+
+logger = logging.getLogger("benchmark_routes")
+
+GRAPH_PATH = "calles_huaraz.graphml"
+DEFAULT_SEED = 42
+# Fecha fija (lunes 8 AM, hora punta) para que todas las ejecuciones usen la misma franja de tráfico
+BENCHMARK_DATETIME = datetime(2025, 7, 14, 8, 0, 0)
+
+
+# --- Dobles de Redis y PostgreSQL ---
+
+class FakeRedis:
+    """Implementa en memoria el subconjunto de redis.StrictRedis que usa main.py."""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def ping(self):
+        return True
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hmset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+        return True
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        target = self.hashes.setdefault(key, {})
+        if field is not None:
+            target[field] = value
+        if mapping:
+            target.update(mapping)
+        return True
+
+    def delete(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += self.hashes.pop(key, None) is not None
+        return removed
+
+    def expire(self, key, seconds):
+        return key in self.hashes
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        if "FROM datos_trafico" in query and params:
+            self._rows = self.connection.traffic_rows(*params[:2])
+        else:
+            self._rows = [{"?column?": 1}]
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def traffic_rows(self, day_of_week, hour_of_day):
+        return self.pool.traffic_rows(day_of_week, hour_of_day)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeConnectionPool:
+    """
+    Doble de psycopg2.pool con una tabla datos_trafico simulada en memoria.
+    Las filas se generan con simulate_traffic_for_edge y una semilla fija.
+    """
+
+    def __init__(self, graph, seed=DEFAULT_SEED):
+        self.graph = graph
+        self.seed = seed
+        self._slots = {}
+        # Mismos atributos internos que psycopg2.pool, leídos por los gauges de metrics.py
+        self._used = {}
+        self._pool = []
+        self.maxconn = 50
+
+    def traffic_rows(self, day_of_week, hour_of_day):
+        slot = (day_of_week, hour_of_day)
+        if slot not in self._slots:
+            random.seed(self.seed * 1000 + day_of_week * 24 + hour_of_day)
+            rows = []
+            highways = self.graph.highways()
+            lengths = np.nan_to_num(self.graph.length, nan=50.0).tolist()
+            for i, (u, v, key) in enumerate(self.graph.edge_keys()):
+                speed, congestion, travel_time, category, highway, length = simulate_traffic_for_edge(
+                    lengths[i], day_of_week, hour_of_day, highways[i]
+                )
+                rows.append({
+                    "u": u, "v": v, "edge_key": key,
+                    "tiempoviajeestimadosegundos": travel_time,
+                    "nivel_congestion": congestion,
+                    "categoria_congestion": category,
+                    "tipo_via_osm": highway,
+                    "length": length,
+                    "velocidad_promedio_kmh": speed,
+                })
+            self._slots[slot] = rows
+        return self._slots[slot]
+
+    def getconn(self):
+        conn = FakeConnection(self)
+        self._used[id(conn)] = conn
+        return conn
+
+    def putconn(self, conn):
+        self._used.pop(id(conn), None)
+
+    def closeall(self):
+        pass
+
+
+# --- Utilidades de medición ---
+
+def percentile(sorted_values, pct):
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies_s, wall_time_s, alloc_bytes=None):
+    """Resume una serie de latencias (en segundos) en milisegundos."""
+    ordered = sorted(latencies_s)
+    stats = {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4) if ordered else 0.0,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 4),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 4),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4) if ordered else 0.0,
+        "throughput_ops_s": round(len(ordered) / wall_time_s, 2) if wall_time_s > 0 else 0.0,
+    }
+    if alloc_bytes:
+        ordered_alloc = sorted(alloc_bytes)
+        stats["alloc_peak_kib_p50"] = round(percentile(ordered_alloc, 50) / 1024, 1)
+        stats["alloc_peak_kib_max"] = round(ordered_alloc[-1] / 1024, 1)
+    return stats
+
+
+def measure(func, inputs, repeat=1, alloc_samples=5):
+    """
+    Ejecuta 'func' sobre cada entrada 'repeat' veces midiendo la latencia.
+    La memoria se mide en una pasada aparte con tracemalloc para no distorsionar los tiempos.
+    """
+    latencies = []
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        for item in inputs:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+    wall_time = time.perf_counter() - wall_start
+
+    alloc_bytes = []
+    tracemalloc.start()
+    for item in inputs[:alloc_samples]:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        func(item)
+        _, peak = tracemalloc.get_traced_memory()
+        alloc_bytes.append(peak - before)
+    tracemalloc.stop()
+
+    return summarize(latencies, wall_time, alloc_bytes)
+
+
+# --- Preparación ---
+
+def generate_od_pairs(graph, count, seed=DEFAULT_SEED):
+    """
+    Genera pares origen/destino reproducibles: nodos elegidos con la semilla entre los
+    que tienen camino, con un pequeño desplazamiento para que el ajuste al nodo más cercano trabaje.
+    """
+    rng = random.Random(seed)
+    arrays = GraphArrays(graph, EdgeIndex(graph.edge_keys()))
+    matrix = arrays.build_matrix(arrays.default_travel_time)
+    nodes = sorted(arrays.node_position)
+    pairs = []
+    attempts = 0
+    while len(pairs) < count and attempts < count * 50:
+        attempts += 1
+        orig, dest = rng.sample(nodes, 2)
+        if arrays.shortest_path(matrix, orig, dest) is None:
+            continue
+        orig_position, dest_position = arrays.node_position[orig], arrays.node_position[dest]
+        pairs.append({
+            "origin": {"lat": float(graph.node_lat[orig_position]) + rng.uniform(-1e-4, 1e-4),
+                       "lon": float(graph.node_lon[orig_position]) + rng.uniform(-1e-4, 1e-4)},
+            "destination": {"lat": float(graph.node_lat[dest_position]) + rng.uniform(-1e-4, 1e-4),
+                            "lon": float(graph.node_lon[dest_position]) + rng.uniform(-1e-4, 1e-4)},
+            "orig_node": orig,
+            "dest_node": dest,
+        })
+    return pairs
+
+
+def install_fakes(graph, seed=DEFAULT_SEED, shared_store_dir=None):
+    """
+    Configura el módulo main con el grafo y los dobles de Redis y PostgreSQL.
+    Con 'shared_store_dir' crea además un almacén de tráfico compartido en ese directorio,
+    con todas las franjas cargadas, como lo dejaría el refrescador.
+    """
+    main.G = graph
+    main.db_pool = FakeConnectionPool(graph, seed)
+    main.redis_client = FakeRedis()
+    main.edge_index = EdgeIndex(graph.edge_keys())
+    main.graph_arrays = GraphArrays(graph, main.edge_index)
+    main.traffic_store = None
+    if shared_store_dir is not None:
+        store = SharedTrafficStore(os.path.join(shared_store_dir, "traffic_slots.bin"), main.edge_index)
+        store.try_acquire_leadership()
+        with store.update():
+            for day in range(7):
+                for hour in range(24):
+                    rows = main.db_pool.traffic_rows(day, hour)
+                    edge_data = {
+                        (r["u"], r["v"], r["edge_key"]): {
+                            "travel_time": r["tiempoviajeestimadosegundos"],
+                            "congestion_level": r["nivel_congestion"],
+                            "categoria_congestion": r["categoria_congestion"],
+                            "tipo_via_osm": r["tipo_via_osm"],
+                            "length": r["length"],
+                            "speed_kmh": r["velocidad_promedio_kmh"],
+                        }
+                        for r in rows
+                    }
+                    store.write_slot(slot_index(day, hour), SlotWeights.from_edge_dict(main.edge_index, edge_data))
+        main.traffic_store = store
+
+
+# --- Modos ---
+
+def run_micro(graph, pairs, repeat):
+    results = {}
+    query_time = BENCHMARK_DATETIME
+    shared_store = main.traffic_store
+    main.traffic_store = None  # las etapas de Redis/PostgreSQL se miden sin el almacén compartido
+
+    results["snapping"] = measure(
+        lambda p: (main.graph_arrays.nearest_node(p["origin"]["lon"], p["origin"]["lat"]),
+                   main.graph_arrays.nearest_node(p["destination"]["lon"], p["destination"]["lat"])),
+        pairs, repeat)
+
+    def fetch_postgres(_):
+        main.redis_client.hashes.clear()
+        return main.get_edge_travel_times(query_time)
+    results["traffic_fetch_postgres"] = measure(fetch_postgres, pairs[:5], repeat)
+
+    main.get_edge_travel_times(query_time)  # deja el slot cacheado en Redis
+    results["traffic_fetch_redis"] = measure(lambda _: main.get_edge_travel_times(query_time), pairs[:5], repeat)
+
+    results["traffic_fetch_redis_to_arrays"] = measure(lambda _: main.get_slot_weights(query_time), pairs[:5], repeat)
+
+    main.traffic_store = shared_store
+    if shared_store is not None:
+        slot = slot_index(query_time.weekday(), query_time.hour)
+        def fetch_shared(_):
+            shared_store._slot_cache.clear()  # mide la copia desde el archivo, no la caché por generación
+            return shared_store.read_slot(slot)
+        results["traffic_fetch_shared"] = measure(fetch_shared, pairs[:5], repeat)
+
+    slot_weights = main.get_slot_weights(query_time)
+    arrays = main.graph_arrays
+    results["weight_application"] = measure(
+        lambda _: arrays.build_matrix(arrays.slot_travel_times(slot_weights)), pairs[:5], repeat)
+
+    travel_times = arrays.slot_travel_times(slot_weights)
+    matrix = arrays.build_matrix(travel_times)
+    results["shortest_path"] = measure(
+        lambda p: arrays.shortest_path(matrix, p["orig_node"], p["dest_node"]),
+        pairs, repeat)
+
+    paths = {id(p): arrays.shortest_path(matrix, p["orig_node"], p["dest_node"]) for p in pairs}
+    results["route_details"] = measure(
+        lambda p: main.get_route_details(paths[id(p)], travel_times, slot_weights), pairs, repeat)
+
+    results["alternatives"] = measure(
+        lambda p: main.find_alternative_routes(travel_times, matrix, slot_weights, p["orig_node"], p["dest_node"]),
+        pairs, max(1, repeat // 2), alloc_samples=2)
+    return results
+
+
+async def _run_load_async(pairs, total_requests, concurrency):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    latencies = []
+    errors = 0
+    counter = iter(range(total_requests))
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                pair = pairs[i % len(pairs)]
+                body = {"origin": pair["origin"], "destination": pair["destination"]}
+                start = time.perf_counter()
+                response = await client.post("/calculate_route", json=body)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    errors += 1
+
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - wall_start
+
+    stats = summarize(latencies, wall_time)
+    stats["concurrency"] = concurrency
+    stats["errors"] = errors
+    return stats
+
+
+def run_load(pairs, total_requests, concurrency):
+    return asyncio.run(_run_load_async(pairs, total_requests, concurrency))
+
+
+# Se ejecuta en un proceso nuevo por medición; imprime una línea JSON con los resultados
+STARTUP_SCRIPT = """
+import json, os, resource, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+import asyncio
+from datetime import datetime
+import numpy as np
+
+async def measure():
+    await main.startup_event()
+    ready = time.perf_counter()
+    # Par origen/destino con camino: el nodo alcanzable más lejano desde el primero
+    arrays = main.graph_arrays
+    matrix = arrays.build_matrix(arrays.default_travel_time)
+    distances = arrays.one_to_all(matrix, int(arrays.node_ids[0]))
+    reachable = np.flatnonzero(np.isfinite(distances))
+    orig, dest = int(arrays.node_ids[0]), int(arrays.node_ids[reachable[np.argmax(distances[reachable])]])
+    route_start = time.perf_counter()
+    main.compute_routes(orig, dest, datetime.now())
+    return ready, time.perf_counter() - route_start
+
+ready, first_route = asyncio.run(measure())
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+peak_rss_mb = peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+heavy = ("osmnx", "geopandas", "pandas", "matplotlib", "sklearn", "shapely")
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "ready_ms": (ready - start) * 1000,
+    "first_route_ms": first_route * 1000,
+    "rss_peak_mb": peak_rss_mb,
+    "heavy_modules": [m for m in heavy if m in sys.modules],
+}))
+sys.stdout.flush()
+os._exit(0)  # sin esperar a las tareas en segundo plano de la aplicación
+"""
+
+
+def run_startup(repeat):
+    """
+    Arranque en frío de la aplicación, cada medición en un proceso nuevo. La primera
+    ejecución no se cuenta: genera la copia nativa del grafo si hace falta.
+    """
+    workdir = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for i in range(repeat + 1):
+        completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=workdir, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"El arranque falló:\n{completed.stderr[-2000:]}")
+        if i > 0:
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    stats = {"runs": len(runs), "heavy_modules": runs[-1]["heavy_modules"]}
+    for metric in ("import_ms", "ready_ms", "first_route_ms", "rss_peak_mb"):
+        values = [run[metric] for run in runs]
+        stats[metric] = round(statistics.median(values), 1)
+        stats[f"{metric}_max"] = round(max(values), 1)
+    return stats
+
+
+def compare(current, baseline_path):
+    """Imprime la variación de p50/p95/p99 respecto a un baseline guardado."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    print(f"\nComparación con {baseline_path} ({baseline.get('meta', {}).get('timestamp', '?')}):")
+    print(f"{'etapa':32} {'métrica':8} {'baseline':>12} {'actual':>12} {'cambio':>9}")
+    sections = list(current.get("micro", {}).items())
+    if "load" in current:
+        sections.append(("load", current["load"]))
+    for name, stats in sections:
+        old = baseline.get("load") if name == "load" else baseline.get("micro", {}).get(name)
+        if not old:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            before, after = old.get(metric), stats.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            print(f"{name:32} {metric:8} {before:12.3f} {after:12.3f} {change:+8.1f}%")
+    if "startup" in current and "startup" in baseline:
+        for metric in ("import_ms", "ready_ms", "first_route_ms", "rss_peak_mb"):
+            before, after = baseline["startup"].get(metric), current["startup"].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            print(f"{'startup':32} {metric:14} {before:12.1f} {after:12.1f} {change:+8.1f}%")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark de la API de rutas de Huaraz.")
+    parser.add_argument("mode", choices=["micro", "load", "all", "startup"])
+    parser.add_argument("--pairs", type=int, default=20, help="Número de pares origen/destino")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--repeat", type=int, default=3, help="Repeticiones por par en micro-benchmarks (arranques en modo startup)")
+    parser.add_argument("--requests", type=int, default=100, help="Solicitudes totales en modo carga")
+    parser.add_argument("--concurrency", type=int, default=4, help="Clientes concurrentes en modo carga")
+    parser.add_argument("--output", default="benchmark_results.json", help="Archivo JSON de resultados")
+    parser.add_argument("--compare", help="Archivo JSON de baseline para comparar")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s", force=True)
+    # Los logs por solicitud de main.py distorsionan los tiempos
+    logging.getLogger("main").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.mode == "startup":
+        logger.info(f"Midiendo {args.repeat} arranques en frío de la aplicación...")
+        results = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+            },
+            "startup": run_startup(args.repeat),
+        }
+        stats = results["startup"]
+        logger.info(f"  importación={stats['import_ms']:.0f}ms lista={stats['ready_ms']:.0f}ms "
+                    f"primera ruta={stats['first_route_ms']:.0f}ms RSS máx={stats['rss_peak_mb']:.0f}MB "
+                    f"módulos pesados={stats['heavy_modules']}")
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Resultados guardados en {args.output}")
+        if args.compare:
+            compare(results, args.compare)
+        return
+
+    logger.info(f"Cargando grafo desde {GRAPH_PATH}...")
+    graph = load_graph(GRAPH_PATH)
+    # El almacén compartido del benchmark vive en un directorio temporal que se borra al terminar
+    with tempfile.TemporaryDirectory(prefix="benchmark_rutas_") as store_dir:
+        install_fakes(graph, args.seed, shared_store_dir=store_dir)
+        try:
+            pairs = generate_od_pairs(graph, args.pairs, args.seed)
+            logger.info(f"{len(pairs)} pares origen/destino generados con semilla {args.seed}.")
+
+            results = {
+                "meta": {
+                    "timestamp": datetime.now().isoformat(timespec="seconds"),
+                    "git_revision": git_revision(),
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "cpu_count": os.cpu_count(),
+                    "seed": args.seed,
+                    "pairs": len(pairs),
+                    "nodes": graph.n_nodes,
+                    "edges": graph.n_edges,
+                }
+            }
+
+            if args.mode in ("micro", "all"):
+                logger.info("Ejecutando micro-benchmarks...")
+                results["micro"] = run_micro(graph, pairs, args.repeat)
+                for stage, stats in results["micro"].items():
+                    logger.info(f"  {stage:24} p50={stats['p50_ms']:.3f}ms p95={stats['p95_ms']:.3f}ms "
+                                f"p99={stats['p99_ms']:.3f}ms {stats['throughput_ops_s']} op/s")
+
+            if args.mode in ("load", "all"):
+                logger.info(f"Ejecutando prueba de carga: {args.requests} solicitudes, concurrencia {args.concurrency}...")
+                results["load"] = run_load(pairs, args.requests, args.concurrency)
+                stats = results["load"]
+                logger.info(f"  /calculate_route p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms "
+                            f"p99={stats['p99_ms']:.1f}ms {stats['throughput_ops_s']} req/s, errores={stats['errors']}")
+
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            logger.info(f"Resultados guardados en {args.output}")
+        finally:
+            main.traffic_store.close()
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,153 @@
+"""
+Grafo de calles compacto para el proceso de la API.
+
+El MultiDiGraph de OSMnx guarda cada atributo del GraphML en un diccionario por arista
+(listas de osmid, nombre, geometría, carriles, 'maxspeed' como texto...), y la API
+solo necesita unos pocos. Aquí se leen una sola vez y quedan como arreglos alineados con
+el orden de graph.edges(keys=True) (el mismo del EdgeIndex):
+- 'maxspeed' ya convertido a km/h (float32, NaN si no tiene o no es numérico),
+- el tipo de vía como código uint8 de un vocabulario (highway_classes),
+- el nombre como índice a una tabla de nombres internados (names; -1 si no tiene),
+- la geometría empaquetada en formato CSR: solo los vértices intermedios, porque los
+  extremos son las coordenadas de los nodos.
+"""
+import math
+import re
+
+import numpy as np
+
+MPH_TO_KMH = 1.609344
+_SPEED_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _first(value):
+    return value[0] if isinstance(value, list) and value else value
+
+
+def parse_maxspeed(value) -> float:
+    """'maxspeed' de OSM ('50', '30 mph', ['40', '60']) en km/h; NaN si falta o no es numérico."""
+    value = _first(value)
+    if value is None or isinstance(value, list):
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = _SPEED_NUMBER.search(str(value))
+    if match is None:
+        return math.nan
+    speed = float(match.group())
+    return speed * MPH_TO_KMH if "mph" in str(value) else speed
+
+
+class CompactGraph:
+    """
+    Nodos y aristas del grafo como arreglos numpy. Las aristas van en el orden de
+    graph.edges(keys=True); edge_src y edge_dst son posiciones en node_ids.
+    """
+
+    def __init__(self, node_ids, node_lat, node_lon, edge_src, edge_dst, edge_key, length, maxspeed_kmh,
+                 highway_code, highway_classes, name_code, names, geometry_offsets, geometry_coords):
+        self.node_ids = node_ids
+        self.node_lat = node_lat
+        self.node_lon = node_lon
+        self.edge_src = edge_src
+        self.edge_dst = edge_dst
+        self.edge_key = edge_key
+        self.length = length
+        self.maxspeed_kmh = maxspeed_kmh
+        self.highway_code = highway_code
+        self.highway_classes = highway_classes
+        self.name_code = name_code
+        self.names = names
+        # Vértices intermedios de la arista i: geometry_coords[geometry_offsets[i]:geometry_offsets[i + 1]] (lon, lat)
+        self.geometry_offsets = geometry_offsets
+        self.geometry_coords = geometry_coords
+
+    @classmethod
+    def from_networkx(cls, graph):
+        """Convierte un MultiDiGraph de OSMnx (con atributos ya tipados por ox.load_graphml)."""
+        node_ids = np.fromiter(graph.nodes, dtype=np.int64, count=len(graph.nodes))
+        node_position = {node: i for i, node in enumerate(graph.nodes)}
+        node_lat = np.array([data["y"] for _, data in graph.nodes(data=True)], dtype=np.float64)
+        node_lon = np.array([data["x"] for _, data in graph.nodes(data=True)], dtype=np.float64)
+
+        n_edges = len(graph.edges)
+        edge_src = np.empty(n_edges, dtype=np.int32)
+        edge_dst = np.empty(n_edges, dtype=np.int32)
+        edge_key = np.empty(n_edges, dtype=np.int32)
+        length = np.empty(n_edges, dtype=np.float64)
+        maxspeed_kmh = np.empty(n_edges, dtype=np.float32)
+        highway_code = np.empty(n_edges, dtype=np.uint8)
+        name_code = np.empty(n_edges, dtype=np.int32)
+        highway_codes, name_codes = {}, {}
+        interior_counts = np.zeros(n_edges, dtype=np.int64)
+        interior_coords = []
+
+        for i, (u, v, key, data) in enumerate(graph.edges(keys=True, data=True)):
+            edge_src[i] = node_position[u]
+            edge_dst[i] = node_position[v]
+            edge_key[i] = key
+            length[i] = data.get("length", math.nan)
+            maxspeed_kmh[i] = parse_maxspeed(data.get("maxspeed"))
+
+            highway = str(_first(data.get("highway", "N/A")))
+            highway_code[i] = highway_codes.setdefault(highway, len(highway_codes))
+
+            name = data.get("name")
+            if name is None or (isinstance(name, float) and math.isnan(name)):
+                name_code[i] = -1
+            else:
+                name = tuple(str(n) for n in name) if isinstance(name, list) else (str(name),)
+                name_code[i] = name_codes.setdefault(name, len(name_codes))
+
+            geometry = data.get("geometry")
+            if geometry is not None:
+                coords = list(geometry.coords)[1:-1]
+                interior_counts[i] = len(coords)
+                interior_coords.extend(coords)
+
+        if len(highway_codes) > 256:
+            raise ValueError(f"Demasiados tipos de vía distintos para un código uint8: {len(highway_codes)}.")
+        geometry_offsets = np.concatenate([[0], np.cumsum(interior_counts)]).astype(np.int64)
+        geometry_coords = np.array(interior_coords, dtype=np.float64).reshape(-1, 2)
+        return cls(node_ids, node_lat, node_lon, edge_src, edge_dst, edge_key, length, maxspeed_kmh,
+                   highway_code, tuple(highway_codes), name_code, tuple(name_codes), geometry_offsets, geometry_coords)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.edge_src)
+
+    def nbytes(self) -> int:
+        """Memoria aproximada de los arreglos (sin contar la tabla de nombres)."""
+        return sum(getattr(self, name).nbytes for name in (
+            "node_ids", "node_lat", "node_lon", "edge_src", "edge_dst", "edge_key", "length",
+            "maxspeed_kmh", "highway_code", "name_code", "geometry_offsets", "geometry_coords"))
+
+    def edge_keys(self) -> list:
+        """Aristas como (u, v, key) con osmids, en el orden de los arreglos (para el EdgeIndex)."""
+        return list(zip(self.node_ids[self.edge_src].tolist(), self.node_ids[self.edge_dst].tolist(), self.edge_key.tolist()))
+
+    def highway(self, i) -> str:
+        return self.highway_classes[self.highway_code[i]]
+
+    def highways(self) -> list:
+        """Tipo de vía de cada arista; las cadenas son las del vocabulario, no copias."""
+        return [self.highway_classes[code] for code in self.highway_code.tolist()]
+
+    def edge_geometry(self):
+        """
+        Geometría completa de todas las aristas en formato CSR: (offsets, coords), con
+        coords[offsets[i]:offsets[i + 1]] los puntos (lon, lat) de la arista i, extremos incluidos.
+        """
+        interior_counts = np.diff(self.geometry_offsets)
+        offsets = np.concatenate([[0], np.cumsum(interior_counts + 2)]).astype(np.int64)
+        coords = np.empty((offsets[-1], 2), dtype=np.float64)
+        coords[offsets[:-1]] = np.column_stack([self.node_lon[self.edge_src], self.node_lat[self.edge_src]])
+        coords[offsets[1:] - 1] = np.column_stack([self.node_lon[self.edge_dst], self.node_lat[self.edge_dst]])
+        owners = np.repeat(np.arange(self.n_edges), interior_counts)
+        rank = np.arange(len(self.geometry_coords)) - self.geometry_offsets[owners]
+        coords[offsets[owners] + 1 + rank] = self.geometry_coords
+        return offsets, coords
@@ -0,0 +1,180 @@
+import logging
+import re
+import unicodedata
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Abreviaturas comunes en las direcciones de Huaraz. Se expanden tanto en el
+# índice como en la consulta para que "av luzuriaga" encuentre "Avenida Luzuriaga".
+ABREVIATURAS = {
+    "av": "avenida",
+    "avda": "avenida",
+    "jr": "jiron",
+    "ca": "calle",
+    "cl": "calle",
+    "psje": "pasaje",
+    "pje": "pasaje",
+    "carr": "carretera",
+    "prol": "prolongacion",
+    "urb": "urbanizacion",
+}
+
+# Palabras que no aportan a la búsqueda (artículos y preposiciones)
+PALABRAS_VACIAS = {"de", "del", "la", "las", "el", "los", "y"}
+
+# Tipos de vía: se ignoran en la similitud de trigramas porque casi todos los nombres los
+# llevan y "Avenida Raimondi" se parecería a cualquier otra avenida
+TIPOS_DE_CALLE = {"avenida", "jiron", "calle", "pasaje", "carretera"}
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normaliza un texto para búsqueda: minúsculas, sin tildes ni signos de puntuación
+    y con las abreviaturas expandidas.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z0-9 ]+", " ", text.lower())
+    tokens = [ABREVIATURAS.get(token, token) for token in text.split()]
+    return " ".join(tokens)
+
+
+def _tokens(normalized: str) -> list:
+    return [t for t in normalized.split() if t not in PALABRAS_VACIAS]
+
+
+def _trigrams(normalized: str) -> set:
+    """Trigramas del nombre sin palabras vacías ni tipos de vía (salvo que no quede otra cosa)."""
+    words = [t for t in _tokens(normalized) if t not in TIPOS_DE_CALLE]
+    padded = f"  {' '.join(words) or normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class GeocodingIndex:
+    """
+    Índice de geocodificación en memoria construido a partir de los nombres de las calles.
+    Cada nombre de calle se indexa una sola vez con un punto representativo (la arista más
+    cercana al centro de la calle), por prefijos de palabra y por trigramas.
+    """
+
+    def __init__(self):
+        self.names = []          # nombre original para mostrar
+        self.normalized = []     # nombre normalizado
+        self.coords = []         # (lat, lon) representativo
+        self._points = defaultdict(list)  # nombre -> [(lat, lon), ...] mientras se construye
+        self._prefix_index = {}  # prefijo de palabra -> set(ids)
+        self._trigram_index = {} # trigrama -> set(ids)
+
+    def add_street_point(self, name, lat: float, lon: float):
+        """Registra un punto (por ejemplo, el punto medio de una arista) de una calle con nombre."""
+        if not name:
+            return
+        names = name if isinstance(name, list) else [name]
+        for single_name in names:
+            single_name = str(single_name).strip()
+            if single_name and single_name.lower() != "nan":
+                self._points[single_name].append((lat, lon))
+
+    def add_from_graph(self, graph):
+        """Añade las calles con nombre de un grafo compacto (compact_graph.CompactGraph)."""
+        lats = ((graph.node_lat[graph.edge_src] + graph.node_lat[graph.edge_dst]) / 2).tolist()
+        lons = ((graph.node_lon[graph.edge_src] + graph.node_lon[graph.edge_dst]) / 2).tolist()
+        for i, code in enumerate(graph.name_code.tolist()):
+            if code >= 0:
+                self.add_street_point(list(graph.names[code]), lats[i], lons[i])
+
+    def add_from_postgis(self, conn):
+        """
+        Añade las calles de la tabla 'edges' creada por load_map_to_db.py.
+        Útil cuando la base de datos cubre más área que el grafo cargado en memoria.
+        """
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT name, ST_Y(ST_Centroid(geometry)), ST_X(ST_Centroid(geometry))
+                FROM edges
+                WHERE name IS NOT NULL;
+                """
+            )
+            for name, lat, lon in cur:
+                # GeoPandas guarda las listas de OSMnx como texto "['A', 'B']"
+                if name.startswith("[") and name.endswith("]"):
+                    name = [n.strip(" '\"") for n in name[1:-1].split(",")]
+                self.add_street_point(name, lat, lon)
+
+    def build(self):
+        """Consolida los puntos registrados y construye los índices de prefijos y trigramas."""
+        for name, points in self._points.items():
+            normalized = normalize_text(name)
+            if not normalized:
+                continue
+            center_lat = sum(p[0] for p in points) / len(points)
+            center_lon = sum(p[1] for p in points) / len(points)
+            # El centroide de una calle curva puede caer fuera de ella: usamos el punto más cercano
+            representative = min(points, key=lambda p: (p[0] - center_lat) ** 2 + (p[1] - center_lon) ** 2)
+
+            entry_id = len(self.names)
+            self.names.append(name)
+            self.normalized.append(normalized)
+            self.coords.append(representative)
+
+            for token in _tokens(normalized):
+                for i in range(1, len(token) + 1):
+                    self._prefix_index.setdefault(token[:i], set()).add(entry_id)
+            for trigram in _trigrams(normalized):
+                self._trigram_index.setdefault(trigram, set()).add(entry_id)
+
+        self._points.clear()
+        logger.info(f"Índice de geocodificación construido con {len(self.names)} calles.")
+        return self
+
+    def search(self, query: str, limit: int = 5) -> list:
+        """
+        Busca calles por nombre. Primero por prefijos de todas las palabras de la consulta
+        (ignorando tildes y mayúsculas) y, si no alcanza, por similitud de trigramas
+        para tolerar errores de tipeo.
+        Retorna una lista de diccionarios con el mismo formato que Nominatim.
+        """
+        normalized_query = normalize_text(query)
+        query_tokens = _tokens(normalized_query)
+        if not query_tokens:
+            return []
+
+        scores = {}
+
+        prefix_matches = None
+        for token in query_tokens:
+            ids = self._prefix_index.get(token, set())
+            prefix_matches = ids if prefix_matches is None else prefix_matches & ids
+            if not prefix_matches:
+                break
+        for entry_id in prefix_matches or ():
+            # Coincidencia de prefijo: prioridad alta, mejor si el nombre empieza con la consulta
+            bonus = 1.0 if self.normalized[entry_id].startswith(normalized_query) else 0.0
+            scores[entry_id] = 2.0 + bonus - len(self.normalized[entry_id]) / 1000
+
+        if len(scores) < limit:
+            query_trigrams = _trigrams(normalized_query)
+            shared_counts = defaultdict(int)
+            for trigram in query_trigrams:
+                for entry_id in self._trigram_index.get(trigram, ()):
+                    shared_counts[entry_id] += 1
+            for entry_id, shared in shared_counts.items():
+                if entry_id in scores:
+                    continue
+                # Fracción de los trigramas de la consulta presentes en el nombre
+                similarity = shared / len(query_trigrams)
+                if similarity >= 0.5:
+                    scores[entry_id] = similarity - len(self.normalized[entry_id]) / 1000
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [
+            {
+                "display_name": f"{self.names[entry_id]}, Huaraz",
+                "lat": self.coords[entry_id][0],
+                "lon": self.coords[entry_id][1],
+                "score": round(score, 3),
+            }
+            for entry_id, score in best
+        ]
@@ -0,0 +1,73 @@
+"""
+Copia nativa (pickle) del grafo de calles para que el proceso de la API no tenga que
+importar osmnx ni parsear el GraphML en cada arranque. Se guarda el grafo compacto
+(compact_graph.CompactGraph), no el MultiDiGraph de OSMnx.
+
+La copia se regenera sola cuando cambia el GraphML (tamaño o fecha de modificación);
+también se puede generar antes del despliegue con:
+    python graph_snapshot.py
+"""
+import argparse
+import logging
+import os
+import pickle
+
+from compact_graph import CompactGraph
+
+logger = logging.getLogger(__name__)
+
+GRAPH_PATH = "calles_huaraz.graphml"
+GRAPH_SNAPSHOT_PATH = os.getenv("GRAPH_SNAPSHOT_PATH", os.path.join("cache", "calles_huaraz.graph.pickle"))
+SNAPSHOT_VERSION = 2
+
+
+def _source_signature(graphml_path):
+    stat = os.stat(graphml_path)
+    return (SNAPSHOT_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def write_snapshot(graphml_path=GRAPH_PATH, snapshot_path=GRAPH_SNAPSHOT_PATH):
+    """Carga el GraphML con osmnx y guarda la copia nativa del grafo compacto. Retorna el grafo compacto."""
+    import osmnx as ox  # solo para regenerar la copia; el arranque normal no lo importa
+
+    graph = CompactGraph.from_networkx(ox.load_graphml(graphml_path))
+    directory = os.path.dirname(snapshot_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Escritura atómica: otro worker puede estar leyendo la copia anterior
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"signature": _source_signature(graphml_path), "graph": graph}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"Copia nativa del grafo guardada en {snapshot_path}.")
+    return graph
+
+
+def load_graph(graphml_path=GRAPH_PATH, snapshot_path=GRAPH_SNAPSHOT_PATH):
+    """
+    Grafo de calles compacto desde la copia nativa si corresponde al GraphML actual; si no existe,
+    está desactualizada o no se puede leer, se regenera desde el GraphML.
+    """
+    signature = _source_signature(graphml_path)
+    try:
+        with open(snapshot_path, "rb") as f:
+            snapshot = pickle.load(f)
+        if snapshot.get("signature") == signature:
+            return snapshot["graph"]
+        logger.info(f"La copia nativa del grafo {snapshot_path} no corresponde a {graphml_path}; se regenera.")
+    except FileNotFoundError:
+        logger.info(f"No existe la copia nativa del grafo {snapshot_path}; se genera desde {graphml_path}.")
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError) as e:
+        logger.warning(f"No se pudo leer la copia nativa del grafo {snapshot_path}, se regenera: {e}")
+    return write_snapshot(graphml_path, snapshot_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera la copia nativa del grafo de calles que usa la API al arrancar.")
+    parser.add_argument("--graph", default=GRAPH_PATH, help="GraphML de origen.")
+    parser.add_argument("--output", default=GRAPH_SNAPSHOT_PATH, help="Archivo de la copia nativa.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    graph = write_snapshot(args.graph, args.output)
+    print(f"Grafo con {graph.n_nodes} nodos y {graph.n_edges} aristas ({graph.nbytes() / 1e6:.1f} MB en arreglos).")
@@ -0,0 +1,229 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import redis
+
+from traffic_store import FIELDS, SlotWeights
+
+logger = logging.getLogger(__name__)
+
+INCIDENTS_REDIS_KEY = "incidents"                  # hash id -> incidente en JSON
+INCIDENTS_VERSION_KEY = "incidents:version"        # contador que cambia con cada alta o baja
+INCIDENT_SYNC_INTERVAL_SECONDS = 1.0
+INCIDENT_SYNC_RETRY_SECONDS = 15.0                 # espera tras un fallo de Redis, para no frenar cada consulta
+
+
+class Incident:
+    """
+    Incidente sobre un conjunto de aristas (posiciones del EdgeIndex): multiplica su
+    velocidad por 'speed_factor' (0 = vía cerrada) entre 'starts_at' y 'ends_at' (None = sin fin).
+    """
+
+    def __init__(self, incident_id, positions, speed_factor, starts_at, ends_at=None, description=""):
+        self.id = incident_id
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.speed_factor = float(speed_factor)
+        self.starts_at = starts_at
+        self.ends_at = ends_at
+        self.description = description
+
+    def is_active(self, at: datetime) -> bool:
+        return self.starts_at <= at and (self.ends_at is None or at < self.ends_at)
+
+    def is_expired(self, at: datetime) -> bool:
+        return self.ends_at is not None and at >= self.ends_at
+
+    def to_dict(self, edge_index) -> dict:
+        return {
+            "id": self.id,
+            "aristas": [list(edge_index.edges[i]) for i in self.positions.tolist()],
+            "factor_velocidad": self.speed_factor,
+            "cierre": self.speed_factor == 0,
+            "inicio": self.starts_at.isoformat(),
+            "fin": self.ends_at.isoformat() if self.ends_at else None,
+            "descripcion": self.description,
+        }
+
+    @classmethod
+    def from_dict(cls, data, edge_index):
+        positions = [edge_index.position[tuple(edge)] for edge in data["aristas"] if tuple(edge) in edge_index.position]
+        return cls(
+            data["id"],
+            positions,
+            data["factor_velocidad"],
+            datetime.fromisoformat(data["inicio"]),
+            datetime.fromisoformat(data["fin"]) if data["fin"] else None,
+            data.get("descripcion", ""),
+        )
+
+
+class IncidentOverlay:
+    """
+    Incidentes vigentes como un delta disperso sobre los arreglos de tráfico de cada franja:
+    solo las aristas afectadas y su factor de velocidad (el menor si hay varios incidentes).
+    apply() lo aplica al momento de la consulta sobre una copia de unos pocos arreglos,
+    sin tocar el almacén compartido ni copiar el grafo.
+
+    Los incidentes se guardan en Redis para que todos los workers los vean; cada worker
+    vuelve a leerlos cuando cambia el contador INCIDENTS_VERSION_KEY.
+    """
+
+    def __init__(self, graph, edge_index, redis_client=None):
+        self.graph = graph
+        self.edge_index = edge_index
+        self.redis_client = redis_client
+        self.incidents = {}
+        self.version = 0  # cambia cada vez que cambia el conjunto de aristas afectadas
+        # (posiciones, factores) vigentes; se reemplaza entero para que los lectores vean un par consistente
+        self._delta = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+        self._edge_geometries = None
+        self._remote_version = None
+        self._next_sync = 0.0
+        self._lock = threading.Lock()
+
+    # --- Alta, baja y consulta ---
+
+    def add(self, positions, speed_factor, starts_at, ends_at=None, description="") -> Incident:
+        incident = Incident(uuid.uuid4().hex[:12], np.unique(positions), speed_factor, starts_at, ends_at, description)
+        with self._lock:
+            self.incidents[incident.id] = incident
+        self._publish(lambda pipe: pipe.hset(INCIDENTS_REDIS_KEY, incident.id, json.dumps(incident.to_dict(self.edge_index))))
+        logger.info(f"Incidente {incident.id} registrado sobre {len(incident.positions)} aristas (factor {speed_factor}).")
+        return incident
+
+    def remove(self, incident_id) -> bool:
+        if self.redis_client is not None:
+            # Puede haberlo creado otro worker y aún no haberse sincronizado
+            self._sync_from_redis()
+        with self._lock:
+            removed = self.incidents.pop(incident_id, None) is not None
+        self._publish(lambda pipe: pipe.hdel(INCIDENTS_REDIS_KEY, incident_id))
+        return removed
+
+    def list_incidents(self) -> list:
+        with self._lock:
+            incidents = sorted(self.incidents.values(), key=lambda incident: incident.starts_at)
+        return [incident.to_dict(self.edge_index) for incident in incidents]
+
+    def edges_in_polygon(self, geojson) -> np.ndarray:
+        """Posiciones de las aristas cuya geometría corta un polígono GeoJSON (lon, lat)."""
+        import shapely
+        from shapely.geometry import shape
+
+        if self._edge_geometries is None:
+            offsets, coords = self.graph.edge_geometry()
+            self._edge_geometries = shapely.linestrings(coords, indices=np.repeat(np.arange(len(offsets) - 1), np.diff(offsets)))
+        return np.flatnonzero(shapely.intersects(self._edge_geometries, shape(geojson)))
+
+    # --- Sincronización entre workers ---
+
+    def _publish(self, change):
+        if self.redis_client is None:
+            return
+        try:
+            pipe = self.redis_client.pipeline()
+            change(pipe)
+            pipe.incr(INCIDENTS_VERSION_KEY)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"No se pudo guardar el cambio de incidentes en Redis (solo aplica a este worker): {e}")
+
+    def _sync_from_redis(self):
+        try:
+            remote_version = self.redis_client.get(INCIDENTS_VERSION_KEY)
+            if remote_version == self._remote_version:
+                return
+            stored = self.redis_client.hgetall(INCIDENTS_REDIS_KEY)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"No se pudieron leer los incidentes desde Redis (reintento en {INCIDENT_SYNC_RETRY_SECONDS:.0f}s): {e}")
+            self._next_sync = time.monotonic() + INCIDENT_SYNC_RETRY_SECONDS
+            return
+        incidents = {}
+        for incident_id, data in stored.items():
+            incidents[incident_id] = Incident.from_dict(json.loads(data), self.edge_index)
+        with self._lock:
+            self.incidents = incidents
+        self._remote_version = remote_version
+
+    def refresh(self, now: datetime):
+        """
+        Actualiza el delta con los incidentes vigentes en 'now' (leyendo antes los cambios de
+        otros workers, como mucho cada INCIDENT_SYNC_INTERVAL_SECONDS, o cada
+        INCIDENT_SYNC_RETRY_SECONDS si Redis no responde). Retorna las posiciones de las
+        aristas cuyo factor cambió, para invalidar las cachés que dependen de ellas, y la
+        versión que dejó este cambio (la anterior es esa menos uno).
+        """
+        if self.redis_client is not None and time.monotonic() >= self._next_sync:
+            self._next_sync = time.monotonic() + INCIDENT_SYNC_INTERVAL_SECONDS
+            self._sync_from_redis()
+
+        with self._lock:
+            factors = {}
+            expired = []
+            for incident in self.incidents.values():
+                if incident.is_expired(now):
+                    expired.append(incident.id)
+                elif incident.is_active(now):
+                    for position in incident.positions.tolist():
+                        factors[position] = min(factors.get(position, 1.0), incident.speed_factor)
+            for incident_id in expired:
+                del self.incidents[incident_id]
+
+            positions = np.array(sorted(factors), dtype=np.int64)
+            new_factors = np.array([factors[p] for p in positions.tolist()], dtype=np.float64)
+            old_positions, old_factors = self._delta
+            if np.array_equal(positions, old_positions) and np.array_equal(new_factors, old_factors):
+                return np.empty(0, dtype=np.int64), self.version
+
+            previous = dict(zip(old_positions.tolist(), old_factors.tolist()))
+            changed = [p for p in set(previous) | set(factors) if previous.get(p) != factors.get(p)]
+            self._delta = (positions, new_factors)
+            self.version += 1
+            version = self.version
+
+        if expired:
+            for incident_id in expired:
+                self._publish(lambda pipe, incident_id=incident_id: pipe.hdel(INCIDENTS_REDIS_KEY, incident_id))
+        return np.array(changed, dtype=np.int64), version
+
+    @property
+    def active_positions(self) -> np.ndarray:
+        return self._delta[0]
+
+    # --- Aplicación a los datos de una franja ---
+
+    def apply(self, slot_weights, graph_arrays):
+        """
+        Datos de la franja con los incidentes vigentes aplicados. Sin incidentes retorna el
+        mismo objeto; si no, copia solo los arreglos que cambian. Las aristas cerradas quedan
+        con tiempo de viaje infinito.
+        """
+        positions, factors = self._delta
+        if len(positions) == 0:
+            return slot_weights
+
+        arrays = {name: getattr(slot_weights, name) for name, _ in FIELDS}
+        for name in ("travel_time", "speed_kmh", "congestion_level", "categoria_congestion", "length"):
+            arrays[name] = arrays[name].copy()
+        travel_time = arrays["travel_time"]
+
+        # Las aristas sin datos de tráfico parten de su velocidad por defecto
+        no_data = positions[np.isnan(travel_time[positions])]
+        travel_time[no_data] = graph_arrays.default_travel_time[no_data]
+        arrays["speed_kmh"][no_data] = graph_arrays.default_speed_kmh[no_data]
+        arrays["length"][no_data] = graph_arrays.length[no_data]
+        arrays["congestion_level"][no_data] = 0.0
+
+        with np.errstate(divide="ignore"):
+            travel_time[positions] = np.where(factors > 0, travel_time[positions] / factors, np.inf)
+        arrays["speed_kmh"][positions] *= factors
+        congestion = np.maximum(arrays["congestion_level"][positions], 1.0 - factors)
+        arrays["congestion_level"][positions] = congestion
+        # Mismos umbrales que get_congestion_category; los códigos son índices de CATEGORIAS
+        arrays["categoria_congestion"][positions] = np.where(congestion < 0.3, 1, np.where(congestion < 0.7, 2, 3))
+        return SlotWeights(arrays, slot_weights.generation)
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+import os
+import threading
+import uuid
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+import metrics
+from traffic_store import CATEGORIAS
+
+logger = logging.getLogger(__name__)
+
+LIVE_CHECK_INTERVAL_SECONDS = float(os.getenv("LIVE_CHECK_INTERVAL_SECONDS", 2))
+MAX_SUBSCRIPTIONS_PER_CONNECTION = 5
+MAX_ROUTE_NODES = 5000                # nodos por ruta suscrita
+MAX_ORIGINS_PER_DIJKSTRA = 16         # filas (orígenes × nodos) de cada lote de Dijkstra
+MIN_ETA_CHANGE_SECONDS = 5.0          # cambios menores del ETA no se notifican (salvo cambios de categoría)
+SEGMENT_CHANGE_SECONDS = 1.0          # un tramo se informa como cambiado si su tiempo varía al menos esto
+BETTER_ROUTE_MIN_GAIN_SECONDS = 60.0  # se sugiere otra ruta si ahorra al menos esto
+BETTER_ROUTE_MIN_GAIN_RATIO = 0.1     # ... y al menos esta fracción del ETA actual
+_BAJA = CATEGORIAS.index("Baja")
+
+
+def congestion_category(level) -> str:
+    # Mismos umbrales que get_route_details
+    if level < 0.3:
+        return "Baja"
+    if level < 0.7:
+        return "Media"
+    return "Alta"
+
+
+def _seconds(value):
+    """Segundos redondeados para JSON; None si la arista o la ruta está cerrada (inf)."""
+    return round(float(value), 2) if np.isfinite(value) else None
+
+
+class RouteSubscription:
+    """Ruta activa de un cliente y los últimos valores que se le enviaron."""
+
+    __slots__ = ("id", "connection", "nodes", "positions", "travel_times", "categories", "eta", "suggested")
+
+    def __init__(self, connection, nodes, positions):
+        self.id = uuid.uuid4().hex[:12]
+        self.connection = connection
+        self.nodes = nodes
+        self.positions = positions
+        self.travel_times = None
+        self.categories = None
+        self.eta = None
+        self.suggested = None
+
+
+class LiveConnection:
+    """
+    Cola de salida de un WebSocket. Guarda solo el último mensaje pendiente por clave
+    (la suscripción), así un cliente lento recibe el ETA vigente y no una fila de
+    actualizaciones viejas. Se usa desde el event loop.
+    """
+
+    def __init__(self):
+        self.subscription_ids = set()
+        self._pending = {}
+        self._ready = asyncio.Event()
+        self._replies = 0
+
+    def push(self, key, message):
+        self._pending[key] = message
+        self._ready.set()
+
+    def reply(self, message):
+        self._replies += 1
+        self.push(("respuesta", self._replies), message)
+
+    async def next_messages(self) -> list:
+        await self._ready.wait()
+        self._ready.clear()
+        messages, self._pending = list(self._pending.values()), {}
+        return messages
+
+
+class _EdgeState:
+    """Tiempo, congestión, categoría y velocidad de un conjunto de aristas en la franja vigente."""
+
+    def __init__(self, travel_time, congestion, category, speed):
+        self.travel_time = travel_time
+        self.congestion = congestion
+        self.category = category
+        self.speed = speed
+
+    @classmethod
+    def read(cls, positions, travel_times, slot_weights, graph_arrays):
+        has_data = ~np.isnan(slot_weights.travel_time[positions])
+        return cls(
+            travel_times[positions],
+            np.where(has_data, slot_weights.congestion_level[positions], 0.0).astype(np.float64),
+            # Las aristas sin datos se muestran como "Baja", igual que en apply_traffic_weights
+            np.where(has_data, slot_weights.categoria_congestion[positions], _BAJA),
+            np.where(has_data, slot_weights.speed_kmh[positions], graph_arrays.default_speed_kmh[positions]),
+        )
+
+    def take(self, rows):
+        return _EdgeState(self.travel_time[rows], self.congestion[rows], self.category[rows], self.speed[rows])
+
+
+class LiveRouteRegistry:
+    """
+    Rutas suscritas por WebSocket. evaluate() se llama cuando cambia la versión de los
+    datos de tráfico (generación del almacén, franja o incidentes) y reevalúa solo las
+    rutas que pasan por aristas cuyo tiempo cambió: el estado de las aristas se lee una
+    vez para todas las rutas afectadas (aunque compartan aristas), los ETA se suman en
+    bloque y la búsqueda de una ruta mejor es un Dijkstra por lote de orígenes, cortado en
+    el mayor ETA del lote (una ruta mejor tiene que llegar antes).
+    """
+
+    def __init__(self, graph_arrays):
+        self.graph_arrays = graph_arrays
+        self.version = None
+        self._subscriptions = {}
+        self._baseline = None  # tiempos de viaje de la última evaluación
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, connection, nodes, travel_times, slot_weights):
+        """Registra una ruta (lista de osmids) y retorna el mensaje inicial con su ETA actual."""
+        if len(connection.subscription_ids) >= MAX_SUBSCRIPTIONS_PER_CONNECTION:
+            raise ValueError(f"Máximo {MAX_SUBSCRIPTIONS_PER_CONNECTION} rutas suscritas por conexión.")
+        if not 2 <= len(nodes) <= MAX_ROUTE_NODES:
+            raise ValueError(f"La ruta debe tener entre 2 y {MAX_ROUTE_NODES} nodos.")
+        unknown = [n for n in nodes if n not in self.graph_arrays.node_position]
+        if unknown:
+            raise ValueError(f"Nodos inexistentes en el grafo: {unknown[:10]}")
+        positions = self.graph_arrays.path_edges(nodes, travel_times)
+
+        subscription = RouteSubscription(connection, list(nodes), positions)
+        state = _EdgeState.read(positions, travel_times, slot_weights, self.graph_arrays)
+        message = self._message("suscrito", subscription, state, float(state.travel_time.sum()),
+                                np.arange(len(positions)), None)
+        with self._lock:
+            self._subscriptions[subscription.id] = subscription
+            connection.subscription_ids.add(subscription.id)
+            metrics.LIVE_ROUTE_SUBSCRIPTIONS.set(len(self._subscriptions))
+        return message
+
+    def unsubscribe(self, subscription_id) -> bool:
+        with self._lock:
+            subscription = self._subscriptions.pop(subscription_id, None)
+            if subscription is not None:
+                subscription.connection.subscription_ids.discard(subscription_id)
+            metrics.LIVE_ROUTE_SUBSCRIPTIONS.set(len(self._subscriptions))
+        return subscription is not None
+
+    def drop_connection(self, connection):
+        for subscription_id in list(connection.subscription_ids):
+            self.unsubscribe(subscription_id)
+
+    def _message(self, kind, subscription, state, eta, segments, suggestion):
+        """Arma el mensaje y deja en la suscripción los valores enviados."""
+        subscription.travel_times = state.travel_time
+        subscription.categories = state.category
+        subscription.eta = eta
+        subscription.suggested = suggestion
+        congestion = float(state.congestion.mean())
+        return {
+            "tipo": kind,
+            "suscripcion": subscription.id,
+            "tiempo_total_viaje_segundos": _seconds(eta),
+            "tiempo_total_viaje_minutos": _seconds(eta / 60),
+            "ruta_cerrada": not np.isfinite(eta),
+            "overall_congestion": congestion,
+            "overall_congestion_category": congestion_category(congestion),
+            "segmentos": [
+                {
+                    "indice": j,
+                    "travel_time_seconds": _seconds(state.travel_time[j]),
+                    "congestion_level": float(state.congestion[j]),
+                    "categoria_congestion": CATEGORIAS[int(state.category[j])],
+                    "speed_kmh": float(state.speed[j]),
+                }
+                for j in segments.tolist()
+            ],
+            "ruta_sugerida": suggestion,
+        }
+
+    def _better_routes(self, affected, etas, matrix) -> dict:
+        """
+        Rutas sugeridas {índice en 'affected': sugerencia}. Los orígenes distintos se buscan en
+        lotes de MAX_ORIGINS_PER_DIJKSTRA para acotar la matriz de distancias, y cada búsqueda
+        se corta en el mayor ETA de sus rutas.
+        """
+        node_position = self.graph_arrays.node_position
+        by_origin = {}
+        for k, subscription in enumerate(affected):
+            by_origin.setdefault(subscription.nodes[0], []).append(k)
+        origins = sorted(by_origin)
+
+        suggestions = {}
+        for start in range(0, len(origins), MAX_ORIGINS_PER_DIJKSTRA):
+            batch = origins[start:start + MAX_ORIGINS_PER_DIJKSTRA]
+            limit = float(np.max(etas[[k for origin in batch for k in by_origin[origin]]]))
+            if np.isnan(limit):
+                limit = np.inf
+            distances, predecessors = dijkstra(matrix, directed=True, return_predecessors=True,
+                                               indices=[node_position[n] for n in batch], limit=limit)
+            for row, origin in enumerate(batch):
+                for k in by_origin[origin]:
+                    subscription, eta = affected[k], float(etas[k])
+                    best = distances[row, node_position[subscription.nodes[-1]]]
+                    gain_needed = max(BETTER_ROUTE_MIN_GAIN_SECONDS, BETTER_ROUTE_MIN_GAIN_RATIO * eta) if np.isfinite(eta) else 0.0
+                    if np.isfinite(best) and eta - best >= gain_needed:
+                        suggestions[k] = {
+                            "nodos_de_ruta": self.graph_arrays.path_nodes(predecessors[row], subscription.nodes[-1]),
+                            "tiempo_total_viaje_segundos": _seconds(best),
+                        }
+        return suggestions
+
+    def evaluate(self, version, travel_times, slot_weights, matrix) -> list:
+        """
+        Reevalúa las rutas afectadas por los cambios desde la última evaluación.
+        Retorna [(conexión, id de suscripción, mensaje)] para las que cambiaron lo suficiente.
+        """
+        with self._lock:
+            if version == self.version:
+                return []
+            self.version = version
+            baseline, self._baseline = self._baseline, travel_times
+            subscriptions = list(self._subscriptions.values())
+        if not subscriptions:
+            return []
+
+        if baseline is None or len(baseline) != len(travel_times):
+            changed = np.ones(len(travel_times), dtype=bool)
+        else:
+            changed = ~np.isclose(travel_times, baseline, rtol=0, atol=1e-3)
+        affected = [s for s in subscriptions if changed[s.positions].any()]
+        if not affected:
+            return []
+
+        # Estado de cada arista una sola vez, aunque varias rutas la compartan
+        lengths = np.array([len(s.positions) for s in affected])
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        unique, inverse = np.unique(np.concatenate([s.positions for s in affected]), return_inverse=True)
+        shared = _EdgeState.read(unique, travel_times, slot_weights, self.graph_arrays)
+        with np.errstate(invalid="ignore"):
+            etas = np.add.reduceat(shared.travel_time[inverse], offsets)
+
+        suggestions = self._better_routes(affected, etas, matrix)
+
+        messages = []
+        for k, subscription in enumerate(affected):
+            state = shared.take(inverse[offsets[k]:offsets[k] + lengths[k]])
+            eta = float(etas[k])
+            suggestion = suggestions.get(k)
+
+            segments = np.flatnonzero(
+                (state.category != subscription.categories)
+                | ~np.isclose(state.travel_time, subscription.travel_times, rtol=0, atol=SEGMENT_CHANGE_SECONDS))
+            eta_changed = not np.isclose(eta, subscription.eta, rtol=0, atol=MIN_ETA_CHANGE_SECONDS)
+            suggestion_changed = (suggestion is None) != (subscription.suggested is None) or (
+                suggestion is not None and suggestion["nodos_de_ruta"] != subscription.suggested["nodos_de_ruta"])
+            if not (eta_changed or suggestion_changed or (state.category != subscription.categories).any()):
+                metrics.LIVE_ROUTE_UPDATES.inc(1, "unchanged")
+                continue
+
+            previous_eta = subscription.eta
+            message = self._message("actualizacion", subscription, state, eta, segments, suggestion)
+            message["cambio_segundos"] = _seconds(eta - previous_eta) if np.isfinite(previous_eta) else None
+            messages.append((subscription.connection, subscription.id, message))
+            metrics.LIVE_ROUTE_UPDATES.inc(1, "sent")
+        logger.info(f"Rutas en vivo: {len(affected)} de {len(subscriptions)} afectadas, {len(messages)} notificadas.")
+        return messages
@@ -1,54 +1,279 @@
-import osmnx as ox
+"""
+Carga los nodos y aristas del grafo de Huaraz en las tablas 'nodes' y 'edges' de PostGIS.
+
+Las filas se envían con COPY (geometría como EWKB en hexadecimal) a tablas de carga y:
+- modo replace (por defecto): las tablas de carga se indexan (GiST sobre la geometría,
+  B-tree sobre las claves) y reemplazan a las actuales con un cambio de nombre dentro de
+  una transacción; las consultas ven la tabla anterior hasta el commit, nunca una vacía,
+- modo upsert: las filas se insertan o actualizan (solo las que cambiaron) sobre las
+  tablas existentes; con --prune también se borran las que ya no están en el grafo.
+
+Uso:
+    python load_map_to_db.py
+    python load_map_to_db.py --mode upsert --graph region_ampliada.graphml
+"""
+import argparse
+import io
+import logging
+import math
+import time
+
 import psycopg2
-from sqlalchemy import create_engine
-import geopandas as gpd
-import pandas as pd 
-
-# --- Configuración de la Base de Datos ---
-DB_HOST = "localhost"
-DB_NAME = "huaraz_rutas"
-DB_USER = "postgres"
-DB_PASS = "alma94moroni" 
-
-# Cadena de conexión para SQLAlchemy (usada por GeoPandas/Pandas)
-db_connection_str = f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
-engine = create_engine(db_connection_str)
-
-# --- Cargar el Grafo existente ---
-graphml_filepath = "calles_huaraz.graphml"
-print(f"Cargando el grafo desde: {graphml_filepath}")
-G = ox.load_graphml(filepath=graphml_filepath)
-print(f"Grafo cargado. Nodos: {len(G.nodes)}, Aristas: {len(G.edges)}")
-
-# --- Exportar nodos y aristas a GeoDataFrames ---
-# prepara los datos en un formato tabular compatible con bases de datos espaciales
-print("Convirtiendo grafo a GeoDataFrames de nodos y aristas...")
-nodes_gdf, edges_gdf = ox.graph_to_gdfs(G)
-
-# Limpiar nombres de columnas para compatibilidad con PostGIS si son muy largos o tienen caracteres especiales
-nodes_gdf.columns = [col.replace(':', '_') for col in nodes_gdf.columns]
-edges_gdf.columns = [col.replace(':', '_') for col in edges_gdf.columns]
-
-# Asegurarse de que los índices son nombres de columnas para que se guarden
-nodes_gdf['osmid'] = nodes_gdf.index # osmid ya es un atributo común, pero lo aseguramos
-edges_gdf['u'] = edges_gdf.index.get_level_values(0)
-edges_gdf['v'] = edges_gdf.index.get_level_values(1)
-edges_gdf['key'] = edges_gdf.index.get_level_values(2)
-
-
-# --- Guardar los GeoDataFrames directamente en PostGIS ---
-print(f"Guardando nodos en la tabla '{DB_NAME}.nodes' en PostgreSQL...")
-try:
-    nodes_gdf.to_postgis("nodes", engine, if_exists="replace", index=False)
-    print("Nodos guardados exitosamente.")
-except Exception as e:
-    print(f"Error al guardar nodos: {e}")
-
-print(f"Guardando aristas en la tabla '{DB_NAME}.edges' en PostgreSQL...")
-try:
-    edges_gdf.to_postgis("edges", engine, if_exists="replace", index=False)
-    print("Aristas guardadas exitosamente.")
-except Exception as e:
-    print(f"Error al guardar aristas: {e}")
-
-print("Proceso de carga de mapa a la base de datos completado.")
\ No newline at end of file
+
+from map_update import edge_line, ensure_edge_ids
+from populate_traffic_data import GRAPH_PATH, get_db_connection
+
+logger = logging.getLogger(__name__)
+
+# Columnas con tipo propio; el resto de atributos del grafo va como TEXT (las listas de
+# OSMnx como "['A', 'B']", igual que las guardaba GeoPandas)
+NODE_COLUMN_TYPES = {
+    "osmid": "BIGINT",
+    "y": "DOUBLE PRECISION",
+    "x": "DOUBLE PRECISION",
+    "street_count": "INTEGER",
+}
+EDGE_COLUMN_TYPES = {
+    "u": "BIGINT",
+    "v": "BIGINT",
+    "key": "BIGINT",
+    "edge_id": "BIGINT",
+    "osmid": "TEXT",
+    "name": "TEXT",
+    "highway": "TEXT",
+    "oneway": "BOOLEAN",
+    "length": "DOUBLE PRECISION",
+}
+TABLES = {
+    # tabla: (tipos conocidos, clave primaria, tipo de geometría)
+    "nodes": (NODE_COLUMN_TYPES, ("osmid",), "Point"),
+    "edges": (EDGE_COLUMN_TYPES, ("u", "v", "key"), "LineString"),
+}
+# Índices B-tree además de la clave primaria y el GiST de la geometría
+EXTRA_INDEXES = {
+    "edges": (("edge_id",), ("name",)),
+    "nodes": (),
+}
+
+
+def _column_name(attribute):
+    # Mismo criterio que antes con GeoPandas: ':' no es cómodo en nombres de columna
+    return attribute.replace(":", "_")
+
+
+def _copy_field(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "\\N"
+    if isinstance(value, (list, tuple, set)):
+        value = str(list(value))
+    elif not isinstance(value, str):
+        value = str(value.item() if hasattr(value, "item") else value)
+    return value.replace("\\", "\\\\").replace("\t", " ").replace("\n", " ").replace("\r", " ")
+
+
+class _CopyStream(io.TextIOBase):
+    """Archivo de solo lectura que arma las líneas de COPY a medida que psycopg2 las pide."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ""
+        self.line_count = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+            self.line_count += 1
+        if size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+# --- Filas del grafo ---
+
+def node_records(graph):
+    """(atributos, geometría) de cada nodo, con 'osmid' incluido. La geometría (None) sale de x, y."""
+    for node, data in graph.nodes(data=True):
+        yield {**data, "osmid": node}, None
+
+
+def edge_records(graph):
+    """(atributos, geometría) de cada arista, con 'u', 'v', 'key' y 'edge_id' incluidos."""
+    ensure_edge_ids(graph)
+    for u, v, key, data in graph.edges(keys=True, data=True):
+        attributes = {name: value for name, value in data.items() if name != "geometry"}
+        attributes.update(u=u, v=v, key=key, edge_id=int(data["edge_id"]))
+        yield attributes, edge_line(graph, u, v, data)
+
+
+def table_columns(graph, table):
+    """Columnas (nombre, tipo) para los atributos presentes en el grafo, las conocidas primero."""
+    known, _, _ = TABLES[table]
+    if table == "nodes":
+        attribute_sets = (data for _, data in graph.nodes(data=True))
+    else:
+        attribute_sets = (data for _, _, data in graph.edges(data=True))
+    extra = set()
+    for attributes in attribute_sets:
+        extra.update(_column_name(name) for name in attributes if name != "geometry")
+    extra -= set(known)
+    return list(known.items()) + [(name, "TEXT") for name in sorted(extra)]
+
+
+def _copy_lines(records, columns):
+    import shapely
+    from shapely.geometry import Point
+
+    names = [name for name, _ in columns]
+    for attributes, geometry in records:
+        attributes = {_column_name(name): value for name, value in attributes.items()}
+        if geometry is None:
+            geometry = Point(attributes["x"], attributes["y"])
+        wkb = shapely.to_wkb(shapely.set_srid(geometry, 4326), hex=True, include_srid=True)
+        yield "\t".join([_copy_field(attributes.get(name)) for name in names] + [wkb]) + "\n"
+
+
+def _records(graph, table):
+    return node_records(graph) if table == "nodes" else edge_records(graph)
+
+
+# --- Carga ---
+
+def _create_table(cur, name, columns, geometry_type, temporary=False):
+    definitions = ", ".join(f'"{column}" {column_type}' for column, column_type in columns)
+    kind = "TEMP TABLE" if temporary else "TABLE"
+    suffix = " ON COMMIT DROP" if temporary else ""
+    cur.execute(f'CREATE {kind} "{name}" ({definitions}, geometry geometry({geometry_type}, 4326)){suffix};')
+
+
+def _copy_into(cur, name, graph, table, columns):
+    column_list = ", ".join(f'"{column}"' for column, _ in columns) + ", geometry"
+    stream = _CopyStream(_copy_lines(_records(graph, table), columns))
+    cur.copy_expert(f'COPY "{name}" ({column_list}) FROM STDIN', stream, size=1 << 16)
+    return stream.line_count
+
+
+def replace_table(conn, graph, table):
+    """
+    Carga la tabla completa en '<tabla>_nuevo', la indexa y la intercambia con la actual
+    dentro de una transacción. Retorna la cantidad de filas.
+    """
+    _, primary_key, geometry_type = TABLES[table]
+    columns = table_columns(graph, table)
+    staging = f"{table}_nuevo"
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP TABLE IF EXISTS "{staging}";')
+            _create_table(cur, staging, columns, geometry_type)
+            rows = _copy_into(cur, staging, graph, table, columns)
+
+            # Los índices se crean con los datos ya cargados: más rápido que mantenerlos fila a fila
+            key_list = ", ".join(f'"{column}"' for column in primary_key)
+            cur.execute(f'ALTER TABLE "{staging}" ADD CONSTRAINT "{staging}_pkey" PRIMARY KEY ({key_list});')
+            cur.execute(f'CREATE INDEX "{staging}_geometry_idx" ON "{staging}" USING GIST (geometry);')
+            index_names = [f"{staging}_pkey", f"{staging}_geometry_idx"]
+            for index_columns in EXTRA_INDEXES[table]:
+                index_name = f"{staging}_{'_'.join(index_columns)}_idx"
+                cur.execute(f'CREATE INDEX "{index_name}" ON "{staging}" ({", ".join(index_columns)});')
+                index_names.append(index_name)
+            cur.execute(f'ANALYZE "{staging}";')
+
+            # Intercambio: las consultas concurrentes esperan el lock y después ven la tabla nueva
+            cur.execute(f'DROP TABLE IF EXISTS "{table}";')
+            cur.execute(f'ALTER TABLE "{staging}" RENAME TO "{table}";')
+            for index_name in index_names:
+                cur.execute(f'ALTER INDEX "{index_name}" RENAME TO "{table}{index_name[len(staging):]}";')
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error al cargar la tabla '{table}', se conserva la anterior: {e}")
+        conn.rollback()
+        raise
+    return rows
+
+
+def upsert_table(conn, graph, table, prune=False):
+    """
+    Inserta las filas nuevas y actualiza las que cambiaron en una tabla creada con
+    replace_table; con 'prune' borra las filas que no están en el grafo. Retorna
+    (filas cargadas, insertadas o actualizadas, borradas).
+    """
+    _, primary_key, geometry_type = TABLES[table]
+    columns = table_columns(graph, table)
+    staging = f"{table}_carga"
+    key_list = ", ".join(f'"{column}"' for column in primary_key)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT to_regclass(%s) IS NOT NULL AND EXISTS (SELECT 1 FROM pg_index WHERE indrelid = to_regclass(%s) AND indisprimary);",
+                        (table, table))
+            if not cur.fetchone()[0]:
+                raise RuntimeError(f"La tabla '{table}' no existe o no tiene clave primaria; cárgala primero con --mode replace.")
+
+            # Atributos que aparecen por primera vez (por ejemplo, al ampliar la región)
+            for column, column_type in columns:
+                cur.execute(f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS "{column}" {column_type};')
+
+            _create_table(cur, staging, columns, geometry_type, temporary=True)
+            rows = _copy_into(cur, staging, graph, table, columns)
+
+            names = [column for column, _ in columns if column not in primary_key] + ["geometry"]
+            all_columns = ", ".join(f'"{column}"' for column, _ in columns) + ", geometry"
+            updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in names)
+            current = ", ".join(f'"{table}"."{column}"' for column in names)
+            incoming = ", ".join(f'EXCLUDED."{column}"' for column in names)
+            cur.execute(f"""
+                INSERT INTO "{table}" ({all_columns})
+                SELECT {all_columns} FROM "{staging}"
+                ON CONFLICT ({key_list}) DO UPDATE SET {updates}
+                WHERE ({current}) IS DISTINCT FROM ({incoming});
+            """)
+            written = cur.rowcount
+
+            deleted = 0
+            if prune:
+                matches = " AND ".join(f't."{column}" = s."{column}"' for column in primary_key)
+                cur.execute(f'DELETE FROM "{table}" t WHERE NOT EXISTS (SELECT 1 FROM "{staging}" s WHERE {matches});')
+                deleted = cur.rowcount
+        conn.commit()
+    except (psycopg2.Error, RuntimeError) as e:
+        logger.error(f"Error en la carga incremental de '{table}': {e}")
+        conn.rollback()
+        raise
+    return rows, written, deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga los nodos y aristas del grafo en PostGIS.")
+    parser.add_argument("--graph", default=GRAPH_PATH, help="GraphML a cargar.")
+    parser.add_argument("--mode", choices=["replace", "upsert"], default="replace",
+                        help="replace: recarga completa con intercambio atómico; upsert: solo inserta o actualiza filas.")
+    parser.add_argument("--prune", action="store_true", help="En modo upsert, borra las filas que no están en el grafo.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+    import osmnx as ox
+
+    logger.info(f"Cargando el grafo desde: {args.graph}")
+    G = ox.load_graphml(args.graph, edge_dtypes={"edge_id": int})
+    logger.info(f"Grafo cargado. Nodos: {len(G.nodes)}, Aristas: {len(G.edges)}")
+
+    conn = get_db_connection()
+    try:
+        for table in ("nodes", "edges"):
+            start = time.perf_counter()
+            if args.mode == "replace":
+                rows = replace_table(conn, G, table)
+                logger.info(f"Tabla '{table}' reemplazada con {rows} filas en {time.perf_counter() - start:.1f}s.")
+            else:
+                rows, written, deleted = upsert_table(conn, G, table, prune=args.prune)
+                logger.info(f"Tabla '{table}': {rows} filas cargadas, {written} insertadas o actualizadas, "
+                            f"{deleted} borradas en {time.perf_counter() - start:.1f}s.")
+    finally:
+        conn.close()
+    logger.info("Proceso de carga de mapa a la base de datos completado.")
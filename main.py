@@ -1,18 +1,35 @@
 import asyncio
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 import uvicorn
 import psycopg2
 from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 import redis
-import osmnx as ox
-import networkx as nx
 import os
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta
 import logging
+import time
 import json
-import copy
+import math
+from typing import Literal
+import numpy as np
+
+from geocoding_index import GeocodingIndex
+from graph_snapshot import load_graph
+from incidents import IncidentOverlay
+from live_routes import LIVE_CHECK_INTERVAL_SECONDS, MAX_ROUTE_NODES, LiveConnection, LiveRouteRegistry
+from probe_ingestion import PROBE_FLUSH_INTERVAL_SECONDS, ProbeIngestor
+from route_cache import ResultCache
+from single_flight import AsyncSingleFlight, SingleFlight
+from routing_graph import GraphArrays
+from trip_optimizer import TripProblem, solve_visit_order
+from traffic_history import HISTORY_ROLLUP_INTERVAL_SECONDS, maintain_history
+from traffic_prediction import EdgeStatics
+from traffic_store import CATEGORIAS, N_SLOTS, TIPOS_VIA, TRAFFIC_STORE_PATH, EdgeIndex, SharedTrafficStore, SlotWeights, slot_index
+import metrics
+import profiling
+from metrics import stage_timer
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -28,6 +45,14 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 
+# Tiempos de espera cortos: si PostgreSQL o Redis no responden se sirve desde el almacén local
+DB_CONNECT_TIMEOUT_SECONDS = int(os.getenv("DB_CONNECT_TIMEOUT_SECONDS", 3))
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", 2))
+RECONNECT_INTERVAL_SECONDS = 15
+TRAFFIC_REFRESH_INTERVAL_SECONDS = 900  # 15 minutos entre ciclos del refrescador
+REDIS_TRAFFIC_TTL_SECONDS = 3600 + TRAFFIC_REFRESH_INTERVAL_SECONDS
+REDIS_RETRY_SECONDS = 15  # tras un fallo, las lecturas de tráfico no vuelven a intentar Redis hasta entonces
+
 app = FastAPI(
     title="API de Rutas Inteligentes para Huaraz",
     description="API para calcular rutas óptimas y alternativas en Huaraz, considerando datos de tráfico y modelos de IA.",
@@ -72,16 +97,107 @@ class MultiRouteResponse(BaseModel):
     nodo_destino_osmid: int
     rutas_alternativas: list[SingleRouteDetails]
 
+class IsochroneRequest(BaseModel):
+    origin: Location
+    umbrales_minutos: list[float] = [10, 20, 30]
+    formato: Literal["poligono", "aristas"] = "poligono"
+
+class Isochrone(BaseModel):
+    umbral_minutos: float
+    nodos_alcanzables: int
+    poligono: dict | None = None            # GeoJSON (lon, lat)
+    aristas: list[list[Location]] | None = None
+
+class IsochroneResponse(BaseModel):
+    nodo_origen_osmid: int
+    dia_de_semana: int
+    hora_del_dia: int
+    isocronas: list[Isochrone]
+
+class TripStop(BaseModel):
+    lat: float
+    lon: float
+    # Ventana de llegada en minutos desde la salida (opcional)
+    ventana_inicio_minutos: float | None = None
+    ventana_fin_minutos: float | None = None
+    servicio_minutos: float = 0.0
+
+class TripRequest(BaseModel):
+    origin: Location
+    paradas: list[TripStop]
+    volver_al_origen: bool = False
+    tiempo_limite_ms: int = 300
+
+class TripStopVisit(BaseModel):
+    indice_parada: int
+    nodo_osmid: int
+    llegada_minutos: float
+    ventana_cumplida: bool
+
+class TripResponse(BaseModel):
+    mensaje: str
+    nodo_origen_osmid: int
+    orden_paradas: list[int]
+    visitas: list[TripStopVisit]
+    tramos: list[SingleRouteDetails]
+    tiempo_total_viaje_minutos: float
+    retraso_total_minutos: float
+
+class IncidentRequest(BaseModel):
+    # Aristas afectadas como [u, v, key] o un polígono GeoJSON (lon, lat); uno de los dos
+    aristas: list[tuple[int, int, int]] | None = None
+    poligono: dict | None = None
+    # Factor sobre la velocidad (0 < f <= 1) o cierre total
+    factor_velocidad: float | None = None
+    cierre: bool = False
+    inicio: datetime | None = None
+    fin: datetime | None = None
+    descripcion: str = ""
+
+class ProbePoint(BaseModel):
+    vehicle_id: str | None = None
+    lat: float
+    lon: float
+    timestamp: float | str
+    speed_kmh: float | None = None
+    heading: float | None = None
+
+class ProbeBatch(BaseModel):
+    points: list[ProbePoint]
+
 # Variables globales para el grafo y las conexiones
 G = None
 db_pool = None
 redis_client = None
+geocoding_index = None
+edge_index = None
+traffic_store = None
+probe_ingestor = None
+edge_statics = None
+graph_arrays = None
+incident_overlay = None
+live_routes = None
+
+MAX_ISOCHRONE_MINUTES = 120
+MAX_TRIP_STOPS = 25
+MAX_TRIP_TIME_LIMIT_MS = 2000
+# Matrices dispersas por franja e isócronas ya calculadas; se invalidan por generación del almacén
+slot_matrix_cache = ResultCache(maxsize=8, ttl_seconds=60)
+isochrone_cache = ResultCache(maxsize=256, ttl_seconds=300)
+trip_matrix_cache = ResultCache(maxsize=64, ttl_seconds=300)
+# Solicitudes idénticas simultáneas comparten un solo cálculo
+redis_retry_at = 0.0  # time.monotonic() desde el que se vuelve a leer tráfico de Redis
+redis_resync_slots = set()  # franjas que el refrescador no pudo escribir en Redis; se reenvían desde el almacén
+
+route_flight = AsyncSingleFlight("calculate_route")
+traffic_load_flight = SingleFlight("traffic_postgres")
 
 def get_edge_travel_times(query_datetime: datetime) -> dict:
     """
     Obtiene los tiempos de viaje estimados y el nivel de congestión para cada arista.
     Primero intenta desde Redis. Si no encuentra o está vacío para la hora,
-    lo obtiene de PostgreSQL y lo cachea en Redis.
+    lo obtiene de PostgreSQL y lo cachea en Redis. Si Redis acaba de fallar, va
+    directo a PostgreSQL durante REDIS_RETRY_SECONDS.
     Retorna un diccionario con (u, v, key) -> {'travel_time': X, 'congestion_level': Y, ...}
     """
     logger.info(f"Obteniendo tiempos de viaje para: {query_datetime.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -92,37 +208,71 @@ def get_edge_travel_times(query_datetime: datetime) -> dict:
     redis_key = f"traffic:{day_of_week}:{hour_of_day}"
     edge_data_from_db = {}
 
+    global redis_retry_at
     try:
-        redis_data = redis_client.hgetall(redis_key)
+        if time.monotonic() < redis_retry_at:
+            raise redis.exceptions.ConnectionError("Redis marcado como no disponible")
+        with stage_timer("traffic_redis"):
+            redis_data = redis_client.hgetall(redis_key)
 
         if redis_data:
+            metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "redis_hit")
             logger.info(f"Datos de tráfico encontrados en Redis para {redis_key}. Cantidad: {len(redis_data)}")
-            for edge_id_str, json_data_str in redis_data.items():
-                u_str, v_str, key_str = edge_id_str.split('-')
-                parsed_data = json.loads(json_data_str)
-                edge_data_from_db[(int(u_str), int(v_str), int(key_str))] = {
-                    'travel_time': parsed_data.get('travel_time', 0.0),
-                    'congestion_level': parsed_data.get('congestion_level', 0.0),
-                    'categoria_congestion': parsed_data.get('categoria_congestion', 'Desconocida'),
-                    'tipo_via_osm': parsed_data.get('tipo_via_osm', 'N/A'),
-                    'length': parsed_data.get('length', 0.0),
-                    'speed_kmh': parsed_data.get('speed_kmh', 0.0)
-                }
+            with stage_timer("traffic_parse"):
+                for edge_id_str, json_data_str in redis_data.items():
+                    u_str, v_str, key_str = edge_id_str.split('-')
+                    parsed_data = json.loads(json_data_str)
+                    edge_data_from_db[(int(u_str), int(v_str), int(key_str))] = {
+                        'travel_time': parsed_data.get('travel_time', 0.0),
+                        'congestion_level': parsed_data.get('congestion_level', 0.0),
+                        'categoria_congestion': parsed_data.get('categoria_congestion', 'Desconocida'),
+                        'tipo_via_osm': parsed_data.get('tipo_via_osm', 'N/A'),
+                        'length': parsed_data.get('length', 0.0),
+                        'speed_kmh': parsed_data.get('speed_kmh', 0.0)
+                    }
             return edge_data_from_db
         else:
+            metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "redis_miss")
             logger.info(f"No hay datos de tráfico en Redis para {redis_key}. Consultando PostgreSQL.")
 
-    except redis.exceptions.ConnectionError as e:
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
+        metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "redis_miss")
+        if time.monotonic() >= redis_retry_at:
+            redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
         logger.warning(f"No se pudo conectar a Redis al obtener tráfico, consultando PostgreSQL. Error: {e}")
     except json.JSONDecodeError as e:
         logger.error(f"Error al decodificar JSON de Redis para {redis_key}: {e}. Consultando PostgreSQL.")
     except Exception as e:
         logger.error(f"Error inesperado al intentar obtener datos de Redis: {e}. Consultando PostgreSQL.")
 
+    # Si varias solicitudes encuentran la franja vacía a la vez, solo una consulta PostgreSQL
+    return traffic_load_flight.do(redis_key, lambda: load_edge_travel_times_from_postgres(day_of_week, hour_of_day, redis_key))
+
+
+def cache_slot_in_redis(redis_key: str, edge_data: dict, expiration_seconds=None):
+    """Reemplaza en Redis el hash de una franja con los datos (u, v, key) -> atributos."""
+    # Eliminar la clave antigua antes de insertar nuevos datos para asegurar frescura
+    redis_client.delete(redis_key)
+    redis_client.hmset(redis_key, {f"{u}-{v}-{key}": json.dumps(data) for (u, v, key), data in edge_data.items()})
+    if expiration_seconds is not None:
+        redis_client.expire(redis_key, expiration_seconds)
+
+
+def load_edge_travel_times_from_postgres(day_of_week: int, hour_of_day: int, redis_key: str) -> dict:
+    """
+    Lee de PostgreSQL los datos de tráfico de una franja y los cachea en Redis.
+    El diccionario puede compartirse entre solicitudes agrupadas: no debe modificarse.
+    """
+    edge_data_from_db = {}
+    if db_pool is None:
+        metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "unavailable")
+        logger.warning(f"PostgreSQL no disponible; la franja {redis_key} se calcula con velocidades por defecto.")
+        return edge_data_from_db
+
     conn = None
     try:
         conn = db_pool.getconn()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with stage_timer("traffic_postgres"), conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
                 """
                 SELECT u, v, edge_key, tiempoviajeestimadosegundos, nivel_congestion,
@@ -141,6 +291,11 @@ def get_edge_travel_times(query_datetime: datetime) -> dict:
                     'length': record.get('length', 0.0),
                     'speed_kmh': record.get('velocidad_promedio_kmh', 0.0)
                 }
+    except psycopg2.OperationalError as e:
+        # Caída de PostgreSQL: mejor una ruta con velocidades por defecto que un error
+        metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "unavailable")
+        logger.warning(f"PostgreSQL no disponible; la franja {redis_key} se calcula con velocidades por defecto. Error: {e}")
+        return {}
     except psycopg2.Error as e:
         logger.error(f"Error al conectar o consultar la base de datos para tiempos de tráfico: {e}")
         raise HTTPException(status_code=500, detail=f"Error en DB al obtener tráfico: {e}")
@@ -154,35 +309,140 @@ def get_edge_travel_times(query_datetime: datetime) -> dict:
     logger.info(f"Se encontraron {len(edge_data_from_db)} tiempos de viaje y congestión en PostgreSQL para el día {day_of_week} hora {hour_of_day}.")
 
     if edge_data_from_db and redis_client:
-        # Eliminar la clave antigua antes de insertar nuevos datos para asegurar frescura
-        redis_client.delete(redis_key)
-        redis_hash_data = {
-            f"{u}-{v}-{key}": json.dumps(data)
-            for (u, v, key), data in edge_data_from_db.items()
-        }
-        redis_client.hmset(redis_key, redis_hash_data)
-        logger.info(f"Datos de tráfico para {redis_key} cacheados en Redis.")
+        try:
+            cache_slot_in_redis(redis_key, edge_data_from_db)
+            logger.info(f"Datos de tráfico para {redis_key} cacheados en Redis.")
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"No se pudieron cachear en Redis los datos de {redis_key}: {e}")
 
     return edge_data_from_db
 
 
+def get_slot_weights(query_datetime: datetime) -> SlotWeights:
+    """
+    Datos de tráfico de la franja (día, hora) como arreglos alineados con edge_index.
+    Se leen del almacén compartido entre workers; si la franja aún no está cargada allí,
+    se recurre a Redis/PostgreSQL mediante get_edge_travel_times.
+    """
+    slot = slot_index(query_datetime.weekday(), query_datetime.hour)
+    weights = None
+    if traffic_store is not None:
+        with stage_timer("traffic_shared"):
+            weights = traffic_store.read_slot(slot)
+        if weights is not None:
+            metrics.TRAFFIC_CACHE_REQUESTS.inc(1, "shared_hit")
+
+    if weights is None:
+        edge_data_from_db = get_edge_travel_times(query_datetime)
+        with stage_timer("traffic_parse"):
+            weights = SlotWeights.from_edge_dict(edge_index, edge_data_from_db)
+    return apply_incidents(weights)
+
+
+def apply_incidents(slot_weights: SlotWeights) -> SlotWeights:
+    """
+    Aplica los incidentes vigentes a los datos de la franja. Si el conjunto de aristas
+    afectadas cambió desde la última consulta, invalida solo las entradas de caché que
+    dependen de esas aristas.
+    """
+    if incident_overlay is None:
+        return slot_weights
+    with stage_timer("incidents"):
+        changed, version = incident_overlay.refresh(datetime.now())
+        if len(changed):
+            # Las entradas que no dependen de esas aristas pasan a la versión nueva. Una entrada
+            # que otro hilo guarde después con la versión anterior ya no se usa.
+            def renew(entry_version):
+                generation, incidents = entry_version
+                return (generation, version) if incidents == version - 1 else entry_version
+
+            invalidated = isochrone_cache.invalidate_edges(changed.tolist(), renew) \
+                + trip_matrix_cache.invalidate_edges(changed.tolist(), renew)
+            logger.info(f"Incidentes actualizados: {len(changed)} aristas cambiaron, {invalidated} resultados cacheados invalidados.")
+        return incident_overlay.apply(slot_weights, graph_arrays)
+
+
+def current_incidents_version() -> int:
+    """
+    Versión de los incidentes vigentes. Las cachés de resultados la leen antes de
+    get_slot_weights: si los incidentes cambian en medio, la entrada queda con una versión
+    anterior a sus datos y a lo sumo no se reutiliza, pero nunca sirve datos viejos.
+    """
+    return incident_overlay.version if incident_overlay is not None else 0
+
+
+def get_slot_matrix(slot: int, slot_weights: SlotWeights, incidents_version: int):
+    """
+    Tiempos de viaje por arista de la franja y su matriz dispersa para scipy.sparse.csgraph.
+    Se cachean por franja mientras no cambien la generación de los datos de tráfico
+    ni los incidentes vigentes ('incidents_version', leída antes de obtener 'slot_weights').
+    """
+    version = (slot_weights.generation, incidents_version)
+    cached = slot_matrix_cache.get(slot, version)
+    if cached is None:
+        travel_times = graph_arrays.slot_travel_times(slot_weights)
+        cached = (travel_times, graph_arrays.build_matrix(travel_times))
+        slot_matrix_cache.put(slot, cached, version)
+    return cached
+
+
 async def refresh_traffic_data_in_redis():
     """
     Tarea en segundo plano para refrescar los datos de tráfico en Redis periódicamente.
+    Con varios workers solo uno (el que obtiene el lock del almacén compartido) consulta
+    PostgreSQL y escribe los arreglos por franja; el resto solo se mantiene conectado
+    al archivo compartido y toma el relevo si el refrescador termina.
+
+    Mientras PostgreSQL no responda se sigue sirviendo lo que haya en el almacén (que
+    persiste en disco entre reinicios) y se reintenta cada RETRY_INTERVAL_SECONDS; al
+    volver, el ciclo siguiente reconcilia las 168 franjas. Una caída de Redis no cuenta
+    como franja fallida: el almacén queda al día y las franjas que no se pudieron
+    escribir en Redis se reenvían desde él al reconectar (resync_redis_from_store).
     """
     global redis_client, db_pool
 
-    REFRESH_INTERVAL_SECONDS = 900 # 15 minutos
+    FOLLOWER_CHECK_SECONDS = 30
+    RETRY_INTERVAL_SECONDS = 30
+    SNAPSHOT_MAX_AGE_SECONDS = 6 * 3600  # un almacén más antiguo se recarga completo
+
+    needs_reconcile = False
 
     while True:
+        if traffic_store is not None and not traffic_store.try_acquire_leadership():
+            traffic_store.attach()
+            await asyncio.sleep(FOLLOWER_CHECK_SECONDS)
+            continue
+
+        if db_pool is None:
+            # maintain_connections crea el pool; se vuelve a mirar cada segundo
+            if not needs_reconcile:
+                logger.warning("PostgreSQL no disponible; se sirven los datos de tráfico del almacén local.")
+            needs_reconcile = True
+            await asyncio.sleep(1)
+            continue
+
         logger.info("Iniciando ciclo completo de refresco de datos de tráfico en Redis para futuras horas/días...")
+        cycle_start = time.perf_counter()
 
         hours_to_cache = 24
         days_to_cache = 2
+        # El primer ciclo, uno posterior a una caída o uno con el almacén desactualizado llena las 168 franjas
+        if traffic_store is not None:
+            updated_at = traffic_store.updated_at
+            if (needs_reconcile or traffic_store.loaded_slots() < N_SLOTS
+                    or updated_at is None or time.time() - updated_at > SNAPSHOT_MAX_AGE_SECONDS):
+                days_to_cache = 7
+        refreshed_slots = {}
+        redis_pending = set()
+        failed_slots = 0
+        redis_available = redis_client is not None
+        postgres_available = True
 
         now = datetime.now()
 
         for day_offset in range(days_to_cache):
+            if not postgres_available:
+                break
             for hour_offset in range(hours_to_cache):
                 target_datetime = now + timedelta(days=day_offset, hours=hour_offset)
 
@@ -214,72 +474,290 @@ async def refresh_traffic_data_in_redis():
                                 'length': record.get('length', 0.0),
                                 'speed_kmh': record.get('velocidad_promedio_kmh', 0.0)
                             }
-                    
-                    if pg_data and redis_client:
-                        # Eliminar la clave antigua antes de insertar nuevos datos para asegurar frescura
-                        redis_client.delete(redis_key) 
-                        redis_hash_data = {
-                            f"{u}-{v}-{key}": json.dumps(data)
-                            for (u, v, key), data in pg_data.items()
-                        }
-                        redis_client.hmset(redis_key, redis_hash_data)
-
-                        expiration_seconds = 3600 + REFRESH_INTERVAL_SECONDS
-                        redis_client.expire(redis_key, expiration_seconds)
-                        logger.info(f"Datos de tráfico para {redis_key} (Día: {target_day_of_week}, Hora: {target_hour_of_day}) actualizados y establecidos para expirar en {expiration_seconds}s.")
-                    else:
-                        logger.warning(f"No se encontraron datos de tráfico en PostgreSQL para el día {target_day_of_week} hora {target_hour_of_day} o Redis no está disponible.")
-
-                except redis.exceptions.ConnectionError as e:
-                    logger.error(f"Error de conexión a Redis durante el refresco de datos: {e}")
+
+                    slot = slot_index(target_day_of_week, target_hour_of_day)
+                    if pg_data and traffic_store is not None:
+                        refreshed_slots[slot] = SlotWeights.from_edge_dict(edge_index, pg_data)
+
+                    if not pg_data:
+                        logger.warning(f"No se encontraron datos de tráfico en PostgreSQL para el día {target_day_of_week} hora {target_hour_of_day}.")
+                    elif redis_available:
+                        try:
+                            cache_slot_in_redis(redis_key, pg_data, REDIS_TRAFFIC_TTL_SECONDS)
+                            redis_resync_slots.discard(slot)
+                            logger.info(f"Datos de tráfico para {redis_key} (Día: {target_day_of_week}, Hora: {target_hour_of_day}) actualizados y establecidos para expirar en {REDIS_TRAFFIC_TTL_SECONDS}s.")
+                        except redis.exceptions.RedisError as e:
+                            # El resto del ciclo solo actualiza el almacén compartido, sin volver a PostgreSQL
+                            logger.error(f"Error de Redis durante el refresco de datos: {e}")
+                            redis_available = False
+                    if pg_data and not redis_available and redis_client is not None and traffic_store is not None:
+                        redis_pending.add(slot)
+
+                except psycopg2.OperationalError as e:
+                    logger.error(f"PostgreSQL no disponible durante el refresco de {redis_key}: {e}")
+                    postgres_available = False
+                    failed_slots += 1
                 except psycopg2.Error as e:
                     logger.error(f"Error de DB al obtener datos para refresco de Redis para {redis_key}: {e}")
+                    failed_slots += 1
                 except Exception as e:
                     logger.error(f"Error inesperado durante el refresco de Redis para {redis_key}: {e}")
+                    failed_slots += 1
                 finally:
                     if conn:
                         db_pool.putconn(conn)
-                
+
+                if not postgres_available:
+                    break
                 await asyncio.sleep(0.05) # Pequeña pausa para evitar saturar el pool de conexiones
 
-        logger.info(f"Ciclo completo de refresco de Redis terminado. Esperando {REFRESH_INTERVAL_SECONDS}s para el próximo ciclo.")
-        await asyncio.sleep(REFRESH_INTERVAL_SECONDS)
+        if refreshed_slots:
+            # Se publican todas las franjas juntas para que los workers cambien de datos a la vez
+            with traffic_store.update():
+                for slot, weights in refreshed_slots.items():
+                    traffic_store.write_slot(slot, weights)
+        # Se reenvían a Redis cuando vuelva, ya con los datos nuevos publicados en el almacén
+        redis_resync_slots.update(redis_pending)
+        metrics.REFRESH_LOOP_DURATION.observe(time.perf_counter() - cycle_start)
+
+        needs_reconcile = failed_slots > 0
+        if needs_reconcile:
+            logger.warning(f"Ciclo de refresco con {failed_slots} franjas fallidas. Reintento en {RETRY_INTERVAL_SECONDS}s.")
+            await asyncio.sleep(RETRY_INTERVAL_SECONDS)
+            continue
+        logger.info(f"Ciclo completo de refresco de Redis terminado. Esperando {TRAFFIC_REFRESH_INTERVAL_SECONDS}s para el próximo ciclo.")
+        await asyncio.sleep(TRAFFIC_REFRESH_INTERVAL_SECONDS)
+
+
+def connect_db_pool():
+    """Crea el pool de conexiones a PostgreSQL y verifica que responda."""
+    new_pool = psycopg2.pool.SimpleConnectionPool(
+        minconn=1,
+        maxconn=50, # Aumentado el tamaño del pool de conexiones
+        host=DB_HOST,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS,
+        connect_timeout=DB_CONNECT_TIMEOUT_SECONDS
+    )
+    conn = new_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+    finally:
+        new_pool.putconn(conn)
+    return new_pool
+
+
+def build_geocoding_index(conn=None) -> GeocodingIndex:
+    """Índice de calles del grafo y, si hay conexión, también de la tabla 'edges' de PostGIS."""
+    index = GeocodingIndex()
+    index.add_from_graph(G)
+    if conn is not None:
+        try:
+            index.add_from_postgis(conn)
+        except psycopg2.Error as e:
+            # La tabla 'edges' es opcional (se crea con load_map_to_db.py); el grafo basta
+            logger.warning(f"No se pudieron leer calles desde PostGIS para el geocodificador: {e}")
+            conn.rollback()
+    index.build()
+    return index
+
+
+def connect_services():
+    """
+    Intenta conectar con PostgreSQL (si aún no hay pool) y comprueba Redis. Al conectar
+    por primera vez con PostgreSQL agrega al geocodificador las calles de PostGIS.
+    """
+    global db_pool, geocoding_index
+    if db_pool is None:
+        try:
+            new_pool = connect_db_pool()
+        except psycopg2.Error as e:
+            logger.warning(f"No se pudo conectar a PostgreSQL (reintento en {RECONNECT_INTERVAL_SECONDS}s): {e}")
+        else:
+            logger.info("Conexión exitosa a PostgreSQL.")
+            conn = new_pool.getconn()
+            try:
+                geocoding_index = build_geocoding_index(conn)
+            finally:
+                new_pool.putconn(conn)
+            db_pool = new_pool
+
+    if redis_client is not None:
+        try:
+            redis_client.ping()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Redis no disponible (reintento en {RECONNECT_INTERVAL_SECONDS}s): {e}")
+            return False
+    return db_pool is not None
+
+
+def resync_redis_from_store():
+    """
+    Reenvía a Redis, desde el almacén compartido, las franjas que el refrescador no pudo
+    escribir mientras Redis estaba caído. Si Redis sigue sin responder, quedan pendientes.
+    """
+    try:
+        redis_client.ping()
+        for slot in sorted(redis_resync_slots):
+            weights = traffic_store.read_slot(slot)
+            if weights is not None:
+                edges = edge_index.edges
+                cache_slot_in_redis(f"traffic:{slot // 24}:{slot % 24}",
+                                    {edges[i]: weights.edge_attrs(i) for i in np.flatnonzero(~np.isnan(weights.travel_time)).tolist()},
+                                    REDIS_TRAFFIC_TTL_SECONDS)
+            redis_resync_slots.discard(slot)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Redis aún no disponible; {len(redis_resync_slots)} franjas pendientes de reenviar: {e}")
+        return
+    logger.info("Franjas de tráfico reenviadas a Redis desde el almacén compartido.")
+
+
+async def maintain_connections():
+    """
+    Completa el arranque en segundo plano: conecta con PostgreSQL y Redis sin retrasar
+    las primeras rutas (que se sirven desde el almacén local) y sigue reintentando
+    mientras alguno no responda. También prepara el emparejador de sondas GPS y reenvía
+    a Redis las franjas que el refrescador no pudo escribir en él.
+    """
+    global probe_ingestor
+    connected = False
+    while True:
+        if probe_ingestor is None:
+            probe_ingestor = await asyncio.to_thread(ProbeIngestor, G, edge_index)
+        was_connected = connected
+        connected = await asyncio.to_thread(connect_services)
+        if connected and not was_connected:
+            logger.info("PostgreSQL y Redis disponibles.")
+        if redis_resync_slots:
+            await asyncio.to_thread(resync_redis_from_store)
+        await asyncio.sleep(RECONNECT_INTERVAL_SECONDS)
+
+
+def flush_probe_observations():
+    if db_pool is None:
+        # Las observaciones se acumulan hasta que vuelva PostgreSQL
+        return None
+    conn = db_pool.getconn()
+    try:
+        return probe_ingestor.flush(conn, traffic_store, redis_client)
+    finally:
+        db_pool.putconn(conn)
+
+async def flush_probe_observations_periodically():
+    """Vuelca cada pocos segundos las velocidades observadas por las sondas GPS."""
+    while True:
+        await asyncio.sleep(PROBE_FLUSH_INTERVAL_SECONDS)
+        if probe_ingestor is None or not probe_ingestor.pending():
+            continue
+        try:
+            # La carga masiva y la copia del banco del almacén no deben bloquear el event loop
+            await asyncio.to_thread(flush_probe_observations)
+        except Exception as e:
+            logger.error(f"Error al volcar las sondas GPS: {e}")
+
+
+def maintain_traffic_history():
+    global edge_statics
+    if edge_statics is None:
+        edge_statics = EdgeStatics(G, edge_index)
+    conn = db_pool.getconn()
+    try:
+        return maintain_history(conn, edge_index, edge_statics, traffic_store, redis_client)
+    finally:
+        db_pool.putconn(conn)
+
+async def maintain_traffic_history_periodically():
+    """
+    Cada HISTORY_ROLLUP_INTERVAL_SECONDS, solo en el refrescador: crea las particiones del
+    historial que vienen, aplica la retención y recalcula el perfil de 168 franjas con
+    las últimas semanas de observaciones.
+    """
+    while True:
+        await asyncio.sleep(HISTORY_ROLLUP_INTERVAL_SECONDS)
+        if db_pool is None or traffic_store is None or not traffic_store.is_leader:
+            continue
+        try:
+            await asyncio.to_thread(maintain_traffic_history)
+        except Exception as e:
+            logger.error(f"Error en el mantenimiento del historial de tráfico: {e}")
+
+
+def current_travel_times(now: datetime):
+    """Franja vigente con incidentes aplicados: (versión de los datos, pesos, tiempos por arista, matriz)."""
+    slot = slot_index(now.weekday(), now.hour)
+    incidents_version = current_incidents_version()
+    slot_weights = get_slot_weights(now)
+    travel_times, matrix = get_slot_matrix(slot, slot_weights, incidents_version)
+    version = (slot, slot_weights.generation, incidents_version)
+    return version, slot_weights, travel_times, matrix
+
+def evaluate_live_routes():
+    version, slot_weights, travel_times, matrix = current_travel_times(datetime.now())
+    with stage_timer("live_routes"):
+        return live_routes.evaluate(version, travel_times, slot_weights, matrix)
+
+async def push_live_route_updates():
+    """
+    Cada LIVE_CHECK_INTERVAL_SECONDS, si hay rutas suscritas, mira si cambió la versión de
+    los datos de tráfico (un refresco o un volcado de sondas que publicó el almacén, un
+    incidente o el paso a otra franja) y envía los ETA nuevos de las rutas afectadas.
+    """
+    while True:
+        await asyncio.sleep(LIVE_CHECK_INTERVAL_SECONDS)
+        if live_routes is None or not len(live_routes):
+            continue
+        try:
+            updates = await asyncio.to_thread(evaluate_live_routes)
+        except Exception as e:
+            logger.error(f"Error al reevaluar las rutas en vivo: {e}")
+            continue
+        for connection, subscription_id, message in updates:
+            connection.push(subscription_id, message)
 
 
 @app.on_event("startup")
 async def startup_event():
-    global G, db_pool, redis_client
+    """
+    Arranque sin llamadas de red: el grafo y el almacén de tráfico en disco bastan para
+    servir rutas. PostgreSQL y Redis se conectan en segundo plano (maintain_connections)
+    y, si no están disponibles, la aplicación sigue funcionando con el último almacén.
+    """
+    global G, redis_client, geocoding_index, edge_index, traffic_store, graph_arrays, incident_overlay, live_routes
     logger.info("Iniciando la aplicación FastAPI...")
+    startup_start = time.perf_counter()
     try:
         graph_path = "calles_huaraz.graphml"
         if os.path.exists(graph_path):
-            G = ox.load_graphml(graph_path)
-            logger.info(f"Grafo de Huaraz cargado en memoria. Nodos: {len(G.nodes)}, Aristas: {len(G.edges)}")
+            G = load_graph(graph_path)
+            logger.info(f"Grafo de Huaraz cargado en memoria. Nodos: {G.n_nodes}, Aristas: {G.n_edges} ({G.nbytes() / 1e6:.1f} MB en arreglos)")
         else:
             logger.error(f"Archivo de grafo no encontrado en: {graph_path}")
             raise FileNotFoundError(f"El archivo {graph_path} no se encontró. Asegúrate de que el grafo de Huaraz esté en la raíz del proyecto.")
 
-        db_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=50, # Aumentado el tamaño del pool de conexiones
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS
-        )
-        with db_pool.getconn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT 1")
-            db_pool.putconn(conn)
-        logger.info("Conexión exitosa a PostgreSQL.")
-
-        redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
-        redis_client.ping()
-        logger.info("Conexión exitosa a Redis.")
-
-        logger.info("Aplicación FastAPI iniciada y conexiones verificadas.")
+        edge_index = EdgeIndex(G.edge_keys())
+        graph_arrays = GraphArrays(G, edge_index)
+        traffic_store = SharedTrafficStore(TRAFFIC_STORE_PATH, edge_index)
+        if traffic_store.try_acquire_leadership() or traffic_store.attach():
+            logger.info(f"Almacén de tráfico en disco: generación {traffic_store.generation}, {traffic_store.loaded_slots()} de {N_SLOTS} franjas cargadas.")
+        geocoding_index = build_geocoding_index()
+
+        # El cliente conecta recién al primer comando; los tiempos de espera cortos evitan
+        # que una caída de Redis frene las solicitudes que lo consultan
+        redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                                         socket_connect_timeout=REDIS_TIMEOUT_SECONDS, socket_timeout=REDIS_TIMEOUT_SECONDS)
+        incident_overlay = IncidentOverlay(G, edge_index, redis_client)
+        live_routes = LiveRouteRegistry(graph_arrays)
+
+        logger.info(f"Aplicación FastAPI lista para servir rutas en {(time.perf_counter() - startup_start) * 1000:.0f} ms.")
+        asyncio.create_task(maintain_connections())
         asyncio.create_task(refresh_traffic_data_in_redis())
         logger.info("Tarea de refresco de datos de tráfico en Redis iniciada en segundo plano.")
+        asyncio.create_task(metrics.monitor_event_loop_lag())
+        asyncio.create_task(flush_probe_observations_periodically())
+        asyncio.create_task(maintain_traffic_history_periodically())
+        asyncio.create_task(push_live_route_updates())
 
     except Exception as e:
         logger.error(f"Error durante el inicio de la aplicación: {e}")
@@ -294,11 +772,67 @@ async def shutdown_event():
     if redis_client:
         redis_client.close()
         logger.info("Conexión a Redis cerrada.")
+    if traffic_store:
+        traffic_store.close()
     logger.info("Aplicación FastAPI apagada.")
 
-from fastapi.responses import HTMLResponse
+from fastapi import Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 
+metrics.register_db_pool_gauges(lambda: db_pool)
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """
+    Mide la duración total de cada solicitud, deja disponible el registro de etapas
+    y, si el perfilado está activo, muestrea la pila y guarda las solicitudes lentas.
+    """
+    stage_timings = {}
+    timings_token = metrics.current_stage_timings.set(stage_timings)
+    profiling_tokens = profiling.start_request(request)
+    start = time.perf_counter()
+    status_code = 500
+    response = None
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        route = request.scope.get("route")
+        path = route.path if route is not None else "otros"
+        metrics.REQUEST_DURATION.observe(elapsed, path, status_code)
+        profile_id = profiling.finish_request(profiling_tokens, request, path, status_code, elapsed, stage_timings)
+        metrics.current_stage_timings.reset(timings_token)
+    if profile_id is not None:
+        response.headers["X-Profile-Id"] = str(profile_id)
+    return response
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Métricas del proceso en formato de texto de Prometheus."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/debug/slow_requests")
+async def debug_slow_requests(include_sampled: bool = False):
+    """
+    Solicitudes lentas recientes (y, con include_sampled=true, también las perfiladas por
+    cabecera o muestreo) con su origen/destino y el desglose de tiempo por etapa.
+    """
+    if not profiling.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Perfilado desactivado (PROFILING_ENABLED=1 para activarlo).")
+    return profiling.list_captured(only_slow=not include_sampled)
+
+@app.get("/debug/slow_requests/{record_id}/profile", response_class=PlainTextResponse)
+async def debug_request_profile(record_id: int):
+    """Perfil muestreado de una solicitud en formato folded (flamegraph.pl, speedscope)."""
+    if not profiling.PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Perfilado desactivado (PROFILING_ENABLED=1 para activarlo).")
+    folded = profiling.folded_profile(record_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail=f"No hay un perfil guardado con id {record_id}.")
+    return PlainTextResponse(folded)
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 @app.get("/", response_class=HTMLResponse)
@@ -306,18 +840,155 @@ async def read_root_html():
     with open("static/index.html", "r", encoding="utf-8") as f:
         return HTMLResponse(content=f.read())
 
-def get_route_details(graph, route_nodes):
+@app.post("/incidents")
+async def create_incident(request: IncidentRequest):
     """
-    Extrae los detalles de una ruta específica, incluyendo segmentos, congestión y distancia.
-    Se itera manualmente sobre las aristas de la ruta para obtener sus atributos.
+    Registra un incidente (reducción de velocidad o cierre) sobre aristas o un polígono,
+    vigente entre 'inicio' (por defecto, ahora) y 'fin' (por defecto, sin fin).
     """
-    route_coordinates = []
-    route_segments_data = []
-    total_congestion_sum = 0.0
-    num_segments = 0
-    total_distance_meters = 0.0
-    total_travel_time_seconds = 0.0
+    if incident_overlay is None:
+        raise HTTPException(status_code=503, detail="El registro de incidentes aún no está listo.")
+    if (request.aristas is None) == (request.poligono is None):
+        raise HTTPException(status_code=400, detail="Indica 'aristas' o 'poligono' (solo uno).")
+    if request.cierre == (request.factor_velocidad is not None):
+        raise HTTPException(status_code=400, detail="Indica 'factor_velocidad' o 'cierre' (solo uno).")
+    if request.factor_velocidad is not None and not 0 < request.factor_velocidad <= 1:
+        raise HTTPException(status_code=400, detail="'factor_velocidad' debe estar entre 0 (excluido) y 1.")
+
+    # Las horas se manejan en hora local sin zona, como el resto de la API
+    starts_at = request.inicio.astimezone().replace(tzinfo=None) if request.inicio and request.inicio.tzinfo else (request.inicio or datetime.now())
+    ends_at = request.fin.astimezone().replace(tzinfo=None) if request.fin and request.fin.tzinfo else request.fin
+    if ends_at is not None and ends_at <= starts_at:
+        raise HTTPException(status_code=400, detail="'fin' debe ser posterior a 'inicio'.")
+
+    if request.aristas is not None:
+        unknown = [edge for edge in request.aristas if edge not in edge_index.position]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Aristas inexistentes en el grafo: {unknown[:10]}")
+        positions = [edge_index.position[edge] for edge in request.aristas]
+    else:
+        try:
+            positions = incident_overlay.edges_in_polygon(request.poligono)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Polígono GeoJSON inválido: {e}")
+    if len(positions) == 0:
+        raise HTTPException(status_code=400, detail="El incidente no afecta a ninguna arista del grafo.")
+
+    incident = incident_overlay.add(positions, 0.0 if request.cierre else request.factor_velocidad, starts_at, ends_at, request.descripcion)
+    return incident.to_dict(edge_index)
+
+@app.get("/incidents")
+async def list_incidents():
+    if incident_overlay is None:
+        return []
+    return incident_overlay.list_incidents()
+
+@app.delete("/incidents/{incident_id}")
+async def delete_incident(incident_id: str):
+    """Da por terminado un incidente antes de su fin previsto."""
+    if incident_overlay is None or not incident_overlay.remove(incident_id):
+        raise HTTPException(status_code=404, detail="Incidente no encontrado.")
+    return {"mensaje": "Incidente eliminado.", "id": incident_id}
+
+@app.post("/probes")
+async def ingest_probes(batch: ProbeBatch):
+    """
+    Recibe un lote de sondas GPS. Se asocian a aristas de inmediato y sus velocidades
+    llegan al ruteo en el siguiente volcado (cada PROBE_FLUSH_INTERVAL_SECONDS).
+    """
+    if probe_ingestor is None:
+        raise HTTPException(status_code=503, detail="La ingesta de sondas aún no está lista.")
+    with stage_timer("probe_matching"):
+        summary = probe_ingestor.ingest([point.model_dump() for point in batch.points])
+    summary["pendientes"] = probe_ingestor.pending()
+    return summary
+
+async def send_live_messages(websocket: WebSocket, connection: LiveConnection):
+    while True:
+        for message in await connection.next_messages():
+            await websocket.send_json(message)
+
+def subscribe_live_route(connection: LiveConnection, nodes):
+    _, slot_weights, travel_times, _ = current_travel_times(datetime.now())
+    return live_routes.subscribe(connection, nodes, travel_times, slot_weights)
+
+@app.websocket("/ws/routes")
+async def live_route_updates(websocket: WebSocket):
+    """
+    Actualizaciones de ETA en vivo. El cliente envía
+      {"accion": "suscribir", "nodos_de_ruta": [...], "ref": ...}   (los de una ruta de /calculate_route)
+      {"accion": "cancelar", "suscripcion": "<id>"}
+    y recibe {"tipo": "suscrito", ...} con el ETA actual y, cada vez que cambian los datos de
+    tráfico o los incidentes de sus aristas, {"tipo": "actualizacion", ...} con el ETA nuevo,
+    los tramos que cambiaron y, si la hay, una ruta bastante más rápida ('ruta_sugerida').
+    """
+    await websocket.accept()
+    connection = LiveConnection()
+    sender = asyncio.create_task(send_live_messages(websocket, connection))
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except ValueError:
+                connection.reply({"tipo": "error", "detalle": "Mensaje JSON inválido."})
+                continue
+            action = message.get("accion") if isinstance(message, dict) else None
+            if action == "suscribir":
+                nodes = message.get("nodos_de_ruta")
+                # 'ref' (opcional) vuelve en la respuesta para que el cliente la asocie a su ruta
+                ref = message.get("ref")
+                if live_routes is None:
+                    connection.reply({"tipo": "error", "ref": ref, "detalle": "Las rutas en vivo aún no están listas."})
+                elif not isinstance(nodes, list) or len(nodes) > MAX_ROUTE_NODES \
+                        or not all(isinstance(n, int) and not isinstance(n, bool) for n in nodes):
+                    connection.reply({"tipo": "error", "ref": ref,
+                                      "detalle": f"'nodos_de_ruta' debe ser una lista de hasta {MAX_ROUTE_NODES} osmids."})
+                else:
+                    try:
+                        reply = await asyncio.to_thread(subscribe_live_route, connection, nodes)
+                        connection.reply({**reply, "ref": ref})
+                    except ValueError as e:
+                        connection.reply({"tipo": "error", "ref": ref, "detalle": str(e)})
+                    except HTTPException as e:
+                        # Sin datos de tráfico (modo degradado): falla esta suscripción, no la conexión
+                        connection.reply({"tipo": "error", "ref": ref, "detalle": e.detail})
+                    except Exception as e:
+                        logger.error(f"Error al suscribir una ruta en vivo: {e}")
+                        connection.reply({"tipo": "error", "ref": ref, "detalle": "No se pudo obtener el tráfico actual."})
+            elif action == "cancelar":
+                subscription_id = message.get("suscripcion")
+                # Solo se pueden cancelar las suscripciones de la misma conexión
+                if live_routes is not None and isinstance(subscription_id, str) \
+                        and subscription_id in connection.subscription_ids and live_routes.unsubscribe(subscription_id):
+                    connection.reply({"tipo": "cancelado", "suscripcion": subscription_id})
+                else:
+                    connection.reply({"tipo": "error", "detalle": "Suscripción no encontrada."})
+            else:
+                connection.reply({"tipo": "error", "detalle": "Acción desconocida; usa 'suscribir' o 'cancelar'."})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        if live_routes is not None:
+            live_routes.drop_connection(connection)
 
+@app.get("/geocode")
+async def geocode(q: str, limit: int = 5):
+    """
+    Búsqueda de calles de Huaraz por nombre usando el índice local en memoria.
+    Tolera tildes, mayúsculas, abreviaturas (Av., Jr.) y errores de tipeo.
+    """
+    if geocoding_index is None:
+        raise HTTPException(status_code=503, detail="Índice de geocodificación no disponible.")
+    return geocoding_index.search(q, limit=max(1, min(limit, 20)))
+
+def get_route_details(route_nodes, travel_times, slot_weights: SlotWeights):
+    """
+    Extrae los detalles de una ruta específica, incluyendo segmentos, congestión y distancia.
+    Entre cada par de nodos se toma la arista más rápida (la que usó la búsqueda); sus
+    atributos se leen de los arreglos de la franja y del grafo compacto, y los segmentos
+    de la respuesta se arman solo aquí, para las rutas que se devuelven.
+    """
     def get_overall_congestion_category(overall_congestion_level):
         if overall_congestion_level < 0.3:
             return "Baja"
@@ -325,75 +996,40 @@ def get_route_details(graph, route_nodes):
             return "Media"
         else:
             return "Alta"
-        
-    if route_nodes:
-        route_coordinates.append({"lat": graph.nodes[route_nodes[0]]['y'], "lon": graph.nodes[route_nodes[0]]['x']})
-
-    for i in range(len(route_nodes) - 1):
-        u_node = route_nodes[i]
-        v_node = route_nodes[i+1]
-
-        start_lat = graph.nodes[u_node]['y']
-        start_lon = graph.nodes[u_node]['x']
-        end_lat = graph.nodes[v_node]['y']
-        end_lon = graph.nodes[v_node]['x']
-
-        # Añadir la coordenada del nodo final del segmento.
-        if i < len(route_nodes) - 2:
-            route_coordinates.append({"lat": end_lat, "lon": end_lon})
-
-        chosen_edge_data = None
-        if graph.has_edge(u_node, v_node):
-            for key_in_multigraph in graph[u_node][v_node]:
-                current_edge_attrs = graph[u_node][v_node][key_in_multigraph]
-                if 'travel_time' in current_edge_attrs:
-                    chosen_edge_data = current_edge_attrs
-                    break
 
-        if chosen_edge_data:
-            congestion_level = chosen_edge_data.get('congestion_level', 0.0)
-            edge_length = chosen_edge_data.get('length', 0.0)
-            travel_time_segment = chosen_edge_data.get('travel_time', 0.0)
-            tipo_via_osm = chosen_edge_data.get('tipo_via_osm', 'N/A')
-            categoria_congestion_segment = chosen_edge_data.get('categoria_congestion', 'Desconocida')
-            speed_kmh_segment = chosen_edge_data.get('speed_kmh', 0.0)
-
-            route_segments_data.append({
-                "start_lat": start_lat,
-                "start_lon": start_lon,
-                "end_lat": end_lat,
-                "end_lon": end_lon,
-                "congestion_level": congestion_level,
-                "tipo_via_osm": tipo_via_osm,
-                "categoria_congestion": categoria_congestion_segment,
-                "length_meters": edge_length,
-                "travel_time_seconds": travel_time_segment,
-                "speed_kmh": speed_kmh_segment
-            })
-            total_congestion_sum += congestion_level
-            num_segments += 1
-            total_distance_meters += edge_length
-            total_travel_time_seconds += travel_time_segment
-        else:
-            logger.warning(f"No se encontraron datos de tráfico para la arista ({u_node}, {v_node}) en get_route_details. Usando valores por defecto.")
-            route_segments_data.append({
-                "start_lat": start_lat,
-                "start_lon": start_lon,
-                "end_lat": end_lat,
-                "end_lon": end_lon,
-                "congestion_level": 0.0,
-                "tipo_via_osm": "Desconocido",
-                "categoria_congestion": "Desconocida",
-                "length_meters": graph[u_node][v_node][0].get('length', 0.0) if graph.has_edge(u_node, v_node) else 0.0,
-                "travel_time_seconds": 0.0,
-                "speed_kmh": 0.0
-            })
-
-    if route_nodes and len(route_coordinates) < len(route_nodes):
-        last_node = route_nodes[-1]
-        route_coordinates.append({"lat": graph.nodes[last_node]['y'], "lon": graph.nodes[last_node]['x']})
-
-    overall_congestion = total_congestion_sum / num_segments if num_segments > 0 else 0.0
+    positions = graph_arrays.path_edges(route_nodes, travel_times)
+    nodes = np.array([graph_arrays.node_position[n] for n in route_nodes], dtype=np.int64)
+    lats = graph_arrays.node_lat[nodes].tolist()
+    lons = graph_arrays.node_lon[nodes].tolist()
+
+    # Las aristas sin datos de tráfico usan su velocidad por defecto y se muestran como "Baja"
+    has_data = ~np.isnan(slot_weights.travel_time[positions])
+    congestion = np.where(has_data, slot_weights.congestion_level[positions], 0.0).tolist()
+    lengths = np.where(has_data, slot_weights.length[positions], graph_arrays.length[positions]).tolist()
+    speeds = np.where(has_data, slot_weights.speed_kmh[positions], graph_arrays.default_speed_kmh[positions]).tolist()
+    segment_times = travel_times[positions].tolist()
+    categories = slot_weights.categoria_congestion[positions].tolist()
+    road_types = slot_weights.tipo_via_osm[positions].tolist()
+
+    route_segments_data = []
+    for j, position in enumerate(positions.tolist()):
+        route_segments_data.append({
+            "start_lat": lats[j],
+            "start_lon": lons[j],
+            "end_lat": lats[j + 1],
+            "end_lon": lons[j + 1],
+            "congestion_level": congestion[j],
+            # Código 0 ("N/A"): sin datos de tráfico, o sin datos pero con un incidente aplicado
+            "tipo_via_osm": TIPOS_VIA[road_types[j]] if road_types[j] != 0 else G.highway(position),
+            "categoria_congestion": CATEGORIAS[categories[j]] if has_data[j] else "Baja",
+            "length_meters": lengths[j],
+            "travel_time_seconds": segment_times[j],
+            "speed_kmh": speeds[j],
+        })
+
+    total_travel_time_seconds = float(sum(segment_times))
+    total_distance_meters = float(sum(lengths))
+    overall_congestion = float(np.mean(congestion)) if congestion else 0.0
     overall_congestion_category = get_overall_congestion_category(overall_congestion)
 
     if overall_congestion >= 0.7:
@@ -405,7 +1041,7 @@ def get_route_details(graph, route_nodes):
 
     return SingleRouteDetails(
         nodos_de_ruta=route_nodes,
-        coordenadas_de_ruta=route_coordinates,
+        coordenadas_de_ruta=[{"lat": lat, "lon": lon} for lat, lon in zip(lats, lons)],
         segmentos_de_ruta=route_segments_data,
         tiempo_total_viaje_segundos=round(total_travel_time_seconds, 2),
         tiempo_total_viaje_minutos=round(total_travel_time_seconds / 60, 2),
@@ -415,6 +1051,224 @@ def get_route_details(graph, route_nodes):
         overall_congestion_category=overall_congestion_category
     )
 
+def find_alternative_routes(travel_times, matrix, slot_weights: SlotWeights, orig_node, dest_node, num_alternative_routes=3):
+    """
+    Busca hasta 'num_alternative_routes' rutas distintas penalizando los tramos de cada
+    ruta encontrada (sobre una copia de la matriz de la franja) y repitiendo la búsqueda
+    del camino más corto por tiempo de viaje. Los detalles se arman al final, solo para
+    las rutas encontradas. Retorna los detalles de las rutas ordenados por tiempo total.
+    """
+    penalized = matrix.copy()
+    found_node_paths = []
+
+    for i in range(num_alternative_routes * 5):
+        with stage_timer("shortest_path"):
+            current_route_nodes = graph_arrays.shortest_path(penalized, orig_node, dest_node)
+        if current_route_nodes is None:
+            logger.warning(f"No se encontró más rutas alternativas entre {orig_node} y {dest_node}.")
+            break
+
+        if current_route_nodes in found_node_paths:
+            logger.info(f"Ruta duplicada encontrada (intento {i+1}), buscando otra.")
+            graph_arrays.scale_path(penalized, current_route_nodes, 100000)
+            continue
+
+        found_node_paths.append(current_route_nodes)
+        if len(found_node_paths) >= num_alternative_routes:
+            break
+        graph_arrays.scale_path(penalized, current_route_nodes, 1000)
+
+    found_routes_details = []
+    with stage_timer("route_details"):
+        for route_nodes in found_node_paths:
+            route_details = get_route_details(route_nodes, travel_times, slot_weights)
+            found_routes_details.append(route_details)
+            logger.info(f"Ruta alternativa {len(found_routes_details)} encontrada con {len(route_nodes)} nodos. Tiempo: {route_details.tiempo_total_viaje_minutos:.2f} min. Congestión: {route_details.overall_congestion:.2f}")
+
+    found_routes_details.sort(key=lambda r: r.tiempo_total_viaje_segundos)
+    return found_routes_details
+
+def build_isochrones(orig_node, travel_times, matrix, thresholds_minutes, formato):
+    """
+    Una sola búsqueda uno-a-todos acotada por el umbral mayor; cada umbral se obtiene
+    filtrando los mismos tiempos. 'poligono' devuelve la envolvente cóncava de los nodos
+    alcanzables; 'aristas', los tramos que se alcanzan a recorrer completos.
+    Retorna también las aristas de las que depende el resultado (las que salen de nodos
+    alcanzados), para invalidarlo si cambian.
+    """
+    import shapely
+    from shapely.geometry import MultiPoint, mapping
+
+    max_limit = max(thresholds_minutes) * 60
+    with stage_timer("isochrone_search"):
+        distances = graph_arrays.one_to_all(matrix, orig_node, limit=max_limit)
+
+    isochrones = []
+    with stage_timer("isochrone_geometry"):
+        for minutes in sorted(thresholds_minutes):
+            limit = minutes * 60
+            reached = np.flatnonzero(distances <= limit)
+            isochrone = Isochrone(umbral_minutos=minutes, nodos_alcanzables=len(reached))
+            if formato == "poligono":
+                if len(reached) >= 3:
+                    points = MultiPoint(np.column_stack([graph_arrays.node_lon[reached], graph_arrays.node_lat[reached]]))
+                    isochrone.poligono = mapping(shapely.concave_hull(points, ratio=0.3))
+            else:
+                edges = np.flatnonzero(graph_arrays.reachable_edges(distances, travel_times, limit))
+                src, dst = graph_arrays.edge_src[edges], graph_arrays.edge_dst[edges]
+                isochrone.aristas = [
+                    [Location(lat=graph_arrays.node_lat[a], lon=graph_arrays.node_lon[a]),
+                     Location(lat=graph_arrays.node_lat[b], lon=graph_arrays.node_lon[b])]
+                    for a, b in zip(src.tolist(), dst.tolist())
+                ]
+            isochrones.append(isochrone)
+    return isochrones, graph_arrays.edges_leaving(distances, max_limit)
+
+def plan_isochrone(request: IsochroneRequest, thresholds: list, current_time: datetime) -> str:
+    """Isócronas desde el origen con el tráfico de 'current_time' (cacheadas por franja). Retorna la respuesta serializada."""
+    profiling.register_current_thread()
+    with stage_timer("snapping"):
+        orig_node = graph_arrays.nearest_node(request.origin.lon, request.origin.lat)
+
+    slot = slot_index(current_time.weekday(), current_time.hour)
+    incidents_version = current_incidents_version()
+    try:
+        slot_weights = get_slot_weights(current_time)
+    except Exception as e:
+        logger.error(f"Error al obtener tiempos de viaje: {e}")
+        raise HTTPException(status_code=500, detail=f"Error inesperado al obtener tráfico: {e}")
+
+    cache_key = (orig_node, slot, tuple(thresholds), request.formato)
+    version = (slot_weights.generation, incidents_version)
+    body = isochrone_cache.get(cache_key, version)
+    if body is None:
+        travel_times, matrix = get_slot_matrix(slot, slot_weights, incidents_version)
+        isochrones, dependent_edges = build_isochrones(orig_node, travel_times, matrix, thresholds, request.formato)
+        with stage_timer("serialization"):
+            body = IsochroneResponse(
+                nodo_origen_osmid=orig_node,
+                dia_de_semana=current_time.weekday(),
+                hora_del_dia=current_time.hour,
+                isocronas=isochrones,
+            ).model_dump_json()
+        isochrone_cache.put(cache_key, body, version, edges=frozenset(dependent_edges.tolist()))
+    return body
+
+@app.post("/isochrone", response_model=IsochroneResponse)
+async def isochrone(request: IsochroneRequest):
+    """Zonas alcanzables desde el origen en cada umbral de tiempo con el tráfico de la hora actual."""
+    if G is None:
+        raise HTTPException(status_code=500, detail="Grafo no cargado. Error de inicialización del servidor.")
+    thresholds = sorted(set(request.umbrales_minutos))
+    # NaN no cumple ninguna comparación y pasaría los límites: se rechazan los no finitos
+    if not thresholds or len(thresholds) > 6 or not all(math.isfinite(t) for t in thresholds) \
+            or thresholds[0] <= 0 or thresholds[-1] > MAX_ISOCHRONE_MINUTES:
+        raise HTTPException(status_code=400, detail=f"Se esperan entre 1 y 6 umbrales mayores que 0 y de hasta {MAX_ISOCHRONE_MINUTES} minutos.")
+
+    # Dijkstra y envolventes cóncavas son CPU intensivos: se ejecutan fuera del event loop
+    body = await asyncio.to_thread(plan_isochrone, request, thresholds, datetime.now())
+    return Response(content=body, media_type="application/json")
+
+def plan_trip(request: TripRequest, current_time: datetime) -> str:
+    """
+    Calcula la matriz de duraciones entre la salida y las paradas (una búsqueda uno-a-todos
+    por punto, cacheada por franja), ordena las paradas con trip_optimizer y arma el
+    detalle de cada tramo con get_route_details. Retorna la respuesta serializada.
+    """
+    profiling.register_current_thread()
+    with stage_timer("snapping"):
+        lons = [request.origin.lon] + [stop.lon for stop in request.paradas]
+        lats = [request.origin.lat] + [stop.lat for stop in request.paradas]
+        nodes = [int(node) for node in graph_arrays.nearest_nodes(lons, lats)]
+
+    slot = slot_index(current_time.weekday(), current_time.hour)
+    incidents_version = current_incidents_version()
+    slot_weights = get_slot_weights(current_time)
+    travel_times, matrix = get_slot_matrix(slot, slot_weights, incidents_version)
+
+    cache_key = (tuple(nodes), slot)
+    version = (slot_weights.generation, incidents_version)
+    cached = trip_matrix_cache.get(cache_key, version)
+    if cached is None:
+        with stage_timer("duration_matrix"):
+            cached = graph_arrays.many_to_many(matrix, nodes)
+        # Depende de las aristas de los árboles de caminos mínimos (si se hacen más lentas) y de las
+        # afectadas por incidentes (si se levantan, pueden abrir caminos más cortos)
+        dependent_edges = set(graph_arrays.tree_edges(cached[1]).tolist())
+        if incident_overlay is not None:
+            dependent_edges.update(incident_overlay.active_positions.tolist())
+        trip_matrix_cache.put(cache_key, cached, version, edges=frozenset(dependent_edges))
+    durations, predecessors = cached
+
+    unreachable = [
+        i - 1 for i in range(1, len(nodes))
+        if not np.isfinite(durations[0][i]) or (request.volver_al_origen and not np.isfinite(durations[i][0]))
+    ]
+    if unreachable:
+        raise HTTPException(status_code=404, detail=f"No hay ruta entre la salida y las paradas {unreachable}.")
+
+    windows = {}
+    service = {}
+    for i, stop in enumerate(request.paradas, start=1):
+        earliest = stop.ventana_inicio_minutos * 60 if stop.ventana_inicio_minutos is not None else None
+        latest = stop.ventana_fin_minutos * 60 if stop.ventana_fin_minutos is not None else None
+        if earliest is not None or latest is not None:
+            windows[i] = (earliest, latest)
+        service[i] = stop.servicio_minutos * 60
+    problem = TripProblem(durations.tolist(), windows, service, return_to_start=request.volver_al_origen)
+    with stage_timer("trip_optimization"):
+        order = solve_visit_order(problem, request.tiempo_limite_ms / 1000)
+    _, total_seconds, lateness_seconds, arrivals = problem.evaluate(order)
+    if not math.isfinite(total_seconds):
+        raise HTTPException(status_code=404, detail="No se encontró un orden de visita con rutas entre todas las paradas.")
+
+    sequence = [0] + order + ([0] if request.volver_al_origen else [])
+    legs = []
+    with stage_timer("route_details"):
+        for a, b in zip(sequence[:-1], sequence[1:]):
+            legs.append(get_route_details(graph_arrays.path_nodes(predecessors[a], nodes[b]), travel_times, slot_weights))
+
+    visits = []
+    for stop, arrival in zip(order, arrivals):
+        latest = windows.get(stop, (None, None))[1]
+        visits.append(TripStopVisit(
+            indice_parada=stop - 1,
+            nodo_osmid=nodes[stop],
+            llegada_minutos=round(arrival / 60, 2),
+            ventana_cumplida=latest is None or arrival <= latest,
+        ))
+
+    with stage_timer("serialization"):
+        return TripResponse(
+            mensaje="Recorrido optimizado exitosamente.",
+            nodo_origen_osmid=nodes[0],
+            orden_paradas=[stop - 1 for stop in order],
+            visitas=visits,
+            tramos=legs,
+            tiempo_total_viaje_minutos=round(total_seconds / 60, 2),
+            retraso_total_minutos=round(lateness_seconds / 60, 2),
+        ).model_dump_json()
+
+@app.post("/optimize_trip", response_model=TripResponse)
+async def optimize_trip(request: TripRequest):
+    """Ordena de 1 a MAX_TRIP_STOPS paradas (con ventanas de llegada opcionales) para minimizar el tiempo total."""
+    if G is None:
+        raise HTTPException(status_code=500, detail="Grafo no cargado. Error de inicialización del servidor.")
+    if not 1 <= len(request.paradas) <= MAX_TRIP_STOPS:
+        raise HTTPException(status_code=400, detail=f"Se esperan entre 1 y {MAX_TRIP_STOPS} paradas.")
+    if not 0 < request.tiempo_limite_ms <= MAX_TRIP_TIME_LIMIT_MS:
+        raise HTTPException(status_code=400, detail=f"tiempo_limite_ms debe estar entre 1 y {MAX_TRIP_TIME_LIMIT_MS}.")
+
+    try:
+        # La búsqueda local es CPU intensiva: se ejecuta fuera del event loop
+        body = await asyncio.to_thread(plan_trip, request, datetime.now())
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error al optimizar el recorrido: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno al optimizar el recorrido: {e}")
+    return Response(content=body, media_type="application/json")
+
 @app.post("/calculate_route", response_model=MultiRouteResponse)
 async def calculate_route(request: RouteRequest):
     logger.info(f"Solicitud de ruta recibida: Origen({request.origin.lat}, {request.origin.lon}), Destino({request.destination.lat}, {request.destination.lon})")
@@ -422,101 +1276,60 @@ async def calculate_route(request: RouteRequest):
     if G is None:
         raise HTTPException(status_code=500, detail="Grafo no cargado. Error de inicialización del servidor.")
 
-    orig_node = ox.nearest_nodes(G, request.origin.lon, request.origin.lat)
-    dest_node = ox.nearest_nodes(G, request.destination.lon, request.destination.lat)
+    with stage_timer("snapping"):
+        orig_node = graph_arrays.nearest_node(request.origin.lon, request.origin.lat)
+        dest_node = graph_arrays.nearest_node(request.destination.lon, request.destination.lat)
 
-    logger.info(f"Nodos OSMnx encontrados: Origen {orig_node}, Destino {dest_node}")
+    logger.info(f"Nodos más cercanos encontrados: Origen {orig_node}, Destino {dest_node}")
+    profiling.annotate(
+        origin=request.origin.model_dump(),
+        destination=request.destination.model_dump(),
+        nodo_origen_osmid=orig_node,
+        nodo_destino_osmid=dest_node,
+    )
 
     current_time = datetime.now()
+    # Las solicitudes simultáneas con los mismos nodos en la misma franja esperan un único cálculo,
+    # que corre fuera del event loop
+    flight_key = (orig_node, dest_node, slot_index(current_time.weekday(), current_time.hour))
+    body = await route_flight.do(flight_key, lambda: asyncio.to_thread(compute_routes, orig_node, dest_node, current_time))
+    return Response(content=body, media_type="application/json")
+
+def compute_routes(orig_node, dest_node, current_time: datetime) -> str:
+    """Calcula las rutas alternativas entre dos nodos y retorna la respuesta serializada."""
+    profiling.register_current_thread()
+    incidents_version = current_incidents_version()
     try:
-        edge_data_from_db = get_edge_travel_times(current_time)
+        slot_weights = get_slot_weights(current_time)
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"Error al obtener tiempos de viaje: {e}")
         raise HTTPException(status_code=500, detail=f"Error inesperado al obtener tráfico: {e}")
 
-    DEFAULT_SPEED_MPS = 20 * 1000 / 3600 # 20 km/h en m/s
-
-    G_with_traffic_weights = copy.deepcopy(G)
-
-    for u, v, key, data in G_with_traffic_weights.edges(keys=True, data=True):
-        edge_id = (u, v, key)
-        if edge_id in edge_data_from_db:
-            for attr_name, attr_value in edge_data_from_db[edge_id].items():
-                G_with_traffic_weights[u][v][key][attr_name] = attr_value
-        else:
-            length_meters = data.get('length', 1)
-            default_speed_kmh = data.get('maxspeed', 20)
-            if isinstance(default_speed_kmh, list):
-                default_speed_kmh = float(default_speed_kmh[0]) if default_speed_kmh else 20
-            else:
-                default_speed_kmh = float(default_speed_kmh)
-
-            default_speed_mps = default_speed_kmh * 1000 / 3600
-
-            G_with_traffic_weights[u][v][key]['travel_time'] = length_meters / default_speed_mps if default_speed_mps > 0 else float('inf')
-            G_with_traffic_weights[u][v][key]['congestion_level'] = 0.0
-            G_with_traffic_weights[u][v][key]['categoria_congestion'] = "Baja"
-            G_with_traffic_weights[u][v][key]['tipo_via_osm'] = data.get('highway', 'N/A')
-            G_with_traffic_weights[u][v][key]['length'] = length_meters
-            G_with_traffic_weights[u][v][key]['speed_kmh'] = default_speed_kmh
+    with stage_timer("weights"):
+        travel_times, matrix = get_slot_matrix(slot_index(current_time.weekday(), current_time.hour), slot_weights, incidents_version)
     try:
-        if orig_node not in G_with_traffic_weights or dest_node not in G_with_traffic_weights:
+        if orig_node not in graph_arrays.node_position or dest_node not in graph_arrays.node_position:
             raise HTTPException(status_code=400, detail="Uno o ambos nodos de origen/destino no se encontraron en el grafo.")
 
-        num_alternative_routes = 3
-        found_routes_details = []
-        temp_G_for_alternatives = copy.deepcopy(G_with_traffic_weights)
-        found_node_paths = []
-
-        for i in range(num_alternative_routes * 5):
-            try:
-                current_route_nodes = nx.shortest_path(temp_G_for_alternatives, source=orig_node, target=dest_node, weight='travel_time')
-
-                if current_route_nodes in found_node_paths:
-                    logger.info(f"Ruta duplicada encontrada (intento {i+1}), buscando otra.")
-                    for u, v in zip(current_route_nodes[:-1], current_route_nodes[1:]):
-                        if temp_G_for_alternatives.has_edge(u, v):
-                            for key in list(temp_G_for_alternatives[u][v].keys()):
-                                if 'travel_time' in temp_G_for_alternatives[u][v][key]:
-                                    temp_G_for_alternatives[u][v][key]['travel_time'] *= 100000
-                    continue
-
-                route_details = get_route_details(G_with_traffic_weights, current_route_nodes)
-
-                found_routes_details.append(route_details)
-                found_node_paths.append(current_route_nodes)
-                logger.info(f"Ruta alternativa {len(found_routes_details)} encontrada con {len(current_route_nodes)} nodos. Tiempo: {route_details.tiempo_total_viaje_minutos:.2f} min. Congestión: {route_details.overall_congestion:.2f}")
-
-                if len(found_routes_details) >= num_alternative_routes:
-                    break
-
-                for u, v in zip(current_route_nodes[:-1], current_route_nodes[1:]):
-                    if temp_G_for_alternatives.has_edge(u, v):
-                        for key in list(temp_G_for_alternatives[u][v].keys()):
-                            if 'travel_time' in temp_G_for_alternatives[u][v][key]:
-                                temp_G_for_alternatives[u][v][key]['travel_time'] *= 1000
-
-            except nx.NetworkXNoPath:
-                logger.warning(f"No se encontró más rutas alternativas entre {orig_node} y {dest_node}.")
-                break
-
-        found_routes_details.sort(key=lambda r: r.tiempo_total_viaje_segundos)
+        found_routes_details = find_alternative_routes(travel_times, matrix, slot_weights, orig_node, dest_node)
 
         if not found_routes_details:
             raise HTTPException(status_code=404, detail="No se encontró ninguna ruta entre el origen y el destino especificados.")
 
-        return MultiRouteResponse(
-            mensaje="Rutas calculadas exitosamente.",
-            nodo_origen_osmid=orig_node,
-            nodo_destino_osmid=dest_node,
-            rutas_alternativas=found_routes_details
-        )
-
-    except nx.NetworkXNoPath:
-        logger.warning(f"No se encontró una ruta entre {orig_node} y {dest_node}.")
-        raise HTTPException(status_code=404, detail="No se encontró una ruta entre el origen y el destino especificados.")
+        with stage_timer("serialization"):
+            # Serializamos aquí (y no en FastAPI) para medir esta etapa y evitar una segunda validación
+            body = MultiRouteResponse(
+                mensaje="Rutas calculadas exitosamente.",
+                nodo_origen_osmid=orig_node,
+                nodo_destino_osmid=dest_node,
+                rutas_alternativas=found_routes_details
+            ).model_dump_json()
+        return body
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error al calcular la ruta: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno al calcular la ruta: {e}")
@@ -0,0 +1,528 @@
+"""
+Actualización incremental del mapa desde un extracto local de OpenStreetMap (.osm o .pbf).
+
+En vez de volver a descargar la red y recargar todo (get_map.py + load_map_to_db.py +
+populate_traffic_data.py), se arma el grafo nuevo desde el extracto con los mismos pasos
+que ox.graph_from_point, se compara con el grafo actual y solo se escriben las diferencias:
+
+- cada arista tiene un 'edge_id' estable: las que no cambian (aunque cambie su 'key')
+  lo conservan y las nuevas reciben uno nuevo,
+- la historia de datos_trafico pasa a las aristas nuevas que cubren tramos de aristas
+  anteriores (calles partidas por una intersección nueva, unidas o redibujadas),
+- en datos_trafico y en las tablas 'edges' y 'nodes' de PostGIS solo se borran e
+  insertan las filas de lo que cambió, en una única transacción.
+
+Uso:
+    python map_update.py --extract huaraz.osm --dry-run
+    python map_update.py --extract huaraz.osm.pbf
+Después hay que reiniciar la API para que cargue el grafo nuevo.
+"""
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+from populate_traffic_data import GRAPH_PATH, bulk_upsert_traffic_data, get_congestion_category, get_db_connection
+from probe_ingestion import LocalProjection
+
+logger = logging.getLogger(__name__)
+
+# Mismo punto y radio que get_map.py
+MAP_CENTER = (-9.521471, -77.529300)
+MAP_DIST_M = 3500
+
+MATCH_BUFFER_M = 5.0         # distancia hasta la que dos trazados se consideran la misma calle
+MIN_COVERED_FRACTION = 0.5   # parte de una arista nueva que debe cubrir la historia heredada
+# Atributos que, si cambian con la geometría igual, cuentan como arista modificada
+COMPARED_ATTRIBUTES = ("osmid", "highway", "name", "maxspeed", "oneway", "lanes", "junction", "ref", "access", "bridge", "tunnel")
+COMPARED_NODE_ATTRIBUTES = ("street_count", "highway", "ref")
+
+# Filtro de osmnx para network_type='drive', aplicado sobre las etiquetas de cada vía
+_EXCLUDED_HIGHWAYS = {
+    "abandoned", "bridleway", "bus_guideway", "construction", "corridor", "cycleway", "elevator",
+    "escalator", "footway", "no", "path", "pedestrian", "planned", "platform", "proposed",
+    "raceway", "razed", "service", "steps", "track",
+}
+_EXCLUDED_SERVICES = {"alley", "driveway", "emergency_access", "parking", "parking_aisle", "private"}
+_FILTER_TAGS = ("motor_vehicle", "motorcar")
+
+
+# --- Grafo desde el extracto ---
+
+def extract_to_osm_xml(extract_path, workdir):
+    """Ruta a un .osm XML: los .pbf se convierten con la herramienta 'osmium' (osmium-tool)."""
+    if not extract_path.endswith(".pbf"):
+        return extract_path
+    if shutil.which("osmium") is None:
+        raise RuntimeError("Para leer .pbf hace falta 'osmium' (osmium-tool) en el PATH, o convierte el extracto a .osm.")
+    xml_path = os.path.join(workdir, "extracto.osm")
+    subprocess.run(["osmium", "cat", extract_path, "-o", xml_path, "--overwrite"], check=True)
+    return xml_path
+
+
+def _is_drivable(data) -> bool:
+    if data.get("area") == "yes" or data.get("access") == "private":
+        return False
+    if data.get("highway") in _EXCLUDED_HIGHWAYS or data.get("service") in _EXCLUDED_SERVICES:
+        return False
+    return all(data.get(tag) != "no" for tag in _FILTER_TAGS)
+
+
+def build_graph_from_extract(extract_path, center=MAP_CENTER, dist=MAP_DIST_M):
+    """
+    Grafo de calles para autos desde un extracto local, con los mismos pasos que
+    ox.graph_from_point(center, dist, network_type='drive'): red sin simplificar dentro
+    del área con 500 m de margen, componente principal, simplificación y recorte final.
+    """
+    import osmnx as ox
+    import networkx as nx
+
+    useful_tags = ox.settings.useful_tags_way
+    ox.settings.useful_tags_way = list(useful_tags) + [tag for tag in _FILTER_TAGS if tag not in useful_tags]
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            graph = ox.graph_from_xml(extract_to_osm_xml(extract_path, workdir), simplify=False, retain_all=True)
+    finally:
+        ox.settings.useful_tags_way = useful_tags
+
+    not_drivable = [(u, v, k) for u, v, k, data in graph.edges(keys=True, data=True) if not _is_drivable(data)]
+    graph.remove_edges_from(not_drivable)
+    graph.remove_nodes_from([node for node in list(graph.nodes) if graph.degree(node) == 0])
+    for _, _, data in graph.edges(data=True):
+        for tag in _FILTER_TAGS:
+            data.pop(tag, None)
+
+    polygon = ox.utils_geo.bbox_to_poly(ox.utils_geo.bbox_from_point(center, dist))
+    polygon_proj, crs_utm = ox.projection.project_geometry(polygon)
+    polygon_buffered, _ = ox.projection.project_geometry(polygon_proj.buffer(500), crs=crs_utm, to_latlong=True)
+
+    buffered = ox.truncate.truncate_graph_polygon(graph, polygon_buffered)
+    buffered = ox.truncate.largest_component(buffered, strongly=False)
+    buffered = ox.simplify_graph(buffered)
+    graph = ox.truncate.truncate_graph_polygon(buffered, polygon)
+    graph = ox.truncate.largest_component(graph, strongly=False)
+    nx.set_node_attributes(graph, values=ox.stats.count_streets_per_node(buffered, nodes=graph.nodes), name="street_count")
+    logger.info(f"Grafo desde {extract_path}: {len(graph.nodes)} nodos, {len(graph.edges)} aristas.")
+    return graph
+
+
+# --- Comparación de grafos ---
+
+def edge_line(graph, u, v, data):
+    """Geometría (lon, lat) de una arista; las rectas no tienen 'geometry' en el grafo."""
+    from shapely.geometry import LineString
+
+    geometry = data.get("geometry")
+    if geometry is None:
+        geometry = LineString([(graph.nodes[u]["x"], graph.nodes[u]["y"]), (graph.nodes[v]["x"], graph.nodes[v]["y"])])
+    return geometry
+
+
+def _normalized(value):
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(str(item) for item in value))
+    return None if value is None else str(value)
+
+
+def _attribute_signature(data, names):
+    return tuple(_normalized(data.get(name)) for name in names)
+
+
+def _geometry_signature(line):
+    # 6 decimales ≈ 0.1 m: el mismo trazado da la misma firma aunque se haya vuelto a calcular
+    return tuple((round(x, 6), round(y, 6)) for x, y in line.coords)
+
+
+class MapDiff:
+    """
+    Correspondencia entre las aristas del grafo nuevo y las del anterior (tuplas u, v, key):
+    - same: misma geometría y atributos (la key puede haber cambiado),
+    - modified: misma geometría, atributos distintos,
+    - remapped: arista nueva que cubre tramos de una o más aristas anteriores,
+      con los metros de cada una que cubre,
+    - added: aristas nuevas sin historia; removed: anteriores que no heredó nadie.
+    """
+
+    def __init__(self):
+        self.same = {}
+        self.modified = {}
+        self.remapped = {}
+        self.added = []
+        self.removed = []
+        self.added_nodes = []
+        self.removed_nodes = []
+        self.modified_nodes = []
+
+    def sources(self, new_edge, new_length):
+        """Aristas anteriores de las que hereda 'new_edge', con los metros que cubre de cada una."""
+        if new_edge in self.same:
+            return [(self.same[new_edge], new_length)]
+        if new_edge in self.modified:
+            return [(self.modified[new_edge], new_length)]
+        return self.remapped.get(new_edge, [])
+
+    def unchanged_rows(self):
+        """Aristas cuyas filas en la base de datos siguen siendo válidas tal cual."""
+        return {new for new, old in self.same.items() if new == old}
+
+    def summary(self) -> dict:
+        rekeyed = sum(1 for new, old in self.same.items() if new != old)
+        return {
+            "sin_cambios": len(self.same) - rekeyed,
+            "cambio_de_key": rekeyed,
+            "modificadas": len(self.modified),
+            "reasignadas": len(self.remapped),
+            "nuevas": len(self.added),
+            "eliminadas": len(self.removed),
+            "nodos_nuevos": len(self.added_nodes),
+            "nodos_eliminados": len(self.removed_nodes),
+            "nodos_modificados": len(self.modified_nodes),
+        }
+
+
+def diff_graphs(old_graph, new_graph) -> MapDiff:
+    """
+    Compara dos grafos de calles. Primero se emparejan las aristas con el mismo trazado
+    (mismos extremos y geometría); luego, las que quedan sin pareja se comparan por
+    superposición: una arista nueva hereda de las anteriores cuyo trazado (con
+    MATCH_BUFFER_M de tolerancia y en el mismo sentido) cubre al menos
+    MIN_COVERED_FRACTION de su longitud.
+    """
+    import shapely
+    from shapely.geometry import LineString, Point
+
+    diff = MapDiff()
+
+    old_by_geometry = defaultdict(list)
+    old_lines = {}
+    for u, v, k, data in old_graph.edges(keys=True, data=True):
+        line = edge_line(old_graph, u, v, data)
+        old_lines[(u, v, k)] = line
+        old_by_geometry[(u, v, _geometry_signature(line))].append((u, v, k))
+
+    unmatched_new = {}
+    for u, v, k, data in new_graph.edges(keys=True, data=True):
+        line = edge_line(new_graph, u, v, data)
+        candidates = old_by_geometry.get((u, v, _geometry_signature(line)))
+        if not candidates:
+            unmatched_new[(u, v, k)] = line
+            continue
+        # Entre paralelas con el mismo trazado se prefiere la misma key
+        old_edge = (u, v, k) if (u, v, k) in candidates else candidates[0]
+        candidates.remove(old_edge)
+        old_data = old_graph.edges[old_edge]
+        if _attribute_signature(old_data, COMPARED_ATTRIBUTES) == _attribute_signature(data, COMPARED_ATTRIBUTES):
+            diff.same[(u, v, k)] = old_edge
+        else:
+            diff.modified[(u, v, k)] = old_edge
+
+    inherited = set(diff.same.values()) | set(diff.modified.values())
+    unmatched_old = [edge for edge in old_lines if edge not in inherited]
+
+    if unmatched_new and unmatched_old:
+        lat0, lon0 = MAP_CENTER
+        projection = LocalProjection(lat0, lon0)
+
+        def projected(line):
+            lon, lat = np.asarray(line.coords).T
+            return LineString(np.column_stack(projection.to_xy(lat, lon)))
+
+        old_projected = [projected(old_lines[edge]) for edge in unmatched_old]
+        tree = shapely.STRtree(old_projected)
+        for new_edge, line in unmatched_new.items():
+            new_line = projected(line)
+            sources = []
+            for i in tree.query(new_line.buffer(MATCH_BUFFER_M)).tolist():
+                old_line = old_projected[i]
+                part = new_line.intersection(old_line.buffer(MATCH_BUFFER_M))
+                # Descarta los cruces: una calle transversal solo toca unos metros alrededor de la esquina
+                if part.length <= 2 * MATCH_BUFFER_M:
+                    continue
+                # Mismo sentido de circulación: recorrer la parte común avanza otro tanto por la arista anterior
+                coords = shapely.get_coordinates(part)
+                advance = old_line.project(Point(coords[-1])) - old_line.project(Point(coords[0]))
+                if advance >= 0.5 * part.length:
+                    sources.append((unmatched_old[i], min(part.length, old_line.length)))
+            if sum(overlap for _, overlap in sources) >= MIN_COVERED_FRACTION * new_line.length > 0:
+                diff.remapped[new_edge] = sources
+            else:
+                diff.added.append(new_edge)
+        inherited.update(old for sources in diff.remapped.values() for old, _ in sources)
+    else:
+        diff.added.extend(unmatched_new)
+
+    diff.removed = [edge for edge in old_lines if edge not in inherited]
+
+    old_nodes, new_nodes = set(old_graph.nodes), set(new_graph.nodes)
+    diff.added_nodes = sorted(new_nodes - old_nodes)
+    diff.removed_nodes = sorted(old_nodes - new_nodes)
+    diff.modified_nodes = sorted(
+        node for node in new_nodes & old_nodes
+        if (round(old_graph.nodes[node]["x"], 7), round(old_graph.nodes[node]["y"], 7)) != (round(new_graph.nodes[node]["x"], 7), round(new_graph.nodes[node]["y"], 7))
+        or _attribute_signature(old_graph.nodes[node], COMPARED_NODE_ATTRIBUTES) != _attribute_signature(new_graph.nodes[node], COMPARED_NODE_ATTRIBUTES)
+    )
+    return diff
+
+
+def ensure_edge_ids(graph):
+    """Numera las aristas en orden (u, v, key) si el grafo aún no tiene 'edge_id' (GraphML anteriores a este script)."""
+    edges = sorted(graph.edges(keys=True))
+    if any(graph.edges[edge].get("edge_id") is None for edge in edges):
+        for i, edge in enumerate(edges, start=1):
+            graph.edges[edge]["edge_id"] = i
+
+
+def assign_edge_ids(old_graph, new_graph, diff):
+    """
+    Atributo 'edge_id' estable en ambos grafos (ver ensure_edge_ids para el grafo anterior).
+    Las aristas sin cambios o modificadas conservan el ID de su pareja; las reasignadas y
+    nuevas reciben IDs nuevos.
+    """
+    ensure_edge_ids(old_graph)
+    old_edges = old_graph.edges(keys=True)
+    next_id = max((int(old_graph.edges[edge]["edge_id"]) for edge in old_edges), default=0) + 1
+
+    for edge in sorted(new_graph.edges(keys=True)):
+        old_edge = diff.same.get(edge) or diff.modified.get(edge)
+        if old_edge is not None:
+            new_graph.edges[edge]["edge_id"] = int(old_graph.edges[old_edge]["edge_id"])
+        else:
+            new_graph.edges[edge]["edge_id"] = next_id
+            next_id += 1
+
+
+# --- Historia de tráfico ---
+
+def _stage_keys(cur, table, keys):
+    """Carga tuplas (u, v, key) en una tabla temporal para cruzarlas con otras tablas."""
+    cur.execute(f"CREATE TEMP TABLE {table} (u BIGINT, v BIGINT, edge_key BIGINT) ON COMMIT DROP;")
+    execute_values(cur, f"INSERT INTO {table} (u, v, edge_key) VALUES %s", list(keys), page_size=5000)
+
+
+def remap_traffic_rows(old_rows, new_graph, diff):
+    """
+    Filas de datos_trafico (en el orden de TRAFFIC_COLUMNS) para las aristas nuevas que heredan
+    historia. 'old_rows' es {(u, v, key) anterior: {(día, hora): (velocidad, congestión)}}.
+    La velocidad heredada es la media armónica ponderada por los metros cubiertos (el tiempo
+    de recorrer cada tramo se suma) y el tiempo de viaje se recalcula con la longitud nueva.
+    """
+    rows = []
+    unchanged = diff.unchanged_rows()
+    for new_edge in new_graph.edges(keys=True):
+        if new_edge in unchanged:
+            continue
+        data = new_graph.edges[new_edge]
+        length = float(data.get("length", 0.0))
+        sources = diff.sources(new_edge, length)
+        if not sources or length <= 0:
+            continue
+        highway = data.get("highway", "N/A")
+        tipo_via = highway[0] if isinstance(highway, list) else highway
+
+        by_slot = defaultdict(list)
+        for old_edge, overlap in sources:
+            for slot, (speed, congestion) in old_rows.get(old_edge, {}).items():
+                if speed and speed > 0:
+                    by_slot[slot].append((overlap, speed, congestion or 0.0))
+
+        for (day, hour), parts in by_slot.items():
+            covered = sum(overlap for overlap, _, _ in parts)
+            if covered < MIN_COVERED_FRACTION * length:
+                continue
+            seconds = sum(overlap / (speed / 3.6) for overlap, speed, _ in parts)
+            speed_kmh = covered / seconds * 3.6
+            congestion = sum(overlap * c for overlap, _, c in parts) / covered
+            u, v, key = new_edge
+            rows.append((
+                u, v, key, day, hour,
+                speed_kmh, congestion, length / (speed_kmh / 3.6),
+                get_congestion_category(congestion), tipo_via, length,
+            ))
+    return rows
+
+
+def apply_traffic_changes(cur, old_graph, new_graph, diff):
+    """
+    Borra de datos_trafico las filas de aristas que ya no valen tal cual y escribe las
+    heredadas. Usa el cursor de la transacción de apply_map_update (no hace commit).
+    """
+    unchanged = diff.unchanged_rows()
+    stale_keys = [edge for edge in old_graph.edges(keys=True) if edge not in unchanged]
+    source_keys = {old for new in new_graph.edges(keys=True) if new not in unchanged
+                   for old, _ in diff.sources(new, 0.0)}
+
+    old_rows = defaultdict(dict)
+    if source_keys:
+        _stage_keys(cur, "map_update_sources", source_keys)
+        cur.execute("""
+            SELECT d.u, d.v, d.edge_key, d.dia_de_semana, d.hora_del_dia, d.velocidad_promedio_kmh, d.nivel_congestion
+            FROM datos_trafico d JOIN map_update_sources s USING (u, v, edge_key);
+        """)
+        for u, v, key, day, hour, speed, congestion in cur:
+            old_rows[(u, v, key)][(day, hour)] = (speed, congestion)
+
+    deleted = 0
+    if stale_keys:
+        _stage_keys(cur, "map_update_stale", stale_keys)
+        cur.execute("DELETE FROM datos_trafico d USING map_update_stale s WHERE (d.u, d.v, d.edge_key) = (s.u, s.v, s.edge_key);")
+        deleted = cur.rowcount
+
+    rows = remap_traffic_rows(old_rows, new_graph, diff)
+    written = bulk_upsert_traffic_data(cur.connection, rows, commit=False)
+    logger.info(f"datos_trafico: {deleted} filas borradas, {written} filas heredadas por aristas nuevas o cambiadas.")
+    return deleted, written
+
+
+# --- PostGIS ---
+
+def _table_columns(cur, table):
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position;
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def _postgis_value(value):
+    if isinstance(value, (list, tuple, set)):
+        return str(list(value))
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        return value.item()
+    return value
+
+
+def _insert_features(cur, table, columns, features):
+    """
+    Inserta filas de 'nodes' o 'edges' con las columnas que ya tiene la tabla (las que
+    creó load_map_to_db.py; ':' en los nombres de atributo pasa a '_'). La geometría va
+    como EWKB en hexadecimal.
+    """
+    import shapely
+
+    if not features:
+        return 0
+    values = []
+    for attributes, geometry in features:
+        attributes = {name.replace(":", "_"): value for name, value in attributes.items()}
+        attributes["geometry"] = shapely.to_wkb(shapely.set_srid(geometry, 4326), hex=True, include_srid=True)
+        values.append(tuple(_postgis_value(attributes.get(column)) for column in columns))
+    column_list = ", ".join(f'"{column}"' for column in columns)
+    execute_values(cur, f'INSERT INTO "{table}" ({column_list}) VALUES %s', values, page_size=1000)
+    return len(values)
+
+
+def apply_postgis_changes(cur, old_graph, new_graph, diff):
+    """
+    Aplica las diferencias a las tablas 'edges' y 'nodes' de load_map_to_db.py (si existen),
+    incluida la columna 'edge_id'. Usa el cursor de la transacción de apply_map_update.
+    """
+    from shapely.geometry import Point
+
+    cur.execute("SELECT to_regclass('edges') IS NOT NULL, to_regclass('nodes') IS NOT NULL;")
+    has_edges, has_nodes = cur.fetchone()
+
+    if has_edges:
+        columns = _table_columns(cur, "edges")
+        unchanged = diff.unchanged_rows()
+        if "edge_id" not in columns:
+            cur.execute("ALTER TABLE edges ADD COLUMN edge_id BIGINT;")
+            columns.append("edge_id")
+            cur.execute("CREATE TEMP TABLE map_update_edge_ids (u BIGINT, v BIGINT, edge_key BIGINT, edge_id BIGINT) ON COMMIT DROP;")
+            execute_values(cur, "INSERT INTO map_update_edge_ids VALUES %s",
+                           [(u, v, k, new_graph.edges[(u, v, k)]["edge_id"]) for u, v, k in unchanged], page_size=5000)
+            cur.execute("""
+                UPDATE edges e SET edge_id = i.edge_id FROM map_update_edge_ids i
+                WHERE (e.u, e.v, e.key) = (i.u, i.v, i.edge_key);
+            """)
+
+        stale = [edge for edge in old_graph.edges(keys=True) if edge not in unchanged]
+        if stale:
+            _stage_keys(cur, "map_update_stale_edges", stale)
+            cur.execute("DELETE FROM edges e USING map_update_stale_edges s WHERE (e.u, e.v, e.key) = (s.u, s.v, s.edge_key);")
+        features = []
+        for u, v, k, data in new_graph.edges(keys=True, data=True):
+            if (u, v, k) in unchanged:
+                continue
+            attributes = {name: value for name, value in data.items() if name != "geometry"}
+            attributes.update(u=u, v=v, key=k)
+            features.append((attributes, edge_line(new_graph, u, v, data)))
+        inserted = _insert_features(cur, "edges", columns, features)
+        logger.info(f"PostGIS 'edges': {len(stale)} filas borradas, {inserted} insertadas.")
+
+    if has_nodes:
+        columns = _table_columns(cur, "nodes")
+        stale = diff.removed_nodes + diff.modified_nodes
+        if stale:
+            cur.execute("DELETE FROM nodes WHERE osmid = ANY(%s);", (stale,))
+        features = []
+        for node in diff.added_nodes + diff.modified_nodes:
+            data = new_graph.nodes[node]
+            features.append(({**data, "osmid": node}, Point(data["x"], data["y"])))
+        inserted = _insert_features(cur, "nodes", columns, features)
+        logger.info(f"PostGIS 'nodes': {len(stale)} filas borradas, {inserted} insertadas.")
+
+
+def apply_map_update(conn, old_graph, new_graph, diff):
+    """Escribe las diferencias en datos_trafico y PostGIS en una sola transacción."""
+    try:
+        with conn.cursor() as cur:
+            apply_traffic_changes(cur, old_graph, new_graph, diff)
+            apply_postgis_changes(cur, old_graph, new_graph, diff)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error al aplicar la actualización del mapa, no se cambió nada: {e}")
+        conn.rollback()
+        raise
+
+
+def invalidate_redis_slots():
+    """Borra de Redis las franjas cacheadas, que usan las claves de aristas anteriores."""
+    import redis
+
+    client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", 6379)),
+                               db=int(os.getenv("REDIS_DB", 0)), socket_connect_timeout=2)
+    try:
+        removed = client.delete(*(f"traffic:{day}:{hour}" for day in range(7) for hour in range(24)))
+        logger.info(f"Redis: {removed} franjas de tráfico invalidadas.")
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"No se pudieron invalidar las franjas en Redis (vencen solas): {e}")
+
+
+if __name__ == "__main__":
+    import osmnx as ox
+
+    parser = argparse.ArgumentParser(description="Actualiza el mapa desde un extracto local de OSM aplicando solo las diferencias.")
+    parser.add_argument("--extract", required=True, help="Extracto de OpenStreetMap (.osm o .osm.pbf).")
+    parser.add_argument("--graph", default=GRAPH_PATH, help="GraphML actual; se reemplaza por el nuevo (el anterior queda en .bak).")
+    parser.add_argument("--dry-run", action="store_true", help="Solo muestra las diferencias, sin escribir nada.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+    old_graph = ox.load_graphml(args.graph, edge_dtypes={"edge_id": int})
+    new_graph = build_graph_from_extract(args.extract)
+    diff = diff_graphs(old_graph, new_graph)
+    assign_edge_ids(old_graph, new_graph, diff)
+    for name, count in diff.summary().items():
+        print(f"{name:20} {count}")
+    if args.dry_run:
+        raise SystemExit(0)
+
+    # El grafo se escribe aparte y reemplaza al actual solo si la base de datos se actualizó
+    tmp_path = f"{args.graph}.nuevo"
+    ox.save_graphml(new_graph, tmp_path)
+    conn = get_db_connection()
+    try:
+        apply_map_update(conn, old_graph, new_graph, diff)
+    finally:
+        conn.close()
+    shutil.copy2(args.graph, f"{args.graph}.bak")
+    os.replace(tmp_path, args.graph)
+    invalidate_redis_slots()
+    print(f"Mapa actualizado en {args.graph}. Reinicia la API para usar el grafo nuevo.")
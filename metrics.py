@@ -0,0 +1,237 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Buckets (en segundos) pensados para etapas que van de microsegundos a segundos
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Tiempos por etapa de la solicitud en curso: {'snapping': 0.0012, ...}
+current_stage_timings: ContextVar = ContextVar("current_stage_timings", default=None)
+
+
+def _escape_label_value(value) -> str:
+    """Escapa una etiqueta según el formato de texto de Prometheus: \\, \" y saltos de línea."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge con valor fijado explícitamente o calculado en cada lectura mediante 'function'."""
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self._value = 0.0
+
+    def set(self, value):
+        self._value = float(value)
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return float("nan")
+        return self._value
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self.get()}"]
+
+
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label_values -> [counts por bucket..., suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [0] * len(self.buckets) + [0.0, 0]
+                self._series[label_values] = series
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                cumulative = 0
+                for upper, count in zip(self.buckets, series):
+                    cumulative += count
+                    labels = _format_labels(self.label_names, label_values, ("le", upper))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.label_names, label_values, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                labels = _format_labels(self.label_names, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-2]}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Exporta todas las métricas en el formato de texto de Prometheus."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+STAGE_DURATION = registry.register(Histogram(
+    "rutas_stage_duration_seconds",
+    "Duración de cada etapa medida con stage_timer: rutas, isocronas, viajes, lectura de tráfico, sondas y rutas en vivo.",
+    label_names=("stage",),
+))
+REQUEST_DURATION = registry.register(Histogram(
+    "rutas_request_duration_seconds",
+    "Duración total de las solicitudes HTTP por ruta y código de estado.",
+    label_names=("path", "status"),
+))
+TRAFFIC_CACHE_REQUESTS = registry.register(Counter(
+    "rutas_traffic_cache_requests_total",
+    "Lecturas de datos de tráfico por origen (shared_hit, redis_hit, redis_miss, unavailable).",
+    label_names=("result",),
+))
+TRAFFIC_CACHE_HIT_RATIO = registry.register(Gauge(
+    "rutas_traffic_cache_hit_ratio",
+    "Proporción de lecturas de tráfico resueltas sin consultar PostgreSQL (almacén compartido o Redis).",
+    function=lambda: _ratio(
+        TRAFFIC_CACHE_REQUESTS.get("shared_hit") + TRAFFIC_CACHE_REQUESTS.get("redis_hit"),
+        TRAFFIC_CACHE_REQUESTS.get("redis_miss"),
+    ),
+))
+SINGLE_FLIGHT_CALLS = registry.register(Counter(
+    "rutas_single_flight_calls_total",
+    "Llamadas agrupadas por single-flight: 'leader' ejecutó el cálculo, 'coalesced' esperó el de otra.",
+    label_names=("flight", "result"),
+))
+REFRESH_LOOP_DURATION = registry.register(Histogram(
+    "rutas_traffic_refresh_duration_seconds",
+    "Duración de un ciclo completo de refresco de tráfico en Redis.",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+))
+LIVE_ROUTE_SUBSCRIPTIONS = registry.register(Gauge(
+    "rutas_live_route_subscriptions",
+    "Rutas suscritas por WebSocket a actualizaciones de ETA en este worker.",
+))
+LIVE_ROUTE_UPDATES = registry.register(Counter(
+    "rutas_live_route_updates_total",
+    "Rutas suscritas reevaluadas tras un cambio de tráfico: 'sent' se notificó, 'unchanged' no cambió lo suficiente.",
+    label_names=("result",),
+))
+EVENT_LOOP_LAG = registry.register(Histogram(
+    "rutas_event_loop_lag_seconds",
+    "Retraso del event loop respecto al intervalo de muestreo esperado.",
+))
+EVENT_LOOP_LAG_LAST = registry.register(Gauge(
+    "rutas_event_loop_lag_last_seconds",
+    "Último retraso medido del event loop.",
+))
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+def register_db_pool_gauges(get_pool):
+    """
+    Registra gauges de uso del pool de psycopg2. 'get_pool' devuelve el pool actual
+    (puede ser None antes del startup).
+    """
+    def used():
+        pool = get_pool()
+        return len(pool._used) if pool is not None else 0
+
+    def available():
+        pool = get_pool()
+        return len(pool._pool) if pool is not None else 0
+
+    def maximum():
+        pool = get_pool()
+        return pool.maxconn if pool is not None else 0
+
+    registry.register(Gauge("rutas_db_pool_connections_in_use", "Conexiones del pool de PostgreSQL en uso.", function=used))
+    registry.register(Gauge("rutas_db_pool_connections_idle", "Conexiones abiertas y libres en el pool de PostgreSQL.", function=available))
+    registry.register(Gauge("rutas_db_pool_connections_max", "Tamaño máximo del pool de PostgreSQL.", function=maximum))
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    Mide la duración de una etapa, la registra en el histograma de etapas y la acumula
+    en los tiempos de la solicitud en curso (si hay una).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_DURATION.observe(elapsed, stage)
+        timings = current_stage_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+async def monitor_event_loop_lag(interval_seconds: float = 0.5):
+    """Tarea en segundo plano que mide cuánto se retrasa el event loop en despertar."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval_seconds)
+        lag = max(0.0, loop.time() - start - interval_seconds)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
@@ -1,6 +1,6 @@
-import osmnx as ox
 import networkx as nx
 import psycopg2
+import io
 import os
 from datetime import datetime, timedelta
 import random
@@ -46,6 +46,69 @@ def clear_existing_traffic_data(conn):
         conn.rollback()
         raise
 
+# Columnas de datos_trafico en el orden en que se escriben las filas
+TRAFFIC_COLUMNS = (
+    "u", "v", "edge_key", "dia_de_semana", "hora_del_dia",
+    "velocidad_promedio_kmh", "nivel_congestion", "tiempoviajeestimadosegundos",
+    "categoria_congestion", "tipo_via_osm", "length",
+)
+TRAFFIC_VALUE_COLUMNS = TRAFFIC_COLUMNS[5:]
+# Columnas que cambian con la velocidad (tipo_via_osm y length se conservan en las filas existentes)
+TRAFFIC_SPEED_COLUMNS = ("velocidad_promedio_kmh", "nivel_congestion", "tiempoviajeestimadosegundos", "categoria_congestion")
+
+def _copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace("\t", " ").replace("\n", " ")
+    return str(value)
+
+def bulk_upsert_traffic_data(conn, rows, update_columns=TRAFFIC_VALUE_COLUMNS, commit=True):
+    """
+    Inserta o actualiza muchas filas de datos_trafico de una sola vez: las filas (tuplas en el
+    orden de TRAFFIC_COLUMNS) se cargan con COPY en una tabla temporal y se pasan a
+    datos_trafico con un único INSERT ... ON CONFLICT. En las filas que ya existen solo se
+    actualizan 'update_columns'. Hace commit (salvo con commit=False, para incluirla en una
+    transacción más grande) y retorna la cantidad de filas escritas.
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join(map(_copy_value, row)))
+        buffer.write("\n")
+        count += 1
+    if count == 0:
+        return 0
+    buffer.seek(0)
+
+    columns = ", ".join(TRAFFIC_COLUMNS)
+    updates = ",\n                ".join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+            CREATE TEMP TABLE datos_trafico_staging (
+                u BIGINT, v BIGINT, edge_key BIGINT, dia_de_semana INTEGER, hora_del_dia INTEGER,
+                velocidad_promedio_kmh REAL, nivel_congestion REAL, tiempoviajeestimadosegundos REAL,
+                categoria_congestion VARCHAR(50), tipo_via_osm VARCHAR(50), length REAL
+            ) ON COMMIT DROP;
+            """)
+            cur.copy_expert(f"COPY datos_trafico_staging ({columns}) FROM STDIN", buffer)
+            cur.execute(f"""
+            INSERT INTO datos_trafico ({columns})
+            SELECT {columns} FROM datos_trafico_staging
+            ON CONFLICT (u, v, edge_key, dia_de_semana, hora_del_dia) DO UPDATE
+            SET {updates},
+                timestamp = CURRENT_TIMESTAMP;
+            """)
+            cur.execute("DROP TABLE datos_trafico_staging;")
+        if commit:
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error en la carga masiva de datos de tráfico: {e}")
+        conn.rollback()
+        raise
+    return count
+
 def get_congestion_category(congestion_level):
     """
     Clasifica el nivel de congestión en Baja, Media o Alta.
@@ -58,6 +121,25 @@ def get_congestion_category(congestion_level):
     else: # Esto implica congestion_level >= 0.7
         return "Alta"
 
+# Patrones de congestión por día de la semana (0 = lunes) y rango de horas (inclusive)
+CONGESTION_PATTERNS = {
+    0: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
+    1: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
+    2: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
+    3: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
+    4: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.95 },
+    5: { (0, 7): 0.2, (8, 12): 0.6, (13, 17): 0.9, (18, 23): 0.8 },
+    6: { (0, 8): 0.2, (9, 16): 0.9, (17, 23): 0.5 }
+}
+DEFAULT_CONGESTION_FACTOR = 0.3 # Si no hay patrón que coincida
+
+def congestion_pattern_factor(day_of_week, hour_of_day):
+    """Factor de congestión (0 a 1) del patrón para un día de la semana y una hora."""
+    for hour_range, factor in CONGESTION_PATTERNS.get(day_of_week, {}).items():
+        if hour_range[0] <= hour_of_day <= hour_range[1]:
+            return factor
+    return DEFAULT_CONGESTION_FACTOR
+
 def simulate_traffic_for_edge(edge_length_meters, day_of_week, hour_of_day, highway_type=None):
     """
     Simula la velocidad promedio y el nivel de congestión para una arista
@@ -130,23 +212,7 @@ def simulate_traffic_for_edge(edge_length_meters, day_of_week, hour_of_day, high
         congestion_sensitivity = 0.8 # Sensibilidad por defecto
         random_variance = (-0.05, 0.05)
 
-    # Patrones de congestión basados en el día y la hora (lógica existente)
-    congestion_patterns = {
-        0: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
-        1: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
-        2: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
-        3: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.8 },
-        4: { (0, 5): 0.1, (6, 8): 0.9, (9, 11): 0.4, (12, 14): 0.9, (15, 17): 0.7, (18, 23): 0.95 },
-        5: { (0, 7): 0.2, (8, 12): 0.6, (13, 17): 0.9, (18, 23): 0.8 },
-        6: { (0, 8): 0.2, (9, 16): 0.9, (17, 23): 0.5 }
-    }
-
-    current_congestion_factor = 0.3 # Por defecto si no hay patrón que coincida
-    for hour_range, factor in congestion_patterns.get(day_of_week, {}).items():
-        if hour_range[0] <= hour_of_day <= hour_range[1]:
-            current_congestion_factor = factor
-            break
-
+    current_congestion_factor = congestion_pattern_factor(day_of_week, hour_of_day)
     current_congestion_factor += random.uniform(random_variance[0], random_variance[1])
     current_congestion_factor = max(0.0, min(1.0, current_congestion_factor))
 
@@ -236,6 +302,8 @@ if __name__ == "__main__":
         logger.error(f"Error: El archivo de grafo '{GRAPH_PATH}' no se encontró. Por favor, asegúrate de que esté en la misma carpeta que este script.")
         exit(1)
 
+    import osmnx as ox  # solo el script; la API importa este módulo para la carga masiva
+
     try:
         logger.info(f"Cargando grafo de Huaraz desde {GRAPH_PATH}...")
         G = ox.load_graphml(GRAPH_PATH)
@@ -0,0 +1,441 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+import redis
+from scipy.spatial import cKDTree
+
+from traffic_store import CATEGORIAS, TIPOS_VIA, SlotWeights, slot_index
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración ---
+PROBE_FLUSH_INTERVAL_SECONDS = float(os.getenv("PROBE_FLUSH_INTERVAL_SECONDS", 5))
+MAX_MATCH_DISTANCE_M = float(os.getenv("PROBE_MAX_MATCH_DISTANCE_M", 30))
+SAMPLE_SPACING_M = 10.0       # separación de los puntos de muestreo a lo largo de cada arista
+MATCH_CANDIDATES = 8          # puntos candidatos por sonda en el árbol espacial
+HEADING_PENALTY_M = 30.0      # penalización (en metros) por ir en sentido contrario a la arista
+MAX_DERIVED_GAP_SECONDS = 120 # hueco máximo entre dos puntos de un vehículo para derivar velocidad/rumbo
+MAX_PROBE_SPEED_KMH = 130.0
+MAX_TRACKED_VEHICLES = 100_000  # vehículos con último punto guardado para derivar velocidad/rumbo
+# Marcas de tiempo aceptadas (segundos epoch): 2000-01-01 a 2100-01-01
+MIN_PROBE_TIMESTAMP = 946_684_800
+MAX_PROBE_TIMESTAMP = 4_102_444_800
+HISTORY_BUCKET_SECONDS = 900  # resolución del historial de observaciones (observaciones_trafico)
+# Peso del perfil histórico al mezclarlo con lo observado: con PRIOR_OBSERVATIONS sondas
+# en la ventana, la velocidad nueva queda a mitad de camino entre ambos.
+PRIOR_OBSERVATIONS = 5
+
+# Velocidad a flujo libre por tipo de vía de OSM cuando la arista no tiene 'maxspeed'
+FREE_FLOW_SPEED_KMH = {
+    "trunk": 60, "trunk_link": 50,
+    "primary": 50, "primary_link": 40,
+    "secondary": 40, "secondary_link": 35,
+    "tertiary": 35, "tertiary_link": 30,
+    "residential": 30, "unclassified": 30,
+    "living_street": 15, "service": 15,
+}
+DEFAULT_FREE_FLOW_SPEED_KMH = 30
+
+_METERS_PER_DEGREE_LAT = 110_540.0
+_METERS_PER_DEGREE_LON = 111_320.0
+
+
+def free_flow_speeds(graph) -> np.ndarray:
+    """Velocidad a flujo libre de cada arista del grafo compacto: su 'maxspeed' o la de su tipo de vía."""
+    by_class = np.array([FREE_FLOW_SPEED_KMH.get(h, DEFAULT_FREE_FLOW_SPEED_KMH) for h in graph.highway_classes], dtype=np.float32)
+    return np.where(np.isnan(graph.maxspeed_kmh), by_class[graph.highway_code], graph.maxspeed_kmh).astype(np.float32)
+
+
+class LocalProjection:
+    """Proyección equirectangular en metros alrededor de un punto; suficiente para una ciudad."""
+
+    def __init__(self, lat0, lon0):
+        self.lat0 = lat0
+        self.lon0 = lon0
+        self.cos_lat0 = math.cos(math.radians(lat0))
+
+    def to_xy(self, lat, lon):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        x = (lon - self.lon0) * _METERS_PER_DEGREE_LON * self.cos_lat0
+        y = (lat - self.lat0) * _METERS_PER_DEGREE_LAT
+        return x, y
+
+
+def _bearing_degrees(dx, dy):
+    """Rumbo (0 = norte, 90 = este) de un desplazamiento en metros."""
+    return np.degrees(np.arctan2(dx, dy)) % 360
+
+
+class EdgeMatcher:
+    """
+    Asocia puntos GPS a aristas del grafo. Cada arista se muestrea cada SAMPLE_SPACING_M
+    metros a lo largo de su geometría y los puntos van a un KD-tree; para cada sonda se
+    toman los candidatos más cercanos y se elige el de menor distancia, penalizando los
+    que van en sentido contrario al rumbo de la sonda (así se distinguen los dos sentidos
+    de una calle de doble vía).
+    """
+
+    def __init__(self, graph, edge_index):
+        self.projection = LocalProjection(float(np.mean(graph.node_lat)), float(np.mean(graph.node_lon)))
+
+        offsets, coords = graph.edge_geometry()  # (lon, lat), aristas en el orden del EdgeIndex
+        px, py = self.projection.to_xy(coords[:, 1], coords[:, 0])
+        # Tramos rectos: pares de puntos consecutivos de una misma arista
+        point_owner = np.repeat(np.arange(len(edge_index), dtype=np.int32), np.diff(offsets))
+        starts = np.flatnonzero(point_owner[:-1] == point_owner[1:])
+        owners = point_owner[starts]
+        dx, dy = px[starts + 1] - px[starts], py[starts + 1] - py[starts]
+        n = np.maximum(1, np.ceil(np.hypot(dx, dy) / SAMPLE_SPACING_M)).astype(np.int64)
+        # El último tramo de cada arista incluye además su punto final (t = 1)
+        counts = n + (starts + 2 == offsets[owners + 1])
+        segment = np.repeat(np.arange(len(starts)), counts)
+        t = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) / n[segment]
+
+        self.point_edge = owners[segment]
+        self.point_bearing = _bearing_degrees(dx, dy)[segment]
+        self.tree = cKDTree(np.column_stack([px[starts][segment] + dx[segment] * t, py[starts][segment] + dy[segment] * t]))
+        logger.info(f"Índice espacial de aristas construido con {len(self.point_edge)} puntos de muestreo.")
+
+    def match(self, lats, lons, headings=None):
+        """
+        Retorna la posición (en el EdgeIndex) de la arista de cada punto, o -1 si no hay
+        ninguna a menos de MAX_MATCH_DISTANCE_M. 'headings' admite NaN para rumbo desconocido.
+        """
+        x, y = self.projection.to_xy(lats, lons)
+        k = min(MATCH_CANDIDATES, len(self.point_edge))
+        distances, idx = self.tree.query(np.column_stack([x, y]), k=k, distance_upper_bound=MAX_MATCH_DISTANCE_M)
+        distances = distances.reshape(len(x), k)
+        idx = idx.reshape(len(x), k)
+        found = np.isfinite(distances)
+        idx = np.where(found, idx, 0)
+
+        score = distances.copy()
+        if headings is not None:
+            headings = np.asarray(headings, dtype=np.float64)[:, None]
+            diff = np.abs(self.point_bearing[idx] - headings) % 360
+            diff = np.minimum(diff, 360 - diff)
+            score = score + np.where(np.isnan(diff), 0.0, HEADING_PENALTY_M * diff / 180)
+
+        best = np.argmin(score, axis=1)
+        rows = np.arange(len(x))
+        return np.where(found[rows, best], self.point_edge[idx[rows, best]], -1)
+
+
+class WindowedSpeedStats:
+    """
+    Estadísticas en línea (cantidad, media y varianza de Welford) de las velocidades
+    observadas por (arista, franja) dentro de la ventana actual. drain() cierra la ventana.
+    """
+
+    def __init__(self):
+        self._stats = {}  # (posición de arista, franja) -> [n, media, m2]
+        self._lock = threading.Lock()
+
+    def add_many(self, positions, slots, speeds):
+        with self._lock:
+            for position, slot, speed in zip(positions.tolist(), slots.tolist(), speeds.tolist()):
+                stats = self._stats.get((position, slot))
+                if stats is None:
+                    self._stats[(position, slot)] = [1, speed, 0.0]
+                    continue
+                stats[0] += 1
+                delta = speed - stats[1]
+                stats[1] += delta / stats[0]
+                stats[2] += delta * (speed - stats[1])
+
+    def merge(self, other):
+        """Devuelve a la ventana estadísticas drenadas (por ejemplo, si su escritura falló)."""
+        with self._lock:
+            for key, (n_b, mean_b, m2_b) in other.items():
+                stats = self._stats.get(key)
+                if stats is None:
+                    self._stats[key] = [n_b, mean_b, m2_b]
+                    continue
+                n_a, mean_a, m2_a = stats
+                n = n_a + n_b
+                delta = mean_b - mean_a
+                stats[0] = n
+                stats[1] = mean_a + delta * n_b / n
+                stats[2] = m2_a + m2_b + delta * delta * n_a * n_b / n
+
+    def drain(self) -> dict:
+        with self._lock:
+            stats, self._stats = self._stats, {}
+        return stats
+
+    def __len__(self):
+        return len(self._stats)
+
+
+class ProbeIngestor:
+    """
+    Ingesta de sondas GPS: map-matching por lotes, acumulación por (arista, franja) y
+    volcado periódico a PostgreSQL y al almacén de tráfico compartido.
+    """
+
+    def __init__(self, graph, edge_index):
+        self.edge_index = edge_index
+        self.matcher = EdgeMatcher(graph, edge_index)
+        self.stats = WindowedSpeedStats()
+        # Las mismas sondas por (arista, intervalo de HISTORY_BUCKET_SECONDS), para el historial
+        self.history = WindowedSpeedStats()
+        self.free_flow_kmh = free_flow_speeds(graph)
+        self.lengths = np.nan_to_num(graph.length, nan=50.0).astype(np.float32)
+        self.highways = graph.highways()
+        # vehicle_id -> (timestamp, x, y, time.monotonic() al guardarlo), el guardado hace más tiempo primero
+        self._last_points = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ingest(self, probes) -> dict:
+        """
+        Procesa un lote de sondas {vehicle_id, lat, lon, timestamp, speed_kmh?, heading?}.
+        'timestamp' es ISO 8601 o segundos epoch. Si falta la velocidad o el rumbo se derivan
+        del punto anterior del mismo vehículo. Retorna el resumen del lote.
+        """
+        parsed = []
+        invalid = 0
+        for probe in probes:
+            try:
+                speed, heading = probe.get("speed_kmh"), probe.get("heading")
+                vehicle_id = probe.get("vehicle_id")
+                hash(vehicle_id)  # se usa como clave de _last_points
+                parsed.append((
+                    _parse_timestamp(probe["timestamp"]), float(probe["lat"]), float(probe["lon"]),
+                    None if speed is None else float(speed), None if heading is None else float(heading),
+                    vehicle_id,
+                ))
+            except (AttributeError, KeyError, OverflowError, TypeError, ValueError):
+                invalid += 1
+        # En orden temporal para derivar velocidad y rumbo entre puntos consecutivos
+        parsed.sort(key=lambda item: item[0])
+
+        timestamps, lats, lons, speeds, headings = [], [], [], [], []
+        now = time.monotonic()
+        with self._lock:
+            for ts, lat, lon, speed, heading, vehicle_id in parsed:
+                x, y = self.matcher.projection.to_xy(lat, lon)
+                if vehicle_id is not None:
+                    previous = self._last_points.get(vehicle_id)
+                    self._last_points[vehicle_id] = (ts, float(x), float(y), now)
+                    self._last_points.move_to_end(vehicle_id)
+                    if previous is not None and 0 < ts - previous[0] <= MAX_DERIVED_GAP_SECONDS:
+                        dx, dy = float(x) - previous[1], float(y) - previous[2]
+                        if speed is None:
+                            speed = math.hypot(dx, dy) / (ts - previous[0]) * 3.6
+                        if heading is None and math.hypot(dx, dy) > 1.0:
+                            heading = float(_bearing_degrees(dx, dy))
+                if speed is None or not 0 <= speed <= MAX_PROBE_SPEED_KMH:
+                    invalid += 1
+                    continue
+                timestamps.append(ts)
+                lats.append(lat)
+                lons.append(lon)
+                speeds.append(speed)
+                headings.append(float("nan") if heading is None else heading)
+            self._evict_last_points(now)
+
+        if not lats:
+            return {"received": len(probes), "matched": 0, "unmatched": 0, "invalid": invalid}
+
+        positions = self.matcher.match(lats, lons, headings)
+        matched = positions >= 0
+        slots = np.array([
+            slot_index(dt.weekday(), dt.hour) for dt in map(datetime.fromtimestamp, timestamps)
+        ], dtype=np.int32)
+        self.stats.add_many(positions[matched], slots[matched], np.asarray(speeds)[matched])
+        buckets = np.asarray(timestamps, dtype=np.float64) // HISTORY_BUCKET_SECONDS * HISTORY_BUCKET_SECONDS
+        self.history.add_many(positions[matched], buckets.astype(np.int64)[matched], np.asarray(speeds)[matched])
+        return {
+            "received": len(probes),
+            "matched": int(matched.sum()),
+            "unmatched": int((~matched).sum()),
+            "invalid": invalid,
+        }
+
+    def _evict_last_points(self, now):
+        """
+        Olvida los vehículos que no enviaron puntos en los últimos MAX_DERIVED_GAP_SECONDS
+        (ya no sirven para derivar velocidad) y, si aun así son más de MAX_TRACKED_VEHICLES,
+        los que se guardaron hace más tiempo. Se mide con el reloj del proceso y no con las
+        marcas de las sondas, que pueden llegar desordenadas entre vehículos.
+        """
+        while self._last_points:
+            saved_at = next(iter(self._last_points.values()))[3]
+            if now - saved_at <= MAX_DERIVED_GAP_SECONDS and len(self._last_points) <= MAX_TRACKED_VEHICLES:
+                break
+            self._last_points.popitem(last=False)
+
+    def pending(self) -> int:
+        return len(self.stats)
+
+    def flush(self, conn, traffic_store=None, redis_client=None) -> int:
+        """
+        Cierra la ventana actual y escribe las velocidades observadas:
+        1. mezcla la media de la ventana con el perfil vigente de la franja (si el almacén
+           compartido la tiene) en proporción a la cantidad de sondas,
+        2. las escribe en datos_trafico con una carga masiva y, en la misma transacción,
+           agrega las observaciones por intervalo al historial (observaciones_trafico),
+        3. parchea solo esas aristas en el almacén compartido, para que el ruteo las use en
+           el siguiente cálculo, y
+        4. invalida en Redis las franjas tocadas.
+        Si la escritura en PostgreSQL falla, las estadísticas vuelven a la ventana.
+        Retorna la cantidad de (arista, franja) actualizadas.
+        """
+        from populate_traffic_data import TRAFFIC_SPEED_COLUMNS, bulk_upsert_traffic_data, get_congestion_category
+        from traffic_history import observation_rows, write_observations
+
+        window = self.stats.drain()
+        history = self.history.drain()
+        if not window:
+            self.history.merge(history)
+            return 0
+
+        by_slot = {}
+        for (position, slot), (n, mean, _) in window.items():
+            by_slot.setdefault(slot, []).append((position, n, mean))
+
+        rows = []
+        patches = {}
+        for slot, observations in by_slot.items():
+            positions = np.array([o[0] for o in observations], dtype=np.int64)
+            counts = np.array([o[1] for o in observations], dtype=np.float32)
+            observed = np.array([o[2] for o in observations], dtype=np.float32)
+
+            current = traffic_store.read_slot(slot) if traffic_store is not None else None
+            if current is None:
+                current = SlotWeights.empty(len(self.edge_index))
+            previous = current.speed_kmh[positions]
+            has_previous = ~np.isnan(current.travel_time[positions]) & (previous > 0)
+            alpha = np.where(has_previous, counts / (counts + PRIOR_OBSERVATIONS), 1.0)
+            speed = np.maximum(1.0, alpha * observed + (1 - alpha) * np.where(has_previous, previous, 0.0))
+
+            lengths = np.where(has_previous, current.length[positions], self.lengths[positions])
+            congestion = np.clip(1.0 - speed / self.free_flow_kmh[positions], 0.0, 1.0)
+            travel_time = lengths / (speed * 1000 / 3600)
+            categories = [get_congestion_category(c) for c in congestion.tolist()]
+
+            day, hour = divmod(slot, 24)
+            for j, position in enumerate(positions.tolist()):
+                u, v, key = self.edge_index.edges[position]
+                tipo_via = TIPOS_VIA[current.tipo_via_osm[position]] if has_previous[j] else self.highways[position]
+                rows.append((
+                    u, v, key, day, hour,
+                    float(speed[j]), float(congestion[j]), float(travel_time[j]),
+                    categories[j], tipo_via, float(lengths[j]),
+                ))
+            patches[slot] = (positions, {
+                "speed_kmh": speed,
+                "congestion_level": congestion,
+                "travel_time": travel_time,
+                "length": lengths,
+                "categoria_congestion": np.array([CATEGORIAS.index(c) for c in categories], dtype=np.uint8),
+            })
+
+        try:
+            write_observations(conn, observation_rows(self.edge_index, history), commit=False)
+            bulk_upsert_traffic_data(conn, rows, update_columns=TRAFFIC_SPEED_COLUMNS)
+        except Exception:
+            self.stats.merge(window)
+            self.history.merge(history)
+            raise
+
+        publish_slot_patches(patches, traffic_store, redis_client)
+        logger.info(f"Sondas GPS volcadas: {len(rows)} (arista, franja) en {len(patches)} franjas.")
+        return len(rows)
+
+
+def publish_slot_patches(patches, traffic_store=None, redis_client=None):
+    """
+    Lleva al almacén compartido (solo en las franjas ya cargadas) y a Redis las aristas
+    actualizadas en datos_trafico. 'patches' es {franja: (posiciones, {campo: valores})}.
+    """
+    if traffic_store is not None and traffic_store.attached:
+        with traffic_store.update():
+            for slot, (positions, values) in patches.items():
+                if traffic_store.read_slot(slot) is not None:
+                    traffic_store.patch_edges(slot, positions, **values)
+    if redis_client is not None and patches:
+        try:
+            redis_client.delete(*(f"traffic:{slot // 24}:{slot % 24}" for slot in patches))
+        except redis.exceptions.RedisError as e:
+            # Las franjas cacheadas vencen solas; el almacén compartido ya tiene los datos nuevos
+            logger.warning(f"No se pudieron invalidar en Redis las franjas actualizadas: {e}")
+
+
+def _parse_timestamp(value) -> float:
+    """Segundos epoch de una marca ISO 8601 o numérica; ValueError si no es válida o está fuera de rango."""
+    if isinstance(value, (int, float)):
+        ts = float(value)
+    elif isinstance(value, str):
+        try:
+            ts = float(value)
+        except ValueError:
+            ts = datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    else:
+        raise ValueError(f"Marca de tiempo inválida: {value!r}")
+    # También descarta NaN e infinitos, que no se pueden convertir a fecha
+    if not MIN_PROBE_TIMESTAMP <= ts <= MAX_PROBE_TIMESTAMP:
+        raise ValueError(f"Marca de tiempo fuera de rango: {value!r}")
+    return ts
+
+
+def _consume(ingestor, stream, conn, traffic_store, batch_size):
+    batch = []
+    last_flush = time.monotonic()
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            batch.append(json.loads(line))
+        except json.JSONDecodeError:
+            logger.warning(f"Línea ignorada (JSON inválido): {line[:80]}")
+            continue
+        if len(batch) >= batch_size:
+            ingestor.ingest(batch)
+            batch = []
+        if time.monotonic() - last_flush >= PROBE_FLUSH_INTERVAL_SECONDS:
+            ingestor.flush(conn, traffic_store)
+            last_flush = time.monotonic()
+    if batch:
+        ingestor.ingest(batch)
+    ingestor.flush(conn, traffic_store)
+
+
+if __name__ == "__main__":
+    from graph_snapshot import load_graph
+    from populate_traffic_data import GRAPH_PATH, get_db_connection
+    from traffic_store import TRAFFIC_STORE_PATH, EdgeIndex, SharedTrafficStore
+
+    parser = argparse.ArgumentParser(
+        description="Consume sondas GPS en JSON Lines (una por línea) desde un archivo o stdin y actualiza datos_trafico.")
+    parser.add_argument("--input", default="-", help="Archivo JSON Lines; '-' para stdin (por defecto).")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    G = load_graph(GRAPH_PATH)
+    edge_index = EdgeIndex(G.edge_keys())
+    # Si el servidor está corriendo en esta máquina, las velocidades llegan también a sus arreglos en vivo
+    store = SharedTrafficStore(TRAFFIC_STORE_PATH, edge_index)
+    if not store.attach():
+        store = None
+    ingestor = ProbeIngestor(G, edge_index)
+    conn = get_db_connection()
+    try:
+        if args.input == "-":
+            _consume(ingestor, sys.stdin, conn, store, args.batch_size)
+        else:
+            with open(args.input, encoding="utf-8") as f:
+                _consume(ingestor, f, conn, store, args.batch_size)
+    finally:
+        conn.close()
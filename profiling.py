@@ -0,0 +1,193 @@
+import itertools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración (todo desactivado por defecto) ---
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))            # fracción de solicitudes a perfilar
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))                # intervalo de muestreo de pilas
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", 1000)) # 0 desactiva la captura de lentas
+PROFILE_HEADER = "X-Profile"
+MAX_CAPTURED_REQUESTS = int(os.getenv("PROFILE_MAX_CAPTURED", 50))
+
+# Prefijos que nunca se perfilan (estáticos y los propios endpoints de observabilidad)
+EXCLUDED_PATH_PREFIXES = ("/static", "/metrics", "/debug")
+
+# Datos de la solicitud en curso que los endpoints quieren adjuntar a su perfil (origen, destino, ...)
+current_annotations: ContextVar = ContextVar("current_annotations", default=None)
+# Sesión de perfilado de la solicitud en curso (None si no se perfila)
+current_session: ContextVar = ContextVar("current_session", default=None)
+
+_ids = itertools.count(1)
+captured_requests = deque(maxlen=MAX_CAPTURED_REQUESTS)
+
+
+class ProfileSession:
+    """Pilas muestreadas de los hilos que atienden una solicitud."""
+
+    def __init__(self, reason):
+        self.reason = reason
+        self.thread_ids = {threading.get_ident()}
+        self.stacks = Counter()
+        self.samples = 0
+
+
+class SamplingProfiler:
+    """
+    Perfilador por muestreo: un único hilo que, mientras haya sesiones activas, lee
+    periódicamente la pila de los hilos de cada sesión con sys._current_frames().
+    Las pilas se acumulan en formato "folded" (raíz;...;hoja) listo para flamegraph.pl o speedscope.
+
+    Nota: mientras una solicitud corre en el hilo del event loop, las muestras pueden incluir
+    trabajo de otras solicitudes que se intercalan en el mismo hilo.
+    """
+
+    def __init__(self, interval_seconds):
+        self.interval_seconds = interval_seconds
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start_session(self, session):
+        with self._lock:
+            self._sessions.add(session)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+
+    def stop_session(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+                sessions = list(self._sessions)
+            frames = sys._current_frames()
+            for session in sessions:
+                for thread_id in list(session.thread_ids):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        session.stacks[_fold_stack(frame)] += 1
+                session.samples += 1
+            time.sleep(self.interval_seconds)
+
+
+def _fold_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+
+def annotate(**values):
+    """Adjunta datos (origen, destino, nodos, ...) a la solicitud en curso para el registro de lentas."""
+    annotations = current_annotations.get()
+    if annotations is not None:
+        annotations.update(values)
+
+
+def register_current_thread():
+    """
+    Incluye el hilo actual en el muestreo de la solicitud en curso.
+    Se usa cuando parte del trabajo se ejecuta fuera del hilo del event loop (threadpool).
+    """
+    session = current_session.get()
+    if session is not None:
+        session.thread_ids.add(threading.get_ident())
+
+
+def start_request(request):
+    """
+    Prepara el registro de la solicitud y decide si se perfila: por cabecera X-Profile: 1,
+    por muestreo aleatorio (PROFILE_SAMPLE_RATE) o, si la captura de lentas está activa,
+    siempre (para poder conservar el perfil si termina siendo lenta).
+    Retorna los tokens de contexto que deben pasarse a finish_request.
+    """
+    annotations_token = current_annotations.set({})
+    session = None
+    if PROFILING_ENABLED and not request.url.path.startswith(EXCLUDED_PATH_PREFIXES):
+        if request.headers.get(PROFILE_HEADER) == "1":
+            session = ProfileSession("header")
+        elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            session = ProfileSession("rate")
+        elif SLOW_REQUEST_THRESHOLD_MS > 0:
+            session = ProfileSession("slow")
+    if session is not None:
+        profiler.start_session(session)
+    session_token = current_session.set(session)
+    return annotations_token, session_token
+
+
+def finish_request(tokens, request, path, status_code, elapsed_seconds, stage_timings):
+    """
+    Cierra la sesión de perfilado y guarda la solicitud si fue perfilada explícitamente
+    o si superó el umbral de lentitud. Retorna el id del registro guardado (o None).
+    """
+    annotations_token, session_token = tokens
+    session = current_session.get()
+    annotations = current_annotations.get() or {}
+    current_session.reset(session_token)
+    current_annotations.reset(annotations_token)
+
+    if session is None:
+        return None
+    profiler.stop_session(session)
+
+    elapsed_ms = elapsed_seconds * 1000
+    is_slow = SLOW_REQUEST_THRESHOLD_MS > 0 and elapsed_ms >= SLOW_REQUEST_THRESHOLD_MS
+    if session.reason == "slow" and not is_slow:
+        return None
+
+    record = {
+        "id": next(_ids),
+        "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+        "method": request.method,
+        "path": path,
+        "status": status_code,
+        "duration_ms": round(elapsed_ms, 2),
+        "slow": is_slow,
+        "reason": session.reason,
+        "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in stage_timings.items()},
+        "samples": session.samples,
+        **annotations,
+        "_stacks": session.stacks,
+    }
+    captured_requests.append(record)
+    if is_slow:
+        logger.warning(f"Solicitud lenta {request.method} {path}: {elapsed_ms:.0f} ms (perfil #{record['id']}). Etapas: {record['stages_ms']}")
+    return record["id"]
+
+
+def list_captured(only_slow=True):
+    """Registros capturados más recientes primero, sin las pilas."""
+    return [
+        {key: value for key, value in record.items() if key != "_stacks"}
+        for record in reversed(captured_requests)
+        if record["slow"] or not only_slow
+    ]
+
+
+def folded_profile(record_id):
+    """Perfil en formato folded ("pila;de;llamadas N" por línea) o None si ya no está en memoria."""
+    for record in captured_requests:
+        if record["id"] == record_id:
+            return "\n".join(f"{stack} {count}" for stack, count in record["_stacks"].most_common()) + "\n"
+    return None
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    Caché LRU en memoria para resultados de búsquedas (isócronas, matrices de duración...).
+    Cada entrada guarda la versión de los datos con que se calculó (por ejemplo, la
+    generación del almacén de tráfico): si la versión pedida no coincide, o la entrada
+    superó 'ttl_seconds', se trata como ausente.
+
+    Opcionalmente cada entrada lleva las posiciones de las aristas de las que depende su
+    resultado; invalidate_edges() descarta solo las entradas afectadas por un cambio y
+    puede pasar las demás a la versión nueva.
+    """
+
+    def __init__(self, maxsize=256, ttl_seconds=300):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # clave -> (versión, instante, valor, aristas)
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry_version, stored_at, value, _ = entry
+            if entry_version != version or time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, version=None, edges=None):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), value, edges)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_edges(self, positions, renew=None) -> int:
+        """
+        Descarta las entradas que dependen de alguna de las aristas dadas. Con 'renew'
+        (función versión -> versión), las que quedan pasan a la versión que retorna, en la
+        misma operación. Retorna cuántas se descartaron.
+        """
+        positions = set(positions)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[3] is not None and not positions.isdisjoint(entry[3])]
+            for key in stale:
+                del self._entries[key]
+            if renew is not None:
+                for key, (version, stored_at, value, edges) in list(self._entries.items()):
+                    self._entries[key] = (renew(version), stored_at, value, edges)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
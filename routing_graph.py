@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+DEFAULT_SPEED_KMH = 20  # velocidad de las aristas sin datos de tráfico ni 'maxspeed'
+EARTH_RADIUS_M = 6_371_009
+
+
+class GraphArrays:
+    """
+    Vista del grafo compacto (CompactGraph) para búsquedas con scipy.sparse.csgraph: nodos
+    numerados 0..n-1 y, por cada arista del EdgeIndex, sus nodos extremos. Con los tiempos de viaje
+    de una franja se arma una matriz dispersa (una entrada por par de nodos, la arista
+    más rápida entre ellos) sobre la que se hacen búsquedas uno-a-todos y uno-a-muchos.
+    """
+
+    def __init__(self, graph, edge_index):
+        if graph.n_edges != len(edge_index):
+            raise ValueError(f"El EdgeIndex ({len(edge_index)} aristas) no corresponde al grafo ({graph.n_edges} aristas).")
+        self.edge_index = edge_index
+        # Los arreglos del grafo compacto se comparten, no se copian
+        self.node_ids = graph.node_ids
+        self.node_position = {node: i for i, node in enumerate(self.node_ids.tolist())}
+        self.node_lat = graph.node_lat
+        self.node_lon = graph.node_lon
+        self.edge_src = graph.edge_src
+        self.edge_dst = graph.edge_dst
+
+        self.length = np.where(np.isnan(graph.length), 1.0, graph.length)
+        # Velocidad de las aristas sin datos de tráfico: su 'maxspeed' o DEFAULT_SPEED_KMH
+        self.default_speed_kmh = np.where(np.isnan(graph.maxspeed_kmh), DEFAULT_SPEED_KMH, graph.maxspeed_kmh).astype(np.float64)
+        with np.errstate(divide='ignore'):
+            self.default_travel_time = np.where(
+                self.default_speed_kmh > 0, self.length / (self.default_speed_kmh * 1000 / 3600), np.inf)
+        # Código único de cada par (origen, destino) para relacionar caminos con aristas
+        self.edge_pair = self.edge_src.astype(np.int64) * len(self.node_ids) + self.edge_dst
+
+        # Proyección equirectangular en metros alrededor del centro del grafo: a escala de
+        # una ciudad la distancia euclídea coincide con la del círculo máximo
+        self._lon_scale = np.cos(np.radians(self.node_lat.mean())) if self.n_nodes else 1.0
+        self._node_tree = cKDTree(self._project(self.node_lon, self.node_lat))
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    def _project(self, lons, lats):
+        lons = np.radians(np.asarray(lons, dtype=np.float64)) * self._lon_scale
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        return np.column_stack([np.atleast_1d(lons), np.atleast_1d(lats)]) * EARTH_RADIUS_M
+
+    def nearest_nodes(self, lons, lats) -> np.ndarray:
+        """Osmids de los nodos más cercanos a cada punto (reemplaza a ox.nearest_nodes sin importar osmnx)."""
+        _, indices = self._node_tree.query(self._project(lons, lats))
+        return self.node_ids[indices]
+
+    def nearest_node(self, lon, lat) -> int:
+        return int(self.nearest_nodes(lon, lat)[0])
+
+    def slot_travel_times(self, slot_weights) -> np.ndarray:
+        """Tiempo de viaje (s) de cada arista en la franja; las aristas sin datos usan su velocidad por defecto."""
+        travel_time = slot_weights.travel_time.astype(np.float64)
+        return np.where(np.isnan(travel_time), self.default_travel_time, travel_time)
+
+    def fastest_edges(self, travel_times) -> np.ndarray:
+        """
+        Posición de la arista más rápida de cada par (origen, destino) entre las transitables
+        (en un MultiDiGraph puede haber varias paralelas), ordenadas por par (edge_pair creciente).
+        """
+        positions = np.flatnonzero(np.isfinite(travel_times))
+        # Ordenar por (origen, destino, tiempo) y quedarse con la primera de cada par
+        order = positions[np.lexsort((travel_times[positions], self.edge_dst[positions], self.edge_src[positions]))]
+        src, dst = self.edge_src[order], self.edge_dst[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+        return order[first]
+
+    def build_matrix(self, travel_times, chosen=None):
+        """
+        Matriz dispersa de adyacencia con el menor tiempo entre cada par de nodos (las
+        aristas de fastest_edges). Las aristas intransitables (inf) se omiten.
+        """
+        if chosen is None:
+            chosen = self.fastest_edges(travel_times)
+        # Un tiempo exactamente 0 se perdería como entrada "vacía" de la matriz dispersa
+        weights = np.maximum(travel_times[chosen], 1e-6)
+        return csr_matrix((weights, (self.edge_src[chosen], self.edge_dst[chosen])), shape=(self.n_nodes, self.n_nodes))
+
+    def one_to_all(self, matrix, source_node, limit=np.inf):
+        """Tiempos (s) desde un nodo a todos los demás, sin explorar más allá de 'limit'. inf = inalcanzable."""
+        return dijkstra(matrix, directed=True, indices=self.node_position[source_node], limit=limit)
+
+    def reachable_edges(self, distances, travel_times, limit):
+        """Máscara de las aristas que se alcanzan a recorrer completas dentro de 'limit' segundos."""
+        return distances[self.edge_src] + travel_times <= limit
+
+    def edges_leaving(self, distances, limit=np.inf):
+        """Posiciones de las aristas que salen de nodos alcanzados (a 'limit' segundos o menos)."""
+        return np.flatnonzero(distances[self.edge_src] <= limit)
+
+    def tree_edges(self, predecessors):
+        """Posiciones de las aristas (incluidas las paralelas) de los árboles de caminos mínimos."""
+        predecessors = np.atleast_2d(predecessors)
+        rows, targets = np.nonzero(predecessors >= 0)
+        pairs = predecessors[rows, targets].astype(np.int64) * len(self.node_ids) + targets
+        return np.flatnonzero(np.isin(self.edge_pair, pairs))
+
+    def many_to_many(self, matrix, nodes):
+        """
+        Búsquedas uno-a-todos desde cada nodo de 'nodes': retorna la matriz de tiempos entre
+        ellos (len(nodes) × len(nodes)) y los predecesores para reconstruir los caminos.
+        """
+        indices = np.array([self.node_position[n] for n in nodes], dtype=np.int32)
+        distances, predecessors = dijkstra(matrix, directed=True, indices=indices, return_predecessors=True)
+        return distances[:, indices], predecessors
+
+    def path_edges(self, path_nodes, travel_times) -> np.ndarray:
+        """
+        Posiciones de las aristas de un camino (osmids): entre cada par de nodos consecutivos,
+        la paralela más rápida según 'travel_times'. ValueError si algún par no es una arista.
+        """
+        nodes = np.array([self.node_position[int(n)] for n in path_nodes], dtype=np.int64)
+        pairs = nodes[:-1] * len(self.node_ids) + nodes[1:]
+        candidates = np.flatnonzero(np.isin(self.edge_pair, pairs))
+        # La primera de cada par, ordenadas por (par, tiempo), es la más rápida
+        candidates = candidates[np.lexsort((travel_times[candidates], self.edge_pair[candidates]))]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = self.edge_pair[candidates[1:]] != self.edge_pair[candidates[:-1]]
+        fastest = candidates[first]
+        found = np.searchsorted(self.edge_pair[fastest], pairs)
+        valid = found < len(fastest)
+        valid[valid] = self.edge_pair[fastest[found[valid]]] == pairs[valid]
+        if not valid.all():
+            raise ValueError(f"El camino no sigue aristas del grafo (tramo {int(np.argmin(valid))}).")
+        return fastest[found]
+
+    def shortest_path(self, matrix, source_node, target_node):
+        """Camino más rápido (osmids) entre dos nodos según 'matrix'; None si no hay camino."""
+        distances, predecessors = dijkstra(matrix, directed=True, indices=self.node_position[source_node], return_predecessors=True)
+        if not np.isfinite(distances[self.node_position[target_node]]):
+            return None
+        return self.path_nodes(predecessors, target_node)
+
+    def scale_path(self, matrix, path_nodes, factor):
+        """
+        Multiplica en 'matrix' (en su lugar) el peso de cada tramo de un camino (osmids);
+        como cada entrada es la más rápida de sus paralelas, equivale a penalizarlas todas.
+        """
+        nodes = [self.node_position[int(n)] for n in path_nodes]
+        for u, v in zip(nodes[:-1], nodes[1:]):
+            start, end = matrix.indptr[u], matrix.indptr[u + 1]
+            matrix.data[start + np.flatnonzero(matrix.indices[start:end] == v)] *= factor
+
+    def path_nodes(self, predecessors_row, target_node):
+        """Camino (osmids) hasta 'target_node' a partir de la fila de predecesores de una búsqueda."""
+        current = self.node_position[target_node]
+        path = [current]
+        while predecessors_row[current] >= 0:
+            current = predecessors_row[current]
+            path.append(current)
+        return [int(self.node_ids[i]) for i in reversed(path)]
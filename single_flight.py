@@ -0,0 +1,78 @@
+import asyncio
+import threading
+
+import metrics
+
+
+class AsyncSingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave dentro del event loop: la primera
+    lanza la corrutina como tarea y todas (incluida la primera) esperan su resultado o su
+    excepción en vez de repetir el trabajo. La clave se libera al terminar la tarea, así
+    que no es una caché.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, coroutine_function):
+        task = self._calls.get(key)
+        if task is None:
+            metrics.SINGLE_FLIGHT_CALLS.inc(1, self.name, "leader")
+            task = asyncio.ensure_future(coroutine_function())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._release(key, done))
+        else:
+            metrics.SINGLE_FLIGHT_CALLS.inc(1, self.name, "coalesced")
+        # shield: si un cliente se desconecta no se cancela el cálculo de los demás
+        return await asyncio.shield(task)
+
+    def _release(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Igual que AsyncSingleFlight, para funciones síncronas llamadas desde varios hilos."""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            metrics.SINGLE_FLIGHT_CALLS.inc(1, self.name, "coalesced")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.SINGLE_FLIGHT_CALLS.inc(1, self.name, "leader")
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,98 @@
+// --- ETA EN VIVO ---
+// Una sola conexión WebSocket a /ws/routes para todas las rutas mostradas. El servidor
+// avisa cuando cambian los datos de tráfico o los incidentes de sus tramos (en vez de
+// volver a pedir /calculate_route periódicamente). Si la conexión se cae, se reconecta
+// y se vuelven a suscribir las rutas vigentes.
+const LIVE_RECONNECT_MS = 5000;
+
+const liveEta = (() => {
+    let socket = null;
+    let reconnectTimer = null;
+    let nextRef = 1;
+    // ref -> { nodes, onUpdate, subscriptionId }: rutas que se quieren seguir
+    const watched = new Map();
+
+    function send(message) {
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify(message));
+        }
+    }
+
+    function subscribe(ref) {
+        send({ accion: 'suscribir', nodos_de_ruta: watched.get(ref).nodes, ref: ref });
+    }
+
+    function handleMessage(event) {
+        const message = JSON.parse(event.data);
+        if (message.tipo === 'suscrito') {
+            const route = watched.get(message.ref);
+            if (!route) {
+                // La ruta se dejó de seguir mientras se suscribía
+                send({ accion: 'cancelar', suscripcion: message.suscripcion });
+                return;
+            }
+            route.subscriptionId = message.suscripcion;
+            route.onUpdate(message);
+        } else if (message.tipo === 'actualizacion') {
+            for (const route of watched.values()) {
+                if (route.subscriptionId === message.suscripcion) {
+                    route.onUpdate(message);
+                }
+            }
+        } else if (message.tipo === 'error') {
+            console.warn('ETA en vivo:', message.detalle);
+        }
+    }
+
+    function connect() {
+        if (socket || watched.size === 0) {
+            return;
+        }
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        socket = new WebSocket(`${protocol}//${window.location.host}/ws/routes`);
+        socket.onopen = () => {
+            watched.forEach((route, ref) => subscribe(ref));
+        };
+        socket.onmessage = handleMessage;
+        socket.onclose = () => {
+            socket = null;
+            watched.forEach(route => { route.subscriptionId = null; });
+            clearTimeout(reconnectTimer);
+            if (watched.size > 0) {
+                reconnectTimer = setTimeout(connect, LIVE_RECONNECT_MS);
+            }
+        };
+    }
+
+    /**
+     * Sigue una ruta (sus 'nodos_de_ruta'); onUpdate recibe el mensaje inicial ('suscrito')
+     * y cada 'actualizacion' con el ETA nuevo y los tramos que cambiaron.
+     */
+    function watch(nodes, onUpdate) {
+        const ref = nextRef++;
+        watched.set(ref, { nodes: nodes, onUpdate: onUpdate, subscriptionId: null });
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            subscribe(ref);
+        } else {
+            connect();
+        }
+        return ref;
+    }
+
+    /**
+     * Deja de seguir todas las rutas (por ejemplo, al calcular otras o al reiniciar).
+     */
+    function unwatchAll() {
+        watched.forEach(route => {
+            if (route.subscriptionId) {
+                send({ accion: 'cancelar', suscripcion: route.subscriptionId });
+            }
+        });
+        watched.clear();
+        clearTimeout(reconnectTimer);
+    }
+
+    return { watch: watch, unwatchAll: unwatchAll };
+})();
+
+window.liveEta = liveEta;
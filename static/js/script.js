@@ -20,14 +20,112 @@ let modalTitleElement = null;
 
 let currentRouteSegments = []; 
 
+// --- CACHÉ Y CONTROL DE SOLICITUDES ---
+// Evitamos lanzar un cálculo completo en el servidor por cada clic o tecla:
+// las solicitudes se agrupan (debounce), las que quedan obsoletas se cancelan
+// con AbortController y las respuestas recientes se reutilizan desde memoria.
+const ROUTE_DEBOUNCE_MS = 350;
+const SEARCH_DEBOUNCE_MS = 300;
+const ROUTE_CACHE_MAX_ENTRIES = 30;
+const SEARCH_CACHE_MAX_ENTRIES = 100;
+const COORD_SNAP_DECIMALS = 4; // ~11 m, menor que la distancia típica entre nodos del grafo
+
+let routeDebounceTimer = null;
+let routeAbortController = null;
+const routeResponseCache = new Map(); // clave -> respuesta de /calculate_route
+
+const searchDebounceTimers = {}; // 'origin' | 'destination' -> timer
+const searchAbortControllers = {}; // 'origin' | 'destination' -> AbortController
+const searchResultsCache = new Map(); // consulta normalizada -> resultados de geocodificación
+
 
 // --- FUNCIONES AUXILIARES ---
 
 /**
- * Función para buscar una ubicación usando Nominatim (autocompletado).
+ * Obtiene un valor de una caché LRU basada en Map (lo mueve al final como más reciente).
+ */
+function cacheGet(cache, key) {
+    if (!cache.has(key)) {
+        return undefined;
+    }
+    const value = cache.get(key);
+    cache.delete(key);
+    cache.set(key, value);
+    return value;
+}
+
+/**
+ * Guarda un valor en una caché LRU basada en Map, descartando la entrada más antigua si se excede el límite.
+ */
+function cacheSet(cache, key, value, maxEntries) {
+    if (cache.has(key)) {
+        cache.delete(key);
+    }
+    cache.set(key, value);
+    while (cache.size > maxEntries) {
+        cache.delete(cache.keys().next().value);
+    }
+}
+
+/**
+ * Construye la clave de caché de una ruta: coordenadas ajustadas a una rejilla
+ * y la hora actual (los datos de tráfico del servidor cambian por hora).
+ */
+function buildRouteCacheKey(originLat, originLon, destLat, destLon) {
+    const snap = (value) => value.toFixed(COORD_SNAP_DECIMALS);
+    const now = new Date();
+    return `${snap(originLat)},${snap(originLon)}|${snap(destLat)},${snap(destLon)}|${now.getDay()}:${now.getHours()}`;
+}
+
+/**
+ * Función para buscar una ubicación (autocompletado).
  * Llamada por onkeyup en los inputs de búsqueda y por el focus event listener.
+ * Agrupa las pulsaciones de teclas para no consultar en cada una.
+ */
+function searchLocation(type) {
+    clearTimeout(searchDebounceTimers[type]);
+    searchDebounceTimers[type] = setTimeout(() => executeSearchLocation(type), SEARCH_DEBOUNCE_MS);
+}
+
+/**
+ * Muestra los resultados de geocodificación en la lista desplegable del tipo indicado.
+ */
+function renderSearchResults(type, data) {
+    const searchInput = document.getElementById(`${type}Search`);
+    const resultsDiv = document.getElementById(`${type}SearchResults`);
+
+    resultsDiv.innerHTML = '';
+
+    data.forEach(result => {
+        const div = document.createElement('div');
+        div.textContent = result.display_name;
+        div.onclick = () => {
+            searchInput.value = result.display_name;
+            document.getElementById(`${type}Lat`).value = parseFloat(result.lat).toFixed(6);
+            document.getElementById(`${type}Lon`).value = parseFloat(result.lon).toFixed(6);
+
+            document.getElementById(`${type}CoordsDisplay`).style.display = 'block';
+
+            resultsDiv.innerHTML = '';
+            resultsDiv.style.display = 'none';
+
+            updateMarker(type, result.lat, result.lon);
+
+            if (map) {
+                map.setView([result.lat, result.lon], 16);
+            }
+        };
+        resultsDiv.appendChild(div);
+    });
+    resultsDiv.style.display = 'block';
+}
+
+/**
+ * Ejecuta la búsqueda en el geocodificador local del servidor (/geocode) y solo
+ * recurre a Nominatim si no hay coincidencias (p. ej. lugares que no son calles).
+ * Reutiliza resultados cacheados y cancela la consulta anterior del mismo campo.
  */
-async function searchLocation(type) {
+async function executeSearchLocation(type) {
     const searchInput = document.getElementById(`${type}Search`);
     const resultsDiv = document.getElementById(`${type}SearchResults`);
 
@@ -39,6 +137,13 @@ async function searchLocation(type) {
     resultsDiv.innerHTML = '';
     resultsDiv.style.display = 'none';
 
+    // Cancela la búsqueda anterior antes de cualquier retorno: si terminara después,
+    // pisaría los resultados de esta consulta (o de la caché)
+    if (searchAbortControllers[type]) {
+        searchAbortControllers[type].abort();
+        searchAbortControllers[type] = null;
+    }
+
     const queryText = searchInput.value;
 
     if (queryText.length < 3) {
@@ -49,41 +154,45 @@ async function searchLocation(type) {
         return;
     }
 
+    const cacheKey = queryText.trim().toLowerCase();
+    const cachedResults = cacheGet(searchResultsCache, cacheKey);
+    if (cachedResults) {
+        renderSearchResults(type, cachedResults);
+        return;
+    }
+
+    const controller = new AbortController();
+    searchAbortControllers[type] = controller;
+
+    const localUrl = `/geocode?q=${encodeURIComponent(queryText)}&limit=5`;
     const query = encodeURIComponent(`${queryText}, Huaraz, Peru`);
     const nominatimUrl = `https://nominatim.openstreetmap.org/search?q=${query}&format=json&limit=5`;
 
     try {
-        const response = await fetch(nominatimUrl);
-        const data = await response.json();
-
-
-        data.forEach(result => {
-            const div = document.createElement('div');
-            div.textContent = result.display_name;
-            div.onclick = () => {
-                searchInput.value = result.display_name;
-                document.getElementById(`${type}Lat`).value = parseFloat(result.lat).toFixed(6);
-                document.getElementById(`${type}Lon`).value = parseFloat(result.lon).toFixed(6);
-
-                document.getElementById(`${type}CoordsDisplay`).style.display = 'block';
-
-                resultsDiv.innerHTML = '';
-                resultsDiv.style.display = 'none';
-
-                updateMarker(type, result.lat, result.lon);
+        let data = [];
+        const localResponse = await fetch(localUrl, { signal: controller.signal });
+        if (localResponse.ok) {
+            data = await localResponse.json();
+        }
+        if (data.length === 0) {
+            const response = await fetch(nominatimUrl, { signal: controller.signal });
+            data = await response.json();
+        }
 
-                if (map) {
-                    map.setView([result.lat, result.lon], 16);
-                }
-            };
-            resultsDiv.appendChild(div);
-        });
-        resultsDiv.style.display = 'block';
+        cacheSet(searchResultsCache, cacheKey, data, SEARCH_CACHE_MAX_ENTRIES);
+        renderSearchResults(type, data);
 
     } catch (error) {
+        if (error.name === 'AbortError') {
+            return; // Una búsqueda más reciente reemplazó a esta
+        }
         console.error("Error al buscar ubicación:", error);
         resultsDiv.innerHTML = '<div>Error al buscar. Intenta de nuevo.</div>';
         resultsDiv.style.display = 'block';
+    } finally {
+        if (searchAbortControllers[type] === controller) {
+            searchAbortControllers[type] = null;
+        }
     }
 }
 
@@ -141,6 +250,12 @@ function handleMapClick(e) {
         
     }
     clickMode = null;
+
+    // Si ya hay rutas en pantalla, se recalculan al mover un marcador.
+    // El debounce agrupa ajustes seguidos en una sola solicitud.
+    if (routePolylines.length > 0 && originMarker && destinationMarker) {
+        calculateAndDisplayRoute();
+    }
 }
 
 /**
@@ -150,6 +265,9 @@ function formatTime(totalSeconds) {
     if (typeof totalSeconds !== 'number' || isNaN(totalSeconds)) {
         return '--:--:--';
     }
+    if (totalSeconds === Infinity) {
+        return 'Cerrada'; // ruta con una vía cerrada (ETA en vivo)
+    }
     const hours = Math.floor(totalSeconds / 3600);
     const minutes = Math.floor((totalSeconds % 3600) / 60);
     const seconds = Math.floor(totalSeconds % 60);
@@ -260,8 +378,25 @@ function closeModal() {
 
 /**
  * Función para calcular y mostrar múltiples rutas.
+ * Agrupa llamadas seguidas (botón, ajustes de marcadores) en una sola solicitud.
+ */
+function calculateAndDisplayRoute() {
+    clearTimeout(routeDebounceTimer);
+    routeDebounceTimer = setTimeout(requestAndDisplayRoute, ROUTE_DEBOUNCE_MS);
+}
+
+/**
+ * Solicita las rutas al servidor (o las toma de la caché) y las dibuja.
+ * Cancela la solicitud anterior si todavía está en curso.
  */
-async function calculateAndDisplayRoute() {
+async function requestAndDisplayRoute() {
+    // Cancela el cálculo anterior antes de cualquier retorno (caché incluida): si terminara
+    // después, reemplazaría en pantalla las rutas de esta consulta
+    if (routeAbortController) {
+        routeAbortController.abort();
+        routeAbortController = null;
+    }
+
     const originLat = parseFloat(document.getElementById('originLat').value);
     const originLon = parseFloat(document.getElementById('originLon').value);
     const destLat = parseFloat(document.getElementById('destinationLat').value);
@@ -286,6 +421,17 @@ async function calculateAndDisplayRoute() {
     const bounds = L.latLngBounds(originMarker.getLatLng(), destinationMarker.getLatLng());
     map.fitBounds(bounds.pad(0.5));
 
+    const cacheKey = buildRouteCacheKey(originLat, originLon, destLat, destLon);
+    const cachedData = cacheGet(routeResponseCache, cacheKey);
+    if (cachedData) {
+        console.log("Rutas obtenidas desde la caché local:", cacheKey);
+        displayRoutes(cachedData);
+        return;
+    }
+
+    const controller = new AbortController();
+    routeAbortController = controller;
+
     try {
         const response = await fetch('/calculate_route', { 
             method: 'POST',
@@ -295,7 +441,8 @@ async function calculateAndDisplayRoute() {
             body: JSON.stringify({
                 origin: { lat: originLat, lon: originLon },
                 destination: { lat: destLat, lon: destLon }
-            })
+            }),
+            signal: controller.signal
         });
         const data = await response.json();
 
@@ -309,110 +456,174 @@ async function calculateAndDisplayRoute() {
             return;
         }
 
-        const routeSummariesDiv = document.getElementById('routeSummaries');
-        if (!routeSummariesDiv) {
-            console.error("Error: Elemento 'routeSummaries' no encontrado en el DOM. No se pueden mostrar los resúmenes de ruta.");
-            alert("Error interno: No se pudo encontrar el área para mostrar los resúmenes de ruta.");
+        cacheSet(routeResponseCache, cacheKey, data, ROUTE_CACHE_MAX_ENTRIES);
+        displayRoutes(data);
+    } catch (error) {
+        if (error.name === 'AbortError') {
+            console.log("Solicitud de ruta cancelada por una más reciente.");
             return;
         }
-        routeSummariesDiv.innerHTML = ''; 
+        console.error("Error al obtener las rutas:", error);
+        alert("Error al calcular la ruta: " + error.message);
+        const routeSummariesDiv = document.getElementById('routeSummaries');
+        if (routeSummariesDiv) {
+            routeSummariesDiv.innerHTML = '<div>Error al calcular la ruta.</div>';
+        }
+    } finally {
+        if (routeAbortController === controller) {
+            routeAbortController = null;
+        }
+    }
+}
 
-        if (data.rutas_alternativas && data.rutas_alternativas.length > 0) {
-            let allRoutesBounds = null;
+/**
+ * Dibuja en el mapa y en el resumen las rutas devueltas por /calculate_route.
+ */
+function displayRoutes(data) {
+    // Limpiar las polilíneas que se hayan dibujado mientras la solicitud estaba en curso
+    routePolylines.forEach(polyline => map.removeLayer(polyline));
+    routePolylines = [];
+    liveEta.unwatchAll();
 
-            // Ordenar las rutas por su tiempo de viaje (de la más rápida a la más lenta)
-            data.rutas_alternativas.sort((a, b) => a.tiempo_total_viaje_segundos - b.tiempo_total_viaje_segundos);
+    const routeSummariesDiv = document.getElementById('routeSummaries');
+    if (!routeSummariesDiv) {
+        console.error("Error: Elemento 'routeSummaries' no encontrado en el DOM. No se pueden mostrar los resúmenes de ruta.");
+        alert("Error interno: No se pudo encontrar el área para mostrar los resúmenes de ruta.");
+        return;
+    }
+    routeSummariesDiv.innerHTML = ''; 
 
-            // Definir los colores y etiquetas para las 3 rutas
-            const routeDisplayInfo = [
-                { type: 'Ruta Óptima', color: '#00FF00' }, // Verde
-                { type: 'Ruta Alternativa', color: '#FFFF00' }, // Amarillo
-                { type: 'Ruta Turística', color: '#FF0000' }  // Rojo
-            ];
+    if (data.rutas_alternativas && data.rutas_alternativas.length > 0) {
+        let allRoutesBounds = null;
 
-            // Crear la cabecera de la "tabla"
-            const headerDiv = document.createElement('div');
-            headerDiv.className = 'route-summary-header';
-            headerDiv.innerHTML = `
-                <div class="header-item">Tipo de Ruta</div>
-                <div class="header-item">Nivel Congestión</div>
-                <div class="header-item">Distancia (km)</div>
-                <div class="header-item">Tiempo Estimado</div>
-                <div class="header-item"></div> 
-            `;
-            routeSummariesDiv.appendChild(headerDiv);
-
-
-            data.rutas_alternativas.forEach((route, index) => {
-                console.log(`Detalles de Ruta ${index + 1} (ordenada):`, route);
-
-                const displayInfo = routeDisplayInfo[index] || { type: `Ruta ${index + 1}`, congestionCategory: 'Desconocido', color: '#FFFFFF' };
-                const overallColor = displayInfo.color; 
-
-                const overallCongestionPercentage = (route.overall_congestion * 100).toFixed(1); 
-                
-                const actualCongestionCategory = route.overall_congestion_category;
-                let congestionPercentageColor = 'inherit'; 
-                
-                if (actualCongestionCategory === 'Baja') {
-                    congestionPercentageColor = '#00FF00'; 
-                } else if (actualCongestionCategory === 'Media') {
-                    congestionPercentageColor = '#FFFF00'; 
-                } else if (actualCongestionCategory === 'Alta') {
-                    congestionPercentageColor = '#FF0000'; 
-                }
+        // Ordenar las rutas por su tiempo de viaje (de la más rápida a la más lenta)
+        data.rutas_alternativas.sort((a, b) => a.tiempo_total_viaje_segundos - b.tiempo_total_viaje_segundos);
 
-                const polylineCoords = route.coordenadas_de_ruta.map(coord => [coord.lat, coord.lon]);
+        // Definir los colores y etiquetas para las 3 rutas
+        const routeDisplayInfo = [
+            { type: 'Ruta Óptima', color: '#00FF00' }, // Verde
+            { type: 'Ruta Alternativa', color: '#FFFF00' }, // Amarillo
+            { type: 'Ruta Turística', color: '#FF0000' }  // Rojo
+        ];
 
-                const polyline = L.polyline(polylineCoords, { color: overallColor, weight: 6, opacity: 0.8 }).addTo(map);
-                routePolylines.push(polyline); 
+        // Crear la cabecera de la "tabla"
+        const headerDiv = document.createElement('div');
+        headerDiv.className = 'route-summary-header';
+        headerDiv.innerHTML = `
+            <div class="header-item">Tipo de Ruta</div>
+            <div class="header-item">Nivel Congestión</div>
+            <div class="header-item">Distancia (km)</div>
+            <div class="header-item">Tiempo Estimado</div>
+            <div class="header-item"></div> 
+        `;
+        routeSummariesDiv.appendChild(headerDiv);
 
-                if (!allRoutesBounds) {
-                    allRoutesBounds = polyline.getBounds();
-                } else {
-                    allRoutesBounds.extend(polyline.getBounds());
-                }
 
-                const travelTimeFormatted = formatTime(route.tiempo_total_viaje_segundos);
-                const distanceKm = typeof route.total_distance_meters === 'number'
-                                         ? (route.total_distance_meters / 1000).toFixed(2)
-                                         : '--';
-
-                const routeSummaryDivItem = document.createElement('div');
-                routeSummaryDivItem.className = 'route-summary-row'; 
-                routeSummaryDivItem.innerHTML = `
-                    <div class="row-item" style="color:${overallColor};">${displayInfo.type}</div> 
-                    <div class="row-item" style="color:${congestionPercentageColor};">${overallCongestionPercentage}%</div> 
-                    <div class="row-item">${distanceKm}</div>
-                    <div class="row-item">${travelTimeFormatted}</div>
-                    <div class="row-item">
-                        <button class="show-details-btn" data-route-index="${index}">Detalles</button>
-                    </div>
-                `;
-                routeSummariesDiv.appendChild(routeSummaryDivItem);
-            });
-
-            document.querySelectorAll('.show-details-btn').forEach(button => {
-                button.onclick = (event) => {
-                    const routeIndex = parseInt(event.target.dataset.routeIndex);
-                    showMoreDetails(routeIndex, data.rutas_alternativas[routeIndex]);
-                };
-            });
-
-            if (allRoutesBounds) {
-                map.fitBounds(allRoutesBounds.pad(0.1));
+        data.rutas_alternativas.forEach((route, index) => {
+            console.log(`Detalles de Ruta ${index + 1} (ordenada):`, route);
+
+            const displayInfo = routeDisplayInfo[index] || { type: `Ruta ${index + 1}`, congestionCategory: 'Desconocido', color: '#FFFFFF' };
+            const overallColor = displayInfo.color; 
+
+            const overallCongestionPercentage = (route.overall_congestion * 100).toFixed(1); 
+            
+            const congestionPercentageColor = congestionCategoryColor(route.overall_congestion_category);
+
+            const polylineCoords = route.coordenadas_de_ruta.map(coord => [coord.lat, coord.lon]);
+
+            const polyline = L.polyline(polylineCoords, { color: overallColor, weight: 6, opacity: 0.8 }).addTo(map);
+            routePolylines.push(polyline); 
+
+            if (!allRoutesBounds) {
+                allRoutesBounds = polyline.getBounds();
+            } else {
+                allRoutesBounds.extend(polyline.getBounds());
             }
 
-        } else {
-            routeSummariesDiv.innerHTML = '<div>No se encontraron rutas alternativas.</div>';
+            const travelTimeFormatted = formatTime(route.tiempo_total_viaje_segundos);
+            const distanceKm = typeof route.total_distance_meters === 'number'
+                                     ? (route.total_distance_meters / 1000).toFixed(2)
+                                     : '--';
+
+            const routeSummaryDivItem = document.createElement('div');
+            routeSummaryDivItem.className = 'route-summary-row'; 
+            routeSummaryDivItem.innerHTML = `
+                <div class="row-item" style="color:${overallColor};">${displayInfo.type}</div> 
+                <div class="row-item route-congestion" style="color:${congestionPercentageColor};">${overallCongestionPercentage}%</div> 
+                <div class="row-item">${distanceKm}</div>
+                <div class="row-item route-time">${travelTimeFormatted}</div>
+                <div class="row-item">
+                    <button class="show-details-btn" data-route-index="${index}">Detalles</button>
+                </div>
+            `;
+            routeSummariesDiv.appendChild(routeSummaryDivItem);
+
+            // El servidor avisa por WebSocket si cambia el tráfico de esta ruta
+            liveEta.watch(route.nodos_de_ruta, update => applyLiveUpdate(routeSummaryDivItem, route, update));
+        });
+
+        document.querySelectorAll('.show-details-btn').forEach(button => {
+            button.onclick = (event) => {
+                const routeIndex = parseInt(event.target.dataset.routeIndex);
+                showMoreDetails(routeIndex, data.rutas_alternativas[routeIndex]);
+            };
+        });
+
+        if (allRoutesBounds) {
+            map.fitBounds(allRoutesBounds.pad(0.1));
         }
-    } catch (error) {
-        console.error("Error al obtener las rutas:", error);
-        alert("Error al calcular la ruta: " + error.message);
-        const routeSummariesDiv = document.getElementById('routeSummaries');
-        if (routeSummariesDiv) {
-            routeSummariesDiv.innerHTML = '<div>Error al calcular la ruta.</div>';
+
+    } else {
+        routeSummariesDiv.innerHTML = '<div>No se encontraron rutas alternativas.</div>';
+    }
+}
+
+/**
+ * Color de una categoría de congestión (Baja, Media, Alta) en el resumen de rutas.
+ */
+function congestionCategoryColor(category) {
+    if (category === 'Baja') {
+        return '#00FF00';
+    } else if (category === 'Media') {
+        return '#FFFF00';
+    } else if (category === 'Alta') {
+        return '#FF0000';
+    }
+    return 'inherit';
+}
+
+/**
+ * Aplica una actualización de ETA en vivo a una ruta mostrada: su fila del resumen y
+ * sus datos (los que usa el modal de detalles).
+ */
+function applyLiveUpdate(rowElement, route, update) {
+    const closed = update.ruta_cerrada;
+    route.tiempo_total_viaje_segundos = closed ? Infinity : update.tiempo_total_viaje_segundos;
+    route.overall_congestion = update.overall_congestion;
+    route.overall_congestion_category = update.overall_congestion_category;
+    update.segmentos.forEach(change => {
+        const segment = route.segmentos_de_ruta[change.indice];
+        if (segment) {
+            segment.travel_time_seconds = change.travel_time_seconds === null ? Infinity : change.travel_time_seconds;
+            segment.congestion_level = change.congestion_level;
+            segment.categoria_congestion = change.categoria_congestion;
+            segment.speed_kmh = change.speed_kmh;
         }
+    });
+
+    const timeCell = rowElement.querySelector('.route-time');
+    const congestionCell = rowElement.querySelector('.route-congestion');
+    timeCell.textContent = formatTime(route.tiempo_total_viaje_segundos);
+    congestionCell.textContent = `${(update.overall_congestion * 100).toFixed(1)}%`;
+    congestionCell.style.color = congestionCategoryColor(update.overall_congestion_category);
+
+    if (update.ruta_sugerida) {
+        const suggested = update.ruta_sugerida.tiempo_total_viaje_segundos;
+        timeCell.title = `Hay una ruta más rápida (${formatTime(suggested)}); vuelve a calcular la ruta.`;
+        timeCell.classList.add('route-time-outdated');
+    } else {
+        timeCell.title = '';
+        timeCell.classList.remove('route-time-outdated');
     }
 }
 
@@ -429,6 +640,14 @@ window.resetApplication = resetApplication;
 function resetApplication() {
     console.log("Reiniciando aplicación...");
 
+    // Descartar cálculos pendientes para que no dibujen rutas después del reseteo
+    clearTimeout(routeDebounceTimer);
+    liveEta.unwatchAll();
+    if (routeAbortController) {
+        routeAbortController.abort();
+        routeAbortController = null;
+    }
+
     document.getElementById('originSearch').value = '';
     document.getElementById('originLat').value = '';
     document.getElementById('originLon').value = '';
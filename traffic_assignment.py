@@ -0,0 +1,373 @@
+"""
+Simulación de tráfico por asignación de demanda (equilibrio de usuario).
+
+En vez de ruido aleatorio independiente por arista (simulate_traffic_for_edge), las
+velocidades salen de cargar una matriz de demanda origen–destino sobre la red:
+- cada arista tiene una capacidad según su tipo de vía y un tiempo a flujo libre (su
+  'maxspeed' o la velocidad de su tipo de vía, como en EdgeStatics),
+- el tiempo con un flujo x sigue la función BPR t = t0 · (1 + α · (x / c)^β),
+- el equilibrio de usuario se aproxima con Frank–Wolfe: en cada iteración se cargan todos
+  los viajes en sus caminos más rápidos con los tiempos vigentes (all-or-nothing) y se
+  avanza hacia esa carga con una búsqueda lineal sobre la función objetivo de Beckmann.
+
+La carga all-or-nothing está vectorizada: un Dijkstra de scipy por lote de orígenes y los
+caminos de todos los viajes del lote se recorren hacia atrás a la vez, un tramo por paso.
+La demanda de cada franja es la de la hora punta por el factor de CONGESTION_PATTERNS; como hay pocos factores distintos, se resuelve un equilibrio por
+factor (partiendo del anterior) y no uno por cada una de las 168 franjas.
+
+Con --close se cierran las aristas de una calle y se compara con la red completa
+("¿qué pasa si se cierra la Av. Luzuriaga?"); los escenarios nunca se escriben.
+
+Uso:
+    python traffic_assignment.py --synthetic-pairs 3000 --dry-run
+    python traffic_assignment.py --demand demanda_od.csv
+    python traffic_assignment.py --close "Avenida Mariscal Toribio de Luzuriaga" --dry-run
+"""
+import argparse
+import csv
+import logging
+import time
+
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+
+from populate_traffic_data import congestion_pattern_factor
+from probe_ingestion import LocalProjection
+from traffic_store import CATEGORIAS, N_SLOTS
+
+logger = logging.getLogger(__name__)
+
+BPR_ALPHA = 0.15
+BPR_BETA = 4.0
+# Capacidad (vehículos/hora) de una arista según su tipo de vía de OSM; cada arista es un sentido
+CAPACITY_VEH_H = {
+    "trunk": 1800, "trunk_link": 1200,
+    "primary": 1400, "primary_link": 1000,
+    "secondary": 1100, "secondary_link": 900,
+    "tertiary": 900, "tertiary_link": 700,
+    "residential": 500, "unclassified": 500,
+    "living_street": 250, "service": 250,
+}
+DEFAULT_CAPACITY_VEH_H = 500
+MIN_ASSIGNED_SPEED_KMH = 1.0
+MAX_ITERATIONS = 30
+TARGET_RELATIVE_GAP = 0.005   # brecha relativa del equilibrio a la que se detiene Frank–Wolfe
+LINE_SEARCH_STEPS = 30
+ORIGIN_BATCH_CELLS = 4_000_000  # orígenes por lote × nodos: acota la memoria de los Dijkstra por lote
+
+DEFAULT_SYNTHETIC_PAIRS = 3000
+DEFAULT_SYNTHETIC_ZONES = 200   # el costo de cada carga crece con los orígenes distintos, no con los pares
+DEFAULT_PEAK_TRIPS = 50000      # viajes por hora en la hora punta con la demanda sintética (ver log_peak_congestion)
+MIN_SYNTHETIC_DISTANCE_M = 500.0
+# Bajo esta fracción de aristas en "Media" o "Alta" en la hora punta, la demanda probablemente está subestimada
+MIN_PEAK_CONGESTED_SHARE = 0.05
+
+
+def bpr_times(free_flow_time, capacity, flows):
+    """Tiempo de viaje (s) de cada arista con 'flows' vehículos/hora."""
+    return free_flow_time * (1.0 + BPR_ALPHA * (flows / capacity) ** BPR_BETA)
+
+
+def _path_loads(predecessors, rows, destinations, trips):
+    """
+    Recorre hacia atrás, todos a la vez, los caminos de cada viaje (fila 'rows' de
+    'predecessors' hasta 'destinations'): un paso por tramo para todos los viajes que aún
+    no llegan a su origen. Retorna (nodo padre, nodo hijo, viajes) de cada tramo recorrido.
+    """
+    parents, children, loads = [], [], []
+    current = destinations
+    parent = predecessors[rows, current]
+    active = np.flatnonzero(parent >= 0)
+    while len(active):
+        parents.append(parent[active])
+        children.append(current[active])
+        loads.append(trips[active])
+        current, rows, trips = parent[active], rows[active], trips[active]
+        parent = predecessors[rows, current]
+        active = np.flatnonzero(parent >= 0)
+    if not parents:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    return np.concatenate(parents), np.concatenate(children), np.concatenate(loads)
+
+
+class AssignmentNetwork:
+    """Red para la asignación: GraphArrays más la capacidad y el tiempo a flujo libre de cada arista."""
+
+    def __init__(self, graph_arrays, statics, closed=None):
+        self.graph_arrays = graph_arrays
+        self.capacity = np.array([CAPACITY_VEH_H.get(h, DEFAULT_CAPACITY_VEH_H) for h in statics.highways], dtype=np.float64)
+        self.free_flow_kmh = statics.free_flow_kmh.astype(np.float64)
+        self.free_flow_time = statics.length.astype(np.float64) / (self.free_flow_kmh * 1000 / 3600)
+        if closed is not None:
+            self.free_flow_time[closed] = np.inf
+
+    def link_times(self, flows):
+        return bpr_times(self.free_flow_time, self.capacity, flows)
+
+    def speeds(self, flows) -> np.ndarray:
+        """Velocidad (km/h) de cada arista con 'flows'; la misma razón que el tiempo BPR."""
+        ratio = 1.0 + BPR_ALPHA * (flows / self.capacity) ** BPR_BETA
+        return np.maximum(MIN_ASSIGNED_SPEED_KMH, self.free_flow_kmh / ratio).astype(np.float32)
+
+    def all_or_nothing(self, travel_times, origins, destinations, trips):
+        """
+        Carga cada viaje en su camino más rápido con 'travel_times'. Retorna el flujo por
+        arista y los viajes sin camino entre su origen y su destino.
+        """
+        arrays = self.graph_arrays
+        n = arrays.n_nodes
+        chosen = arrays.fastest_edges(travel_times)
+        matrix = arrays.build_matrix(travel_times, chosen)
+        chosen_pairs = arrays.edge_pair[chosen]
+
+        flows = np.zeros(len(travel_times), dtype=np.float64)
+        unrouted = 0.0
+        sources, pair_source = np.unique(origins, return_inverse=True)
+        batch_size = max(1, ORIGIN_BATCH_CELLS // max(n, 1))
+        for start in range(0, len(sources), batch_size):
+            batch_sources = sources[start:start + batch_size]
+            in_batch = (pair_source >= start) & (pair_source < start + len(batch_sources))
+            distances, predecessors = dijkstra(matrix, directed=True, indices=batch_sources, return_predecessors=True)
+            rows = pair_source[in_batch] - start
+            pair_destinations, pair_trips = destinations[in_batch], trips[in_batch]
+            reachable = np.isfinite(distances[rows, pair_destinations])
+            unrouted += float(pair_trips[~reachable].sum())
+
+            parents, children, loads = _path_loads(
+                predecessors, rows[reachable], pair_destinations[reachable], pair_trips[reachable])
+            edges = chosen[np.searchsorted(chosen_pairs, parents.astype(np.int64) * n + children)]
+            flows += np.bincount(edges, weights=loads, minlength=len(flows))
+        return flows, unrouted
+
+    def _line_search(self, flows, direction):
+        """Paso en [0, 1] que minimiza la función de Beckmann sobre flows + paso · direction (bisección)."""
+        moving = np.isfinite(self.free_flow_time) & (direction != 0)
+        t0, capacity = self.free_flow_time[moving], self.capacity[moving]
+        x, d = flows[moving], direction[moving]
+
+        def derivative(step):
+            return float(np.dot(bpr_times(t0, capacity, x + step * d), d))
+
+        if derivative(1.0) <= 0:
+            return 1.0
+        low, high = 0.0, 1.0
+        for _ in range(LINE_SEARCH_STEPS):
+            middle = (low + high) / 2
+            if derivative(middle) > 0:
+                high = middle
+            else:
+                low = middle
+        return (low + high) / 2
+
+    def equilibrium(self, origins, destinations, trips, initial_flows=None,
+                    max_iterations=MAX_ITERATIONS, target_gap=TARGET_RELATIVE_GAP):
+        """
+        Equilibrio de usuario aproximado con Frank–Wolfe. 'initial_flows' debe ser una carga
+        factible para esta demanda (por ejemplo, el equilibrio de otra demanda escalado).
+        Retorna (flujo por arista, resumen).
+        """
+        if max_iterations < 1:
+            raise ValueError("max_iterations debe ser al menos 1.")
+        if initial_flows is None:
+            flows, unrouted = self.all_or_nothing(self.free_flow_time, origins, destinations, trips)
+        else:
+            flows = initial_flows
+        gap = np.inf
+        iteration = 0
+        for iteration in range(1, max_iterations + 1):
+            times = self.link_times(flows)
+            target, unrouted = self.all_or_nothing(times, origins, destinations, trips)
+            open_edges = np.isfinite(times)
+            total = float(np.dot(times[open_edges], flows[open_edges]))
+            gap = (total - float(np.dot(times[open_edges], target[open_edges]))) / total if total > 0 else 0.0
+            if gap <= target_gap:
+                break
+            direction = target - flows
+            flows = flows + self._line_search(flows, direction) * direction
+
+        times = self.link_times(flows)
+        open_edges = np.isfinite(times)
+        return flows, {
+            "iterations": iteration,
+            "relative_gap": gap,
+            "unrouted_trips": unrouted,
+            "vehicle_hours": float(np.dot(times[open_edges], flows[open_edges])) / 3600,
+        }
+
+
+def slot_demand_factors() -> np.ndarray:
+    """Demanda de cada una de las 168 franjas relativa a la de la hora punta."""
+    return np.array([congestion_pattern_factor(slot // 24, slot % 24) for slot in range(N_SLOTS)])
+
+
+def assign_slots(network, origins, destinations, peak_trips, **options):
+    """
+    Velocidades (aristas × 168) del equilibrio de cada franja. Se resuelve un equilibrio por
+    factor de demanda distinto, de menor a mayor, partiendo del anterior escalado (la carga
+    all-or-nothing es lineal en la demanda, así que sigue siendo factible).
+    Retorna (velocidades, {factor: (flujos, resumen)}).
+    """
+    factors = slot_demand_factors()
+    speeds = np.empty((len(network.free_flow_time), N_SLOTS), dtype=np.float32)
+    results = {}
+    flows, previous = None, None
+    for factor in np.unique(factors).tolist():
+        start = time.perf_counter()
+        initial = flows * (factor / previous) if flows is not None else None
+        flows, summary = network.equilibrium(origins, destinations, peak_trips * factor, initial, **options)
+        speeds[:, factors == factor] = network.speeds(flows)[:, None]
+        results[factor] = (flows, summary)
+        previous = factor
+        logger.info(f"Demanda {factor:.2f} × punta: {summary['iterations']} iteraciones, brecha {summary['relative_gap']:.4f}, "
+                    f"{summary['vehicle_hours']:.0f} veh·h, {summary['unrouted_trips']:.0f} viajes sin camino "
+                    f"({time.perf_counter() - start:.1f}s).")
+    return speeds, results
+
+
+# --- Demanda ---
+
+def _node_positions(graph_arrays, lons, lats):
+    return np.array([graph_arrays.node_position[int(node)] for node in graph_arrays.nearest_nodes(lons, lats)], dtype=np.int64)
+
+
+def load_demand_csv(path, graph_arrays):
+    """
+    Demanda de la hora punta desde un CSV con columnas origen_lat, origen_lon, destino_lat,
+    destino_lon y viajes_hora; cada punto se ajusta al nodo más cercano.
+    Retorna (orígenes, destinos, viajes) con posiciones de nodos.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        raise ValueError(f"El archivo de demanda {path} no tiene filas.")
+    column = lambda name: np.array([float(row[name]) for row in rows])
+    origins = _node_positions(graph_arrays, column("origen_lon"), column("origen_lat"))
+    destinations = _node_positions(graph_arrays, column("destino_lon"), column("destino_lat"))
+    trips = column("viajes_hora")
+    # Los pares que caen en el mismo nodo no recorren ninguna arista
+    keep = (origins != destinations) & (trips > 0)
+    return origins[keep], destinations[keep], trips[keep]
+
+
+def synthetic_demand(graph_arrays, n_pairs=DEFAULT_SYNTHETIC_PAIRS, total_trips=DEFAULT_PEAK_TRIPS,
+                     n_zones=DEFAULT_SYNTHETIC_ZONES, seed=42):
+    """
+    Demanda al azar (reproducible con la semilla) entre 'n_zones' nodos que hacen de
+    centroides de zona, como una matriz OD por zonas: hasta 'n_pairs' pares de zonas
+    separadas por al menos MIN_SYNTHETIC_DISTANCE_M, con 'total_trips' viajes por hora
+    repartidos entre ellos.
+    """
+    rng = np.random.default_rng(seed)
+    zones = rng.choice(graph_arrays.n_nodes, size=min(n_zones, graph_arrays.n_nodes), replace=False)
+    projection = LocalProjection(float(np.mean(graph_arrays.node_lat)), float(np.mean(graph_arrays.node_lon)))
+    x, y = projection.to_xy(graph_arrays.node_lat[zones], graph_arrays.node_lon[zones])
+    far = np.hypot(x[:, None] - x[None, :], y[:, None] - y[None, :]) >= MIN_SYNTHETIC_DISTANCE_M
+    pair_o, pair_d = np.nonzero(far)
+    chosen = rng.choice(len(pair_o), size=min(n_pairs, len(pair_o)), replace=False)
+    weights = rng.gamma(2.0, size=len(chosen))
+    return zones[pair_o[chosen]], zones[pair_d[chosen]], weights / weights.sum() * total_trips
+
+
+def street_edges(graph, name) -> np.ndarray:
+    """Posiciones de las aristas cuyo nombre contiene 'name' (sin distinguir mayúsculas)."""
+    needle = name.casefold()
+    codes = [code for code, names in enumerate(graph.names) if any(needle in n.casefold() for n in names)]
+    return np.flatnonzero(np.isin(graph.name_code, codes))
+
+
+def log_peak_congestion(speeds, category_code) -> float:
+    """
+    Registra cuántas aristas quedan en cada categoría en la franja de mayor demanda y
+    retorna la fracción en "Media" o "Alta"; sirve para calibrar --peak-trips.
+    """
+    peak_slot = int(np.argmax(slot_demand_factors()))
+    counts = np.bincount(category_code[:, peak_slot], minlength=len(CATEGORIAS))
+    shares = counts / max(len(speeds), 1)
+    logger.info("Hora punta: " + ", ".join(f"{shares[code]:.1%} {CATEGORIAS[code]}" for code in range(1, len(CATEGORIAS))) + " de las aristas.")
+    return float(shares[2:].sum())
+
+
+def log_scenario_comparison(graph, base, scenario, closed, top=10):
+    """Compara la hora punta de la red completa ('base') con la del escenario con cierres."""
+    peak = max(base)
+    base_flows, base_summary = base[peak]
+    scenario_flows, scenario_summary = scenario[peak]
+    # Los viajes que quedan sin camino no suman veh·h: compararlos junto con el total
+    logger.info(f"Hora punta: {base_summary['vehicle_hours']:.0f} veh·h con la red completa, "
+                f"{scenario_summary['vehicle_hours']:.0f} veh·h con {len(closed)} aristas cerradas; "
+                f"{scenario_summary['unrouted_trips']:.0f} viajes/hora quedan sin camino.")
+    change = scenario_flows - base_flows
+    change[closed] = 0.0
+    # Por cada calle con nombre, su tramo con mayor aumento de flujo
+    named = np.flatnonzero((graph.name_code >= 0) & (change > 0))
+    order = named[np.lexsort((-change[named], graph.name_code[named]))]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = graph.name_code[order[1:]] != graph.name_code[order[:-1]]
+    busiest = order[first]
+    logger.info("Calles que más tráfico reciben (tramo con mayor aumento):")
+    for i in busiest[np.argsort(-change[busiest], kind="stable")][:top].tolist():
+        logger.info(f"  {' / '.join(graph.names[graph.name_code[i]])}: {base_flows[i]:.0f} → {scenario_flows[i]:.0f} veh/h")
+
+if __name__ == "__main__":
+    from graph_snapshot import load_graph
+    from populate_traffic_data import GRAPH_PATH, TRAFFIC_SPEED_COLUMNS, bulk_upsert_traffic_data, get_db_connection
+    from routing_graph import GraphArrays
+    from traffic_prediction import EdgeStatics, derive_traffic_fields, prediction_rows, publish_to_store
+    from traffic_store import TRAFFIC_STORE_PATH, EdgeIndex, SharedTrafficStore
+
+    parser = argparse.ArgumentParser(description="Simula el tráfico de las 168 franjas asignando una demanda origen–destino (Frank–Wolfe + BPR).")
+    parser.add_argument("--demand", help="CSV con origen_lat, origen_lon, destino_lat, destino_lon, viajes_hora (hora punta).")
+    parser.add_argument("--synthetic-pairs", type=int, default=DEFAULT_SYNTHETIC_PAIRS, help="Pares OD al azar si no se da --demand.")
+    parser.add_argument("--zones", type=int, default=DEFAULT_SYNTHETIC_ZONES, help="Zonas (nodos de origen/destino) de la demanda sintética.")
+    parser.add_argument("--peak-trips", type=float, default=DEFAULT_PEAK_TRIPS, help="Viajes por hora en la punta de la demanda sintética.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--close", action="append", default=[], help="Cierra las aristas de la calle con este nombre (se puede repetir).")
+    parser.add_argument("--max-iterations", type=int, default=MAX_ITERATIONS, help="Iteraciones de Frank–Wolfe por factor de demanda (al menos 1).")
+    parser.add_argument("--gap", type=float, default=TARGET_RELATIVE_GAP, help="Brecha relativa a la que se detiene Frank–Wolfe.")
+    parser.add_argument("--dry-run", action="store_true", help="Simula sin escribir en la base de datos (implícito con --close).")
+    args = parser.parse_args()
+    if args.max_iterations < 1:
+        parser.error("--max-iterations debe ser al menos 1.")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+    G = load_graph(GRAPH_PATH)
+    edge_index = EdgeIndex(G.edge_keys())
+    graph_arrays = GraphArrays(G, edge_index)
+    statics = EdgeStatics(G, edge_index)
+    if args.demand:
+        origins, destinations, trips = load_demand_csv(args.demand, graph_arrays)
+    else:
+        origins, destinations, trips = synthetic_demand(graph_arrays, args.synthetic_pairs, args.peak_trips, args.zones, args.seed)
+    logger.info(f"Demanda: {len(trips)} pares OD, {trips.sum():.0f} viajes/hora en la hora punta.")
+    options = {"max_iterations": args.max_iterations, "target_gap": args.gap}
+
+    closed = np.unique(np.concatenate([street_edges(G, name) for name in args.close])).astype(np.int64) if args.close else None
+    start = time.perf_counter()
+    if closed is not None:
+        logger.info(f"Escenario: {len(closed)} aristas cerradas ({', '.join(args.close)}).")
+        _, base = assign_slots(AssignmentNetwork(graph_arrays, statics), origins, destinations, trips, **options)
+    speeds, results = assign_slots(AssignmentNetwork(graph_arrays, statics, closed), origins, destinations, trips, **options)
+    logger.info(f"Asignación de las 168 franjas: {time.perf_counter() - start:.1f}s.")
+    fields = derive_traffic_fields(statics, speeds)
+    congested_share = log_peak_congestion(speeds, fields[2])
+    if closed is not None:
+        # Un escenario hipotético nunca se escribe: datos_trafico alimenta el ruteo real
+        log_scenario_comparison(G, base, results, closed)
+        if not args.dry_run:
+            logger.info("Con --close la simulación no se escribe en la base de datos.")
+    elif not args.dry_run:
+        if congested_share < MIN_PEAK_CONGESTED_SHARE:
+            logger.warning(f"Solo {congested_share:.1%} de las aristas quedan en 'Media' o 'Alta' en la hora punta: "
+                           "la demanda parece baja y el perfil escrito será casi de flujo libre. "
+                           "Conviene calibrar --peak-trips (o la demanda del CSV) con --dry-run antes de escribir.")
+        conn = get_db_connection()
+        try:
+            start = time.perf_counter()
+            written = bulk_upsert_traffic_data(conn, prediction_rows(edge_index, statics, speeds, *fields),
+                                               update_columns=TRAFFIC_SPEED_COLUMNS)
+            logger.info(f"{written} filas escritas en datos_trafico en {time.perf_counter() - start:.2f}s.")
+        finally:
+            conn.close()
+        store = SharedTrafficStore(TRAFFIC_STORE_PATH, edge_index)
+        if store.attach():
+            publish_to_store(store, statics, speeds, *fields)
@@ -0,0 +1,387 @@
+"""
+Historial de observaciones de tráfico por arista.
+
+datos_trafico guarda una sola fila por (arista, día de la semana, hora): el perfil que usa
+el ruteo. Las sondas GPS, además, se guardan en 'observaciones_trafico' agrupadas por
+arista e intervalo de HISTORY_BUCKET_SECONDS (cantidad, media y m2 de Welford), en una
+tabla particionada por mes con índice BRIN sobre 'observado_en'. Como las filas llegan en
+orden temporal, el BRIN y la poda de particiones hacen que una consulta por rango de
+fechas lea solo los bloques de ese rango, no todo el historial.
+
+Sobre el historial:
+- rollup_profile() recalcula el perfil de 168 franjas con las últimas semanas y
+  apply_rollup() lo escribe en datos_trafico (y en el almacén compartido si está abierto),
+- average_speeds() responde consultas como "velocidad media en estas aristas los últimos
+  8 lunes de 7 a 9" en una sola consulta agregada.
+
+Uso:
+    python traffic_history.py rollup --weeks 8
+    python traffic_history.py query --day 0 --from-hour 7 --to-hour 9 --weeks 8 --edge 287840918 4681487920 0
+    python traffic_history.py prune --keep-months 24
+"""
+import argparse
+import io
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+
+from traffic_store import CATEGORIAS, N_SLOTS, slot_index
+
+logger = logging.getLogger(__name__)
+
+HISTORY_TABLE = "observaciones_trafico"
+HISTORY_ROLLUP_WEEKS = int(os.getenv("HISTORY_ROLLUP_WEEKS", 8))
+HISTORY_ROLLUP_INTERVAL_SECONDS = float(os.getenv("HISTORY_ROLLUP_INTERVAL_SECONDS", 24 * 3600))
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", 24))
+# Sondas mínimas en la ventana del rollup para reemplazar la velocidad del perfil
+ROLLUP_MIN_SAMPLES = 5
+
+HISTORY_COLUMNS = (
+    "observado_en", "u", "v", "edge_key", "dia_de_semana", "hora_del_dia",
+    "muestras", "velocidad_promedio_kmh", "velocidad_m2",
+)
+
+
+# --- Esquema y particiones ---
+
+def ensure_history_table(conn):
+    """Crea la tabla particionada y su índice BRIN si no existen (no hace commit)."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+                observado_en TIMESTAMPTZ NOT NULL,     -- inicio del intervalo
+                u BIGINT NOT NULL,
+                v BIGINT NOT NULL,
+                edge_key BIGINT NOT NULL,
+                dia_de_semana SMALLINT NOT NULL,       -- hora local, igual que la franja del perfil
+                hora_del_dia SMALLINT NOT NULL,
+                muestras INTEGER NOT NULL,
+                velocidad_promedio_kmh REAL NOT NULL,
+                velocidad_m2 REAL NOT NULL             -- suma de cuadrados de las desviaciones (Welford)
+            ) PARTITION BY RANGE (observado_en);
+        """)
+        cur.execute(f"""
+            CREATE INDEX IF NOT EXISTS {HISTORY_TABLE}_observado_en_brin
+            ON {HISTORY_TABLE} USING BRIN (observado_en) WITH (pages_per_range = 32);
+        """)
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def _next_month(month):
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def _partition_name(month):
+    return f"{HISTORY_TABLE}_{month.year:04d}_{month.month:02d}"
+
+
+def ensure_partitions(conn, start, end):
+    """
+    Crea la tabla y las particiones mensuales (meses UTC) que cubren [start, end] si no
+    existen (no hace commit). Solo ejecuta DDL cuando falta algo; lo normal es una única
+    consulta a to_regclass. El DDL va en un savepoint: si otro proceso crea la misma
+    partición a la vez, se descarta solo el savepoint y se vuelve a comprobar, sin abortar
+    la transacción del llamador (el volcado de sondas la usa dentro de la suya).
+    """
+    months = []
+    month = _month_start(start.astimezone(timezone.utc))
+    while month <= end:
+        months.append(month)
+        month = _next_month(month)
+    for attempt in range(2):
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL, array_agg(to_regclass(name) IS NOT NULL) FROM unnest(%s::text[]) AS name;",
+                        (HISTORY_TABLE, [_partition_name(m) for m in months]))
+            table_exists, partitions_exist = cur.fetchone()
+            missing = [m for m, exists in zip(months, partitions_exist or []) if not exists]
+            if table_exists and not missing:
+                return
+            cur.execute("SAVEPOINT ensure_partitions;")
+            try:
+                if not table_exists:
+                    ensure_history_table(conn)
+                for month in missing:
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {_partition_name(month)} PARTITION OF {HISTORY_TABLE}
+                        FOR VALUES FROM (%s) TO (%s);
+                    """, (month, _next_month(month)))
+            except (psycopg2.errors.DuplicateTable, psycopg2.errors.DuplicateObject, psycopg2.errors.UniqueViolation) as e:
+                # IF NOT EXISTS no protege de una creación concurrente que todavía no había hecho commit
+                cur.execute("ROLLBACK TO SAVEPOINT ensure_partitions;")
+                if attempt:
+                    raise
+                logger.info(f"Otra conexión creó a la vez el historial o sus particiones; se vuelve a comprobar: {e}")
+                continue
+            cur.execute("RELEASE SAVEPOINT ensure_partitions;")
+            return
+
+
+def drop_old_partitions(conn, keep_months=HISTORY_RETENTION_MONTHS, now=None):
+    """Borra las particiones de meses anteriores a los últimos 'keep_months'. Retorna sus nombres."""
+    now = now or datetime.now(timezone.utc)
+    oldest = _month_start(now)
+    for _ in range(keep_months - 1):
+        oldest = (oldest - timedelta(days=1)).replace(day=1)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s);
+        """, (HISTORY_TABLE,))
+        dropped = sorted(name for (name,) in cur.fetchall() if name < _partition_name(oldest))
+        for name in dropped:
+            cur.execute(f"DROP TABLE {name};")
+    conn.commit()
+    return dropped
+
+
+# --- Escritura ---
+
+def observation_rows(edge_index, stats):
+    """
+    Filas de observaciones_trafico a partir de estadísticas por (posición de arista, inicio
+    del intervalo en segundos epoch) -> [cantidad, media, m2], en el orden de HISTORY_COLUMNS.
+    """
+    rows = []
+    slots = {}
+    for (position, bucket), (n, mean, m2) in stats.items():
+        if bucket not in slots:
+            local = datetime.fromtimestamp(bucket)
+            slots[bucket] = (datetime.fromtimestamp(bucket, timezone.utc), local.weekday(), local.hour)
+        observed_at, day, hour = slots[bucket]
+        u, v, key = edge_index.edges[position]
+        rows.append((observed_at, u, v, key, day, hour, int(n), float(mean), float(m2)))
+    return rows
+
+
+def write_observations(conn, rows, commit=True):
+    """
+    Agrega observaciones al historial con COPY, creando antes las particiones que falten.
+    Con commit=False queda dentro de la transacción del llamador. Retorna la cantidad de filas.
+    """
+    if not rows:
+        return 0
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join([row[0].isoformat(), *map(str, row[1:])]))
+        buffer.write("\n")
+    buffer.seek(0)
+    try:
+        ensure_partitions(conn, min(row[0] for row in rows), max(row[0] for row in rows))
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY {HISTORY_TABLE} ({', '.join(HISTORY_COLUMNS)}) FROM STDIN", buffer)
+        if commit:
+            conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error al guardar observaciones en el historial de tráfico: {e}")
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+# --- Consultas ---
+
+def weekly_windows(day_of_week, from_hour, to_hour, weeks, until=None):
+    """
+    Intervalos [inicio, fin) del día de la semana 'day_of_week' (0 = lunes) de 'from_hour'
+    a 'to_hour' (hora local) en las últimas 'weeks' semanas que empezaron antes de 'until'.
+    """
+    until = until or datetime.now()
+    start_day = until.date() - timedelta(days=(until.weekday() - day_of_week) % 7)
+    windows = []
+    day = start_day
+    while len(windows) < weeks:
+        start = datetime.combine(day, datetime.min.time()) + timedelta(hours=from_hour)
+        if start < until:
+            end = datetime.combine(day, datetime.min.time()) + timedelta(hours=to_hour)
+            windows.append((start.astimezone(), min(end, until).astimezone()))
+        day -= timedelta(days=7)
+    return windows
+
+
+def average_speeds(conn, edge_index, windows, positions=None):
+    """
+    Velocidad media (ponderada por sondas) y cantidad de sondas de cada arista dentro de
+    los intervalos 'windows'. 'positions' (del EdgeIndex) limita las aristas; sin él se
+    devuelven todas. Retorna (velocidades float32 con NaN sin datos, muestras) alineados
+    con 'positions'. Cada intervalo es un rango sobre 'observado_en', así que solo se leen
+    las particiones y los bloques del BRIN que lo cubren.
+    """
+    positions = np.arange(len(edge_index)) if positions is None else np.asarray(positions, dtype=np.int64)
+    speeds = np.full(len(positions), np.nan, dtype=np.float32)
+    samples = np.zeros(len(positions), dtype=np.int64)
+    if not windows or len(positions) == 0:
+        return speeds, samples
+
+    ranges = " OR ".join(["(o.observado_en >= %s AND o.observado_en < %s)"] * len(windows))
+    params = [moment for window in windows for moment in window]
+    edge_filter = ""
+    if len(positions) < len(edge_index):
+        edges = [edge_index.edges[p] for p in positions.tolist()]
+        edge_filter = """
+            JOIN unnest(%s::bigint[], %s::bigint[], %s::bigint[]) AS e(u, v, edge_key)
+              ON o.u = e.u AND o.v = e.v AND o.edge_key = e.edge_key"""
+        params = [[e[0] for e in edges], [e[1] for e in edges], [e[2] for e in edges]] + params
+
+    row_of = {edge_index.edges[p]: j for j, p in enumerate(positions.tolist())}
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT o.u, o.v, o.edge_key, SUM(o.muestras), SUM(o.muestras * o.velocidad_promedio_kmh) / SUM(o.muestras)
+            FROM {HISTORY_TABLE} o{edge_filter}
+            WHERE {ranges}
+            GROUP BY o.u, o.v, o.edge_key;
+        """, params)
+        for u, v, key, n, mean in cur:
+            j = row_of.get((u, v, key))
+            if j is not None:
+                speeds[j] = mean
+                samples[j] = n
+    return speeds, samples
+
+
+def rollup_profile(conn, edge_index, weeks=HISTORY_ROLLUP_WEEKS, until=None):
+    """
+    Velocidad media (ponderada por sondas) de cada (arista, franja) en las últimas 'weeks'
+    semanas: matrices aristas × 168 de velocidades (NaN sin datos) y de sondas.
+    """
+    until = until or datetime.now(timezone.utc)
+    speeds = np.full((len(edge_index), N_SLOTS), np.nan, dtype=np.float32)
+    samples = np.zeros((len(edge_index), N_SLOTS), dtype=np.int64)
+    position = edge_index.position
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT u, v, edge_key, dia_de_semana, hora_del_dia,
+                   SUM(muestras), SUM(muestras * velocidad_promedio_kmh) / SUM(muestras)
+            FROM {HISTORY_TABLE}
+            WHERE observado_en >= %s AND observado_en < %s
+            GROUP BY u, v, edge_key, dia_de_semana, hora_del_dia;
+        """, (until - timedelta(weeks=weeks), until))
+        while True:
+            rows = cur.fetchmany(50_000)
+            if not rows:
+                break
+            for u, v, key, day, hour, n, mean in rows:
+                i = position.get((u, v, key))
+                if i is not None:
+                    slot = slot_index(day, hour)
+                    speeds[i, slot] = mean
+                    samples[i, slot] = n
+    logger.info(f"Rollup de {weeks} semanas: {int(np.count_nonzero(samples))} (arista, franja) con observaciones.")
+    return speeds, samples
+
+
+def apply_rollup(conn, edge_index, statics, weeks=HISTORY_ROLLUP_WEEKS, min_samples=ROLLUP_MIN_SAMPLES,
+                 traffic_store=None, redis_client=None, until=None):
+    """
+    Reemplaza en el perfil de 168 franjas la velocidad de las (arista, franja) con al menos
+    'min_samples' sondas en las últimas 'weeks' semanas, en datos_trafico y, si se pasan,
+    en el almacén compartido y en Redis. Retorna la cantidad de (arista, franja) escritas.
+    """
+    from populate_traffic_data import TRAFFIC_SPEED_COLUMNS, bulk_upsert_traffic_data
+    from probe_ingestion import publish_slot_patches
+    from traffic_prediction import derive_traffic_fields
+
+    speeds, samples = rollup_profile(conn, edge_index, weeks, until)
+    speeds = np.maximum(1.0, speeds)
+    congestion, travel_time, category_code = derive_traffic_fields(statics, speeds)
+    edges, slots = np.nonzero(samples >= min_samples)
+    if len(edges) == 0:
+        conn.rollback()
+        return 0
+
+    lengths = statics.length.tolist()
+    rows = [
+        (*edge_index.edges[i], slot // 24, slot % 24,
+         float(speeds[i, slot]), float(congestion[i, slot]), float(travel_time[i, slot]),
+         CATEGORIAS[category_code[i, slot]], statics.highways[i], lengths[i])
+        for i, slot in zip(edges.tolist(), slots.tolist())
+    ]
+    written = bulk_upsert_traffic_data(conn, rows, update_columns=TRAFFIC_SPEED_COLUMNS)
+
+    patches = {}
+    for slot in np.unique(slots).tolist():
+        positions = edges[slots == slot]
+        patches[slot] = (positions, {
+            "speed_kmh": speeds[positions, slot],
+            "congestion_level": congestion[positions, slot],
+            "travel_time": travel_time[positions, slot],
+            "categoria_congestion": category_code[positions, slot],
+        })
+    publish_slot_patches(patches, traffic_store, redis_client)
+    logger.info(f"Perfil actualizado desde el historial: {written} (arista, franja) en {len(patches)} franjas.")
+    return written
+
+
+def maintain_history(conn, edge_index, statics, traffic_store=None, redis_client=None):
+    """Tarea programada: particiones del mes actual y el siguiente, retención y rollup del perfil."""
+    now = datetime.now(timezone.utc)
+    ensure_partitions(conn, now, _next_month(_month_start(now)))
+    conn.commit()
+    dropped = drop_old_partitions(conn)
+    if dropped:
+        logger.info(f"Particiones del historial borradas por antigüedad: {', '.join(dropped)}.")
+    return apply_rollup(conn, edge_index, statics, traffic_store=traffic_store, redis_client=redis_client)
+
+
+if __name__ == "__main__":
+    from graph_snapshot import load_graph
+    from populate_traffic_data import GRAPH_PATH, get_db_connection
+    from traffic_prediction import EdgeStatics
+    from traffic_store import TRAFFIC_STORE_PATH, EdgeIndex, SharedTrafficStore
+
+    parser = argparse.ArgumentParser(description="Historial de observaciones de tráfico: rollup del perfil, consultas y retención.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rollup_parser = subparsers.add_parser("rollup", help="Recalcula el perfil de 168 franjas con las últimas semanas.")
+    rollup_parser.add_argument("--weeks", type=int, default=HISTORY_ROLLUP_WEEKS)
+    rollup_parser.add_argument("--min-samples", type=int, default=ROLLUP_MIN_SAMPLES)
+    rollup_parser.add_argument("--no-redis", action="store_true",
+                               help="No invalida las franjas en Redis (quedan viejas hasta que vencen).")
+    query_parser = subparsers.add_parser("query", help="Velocidad media de unas aristas en un día y horario de las últimas semanas.")
+    query_parser.add_argument("--day", type=int, required=True, help="Día de la semana (0 = lunes).")
+    query_parser.add_argument("--from-hour", type=int, required=True)
+    query_parser.add_argument("--to-hour", type=int, required=True, help="Hora de fin (exclusiva).")
+    query_parser.add_argument("--weeks", type=int, default=8)
+    query_parser.add_argument("--edge", type=int, nargs=3, action="append", metavar=("U", "V", "KEY"),
+                              help="Arista a consultar (se puede repetir); sin ninguna, todas.")
+    prune_parser = subparsers.add_parser("prune", help="Borra las particiones más antiguas que la retención.")
+    prune_parser.add_argument("--keep-months", type=int, default=HISTORY_RETENTION_MONTHS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", force=True)
+    G = load_graph(GRAPH_PATH)
+    edge_index = EdgeIndex(G.edge_keys())
+    conn = get_db_connection()
+    try:
+        if args.command == "rollup":
+            store = SharedTrafficStore(TRAFFIC_STORE_PATH, edge_index)
+            if not store.attach():
+                store = None
+            redis_client = None
+            if not args.no_redis:
+                import redis
+
+                redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", 6379)),
+                                                 db=int(os.getenv("REDIS_DB", 0)), socket_connect_timeout=2)
+            apply_rollup(conn, edge_index, EdgeStatics(G, edge_index), args.weeks, args.min_samples,
+                         traffic_store=store, redis_client=redis_client)
+        elif args.command == "query":
+            positions = None
+            if args.edge:
+                positions = [edge_index.position[tuple(edge)] for edge in args.edge if tuple(edge) in edge_index.position]
+            windows = weekly_windows(args.day, args.from_hour, args.to_hour, args.weeks)
+            speeds, samples = average_speeds(conn, edge_index, windows, positions)
+            for position, speed, n in zip(positions if positions is not None else range(len(edge_index)),
+                                          speeds.tolist(), samples.tolist()):
+                if n:
+                    print(*edge_index.edges[position], f"{speed:.1f} km/h", f"{n} sondas")
+        else:
+            print("\n".join(drop_old_partitions(conn, args.keep_months)) or "Sin particiones para borrar.")
+    finally:
+        conn.close()
@@ -0,0 +1,328 @@
+import argparse
+import logging
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from probe_ingestion import free_flow_speeds
+from traffic_store import CATEGORIAS, N_SLOTS, SlotWeights, TIPOS_VIA
+
+logger = logging.getLogger(__name__)
+
+TRAFFIC_MODEL_PATH = os.getenv("TRAFFIC_MODEL_PATH", os.path.join("models", "traffic_model.joblib"))
+
+# Marcas de tiempo (CURRENT_TIMESTAMP de la transacción) de cada escritura de predicciones
+# en datos_trafico; las filas con esa marca son predicciones y no entran al entrenamiento.
+# Si otro proceso vuelve a escribir la fila, su marca cambia y vuelve a contar como dato.
+PREDICTION_RUNS_TABLE = "predicciones_trafico"
+
+# Clases de vía de OSM con código propio; el resto comparte el último código
+HIGHWAY_CLASSES = (
+    "trunk", "trunk_link", "primary", "primary_link", "secondary", "secondary_link",
+    "tertiary", "tertiary_link", "residential", "unclassified", "living_street", "service",
+)
+OTHER_HIGHWAY_CLASS = len(HIGHWAY_CLASSES)
+
+FEATURE_NAMES = (
+    "highway_class",          # categórica
+    "log_length",
+    "free_flow_kmh",
+    "day_of_week",
+    "hour_of_day",
+    "is_weekend",
+    "edge_mean_ratio",        # velocidad histórica media de la arista / flujo libre
+    "class_slot_mean_ratio",  # lo mismo, promediado sobre las aristas de su clase en esa franja
+)
+
+# Límites de la razón velocidad / flujo libre que puede predecir el modelo
+MIN_SPEED_RATIO = 0.03
+MAX_SPEED_RATIO = 1.2
+MAX_TRAINING_ROWS = 300_000
+
+
+class EdgeStatics:
+    """Atributos fijos de cada arista del grafo compacto (orden del EdgeIndex): clase de vía, longitud y flujo libre."""
+
+    def __init__(self, graph, edge_index):
+        class_codes = {name: code for code, name in enumerate(HIGHWAY_CLASSES)}
+        by_class = np.array([class_codes.get(h, OTHER_HIGHWAY_CLASS) for h in graph.highway_classes], dtype=np.int16)
+        self.highways = graph.highways()
+        self.highway_class = by_class[graph.highway_code]
+        self.length = np.nan_to_num(graph.length, nan=50.0).astype(np.float32)
+        self.free_flow_kmh = free_flow_speeds(graph)
+
+    def __len__(self):
+        return len(self.length)
+
+
+def ensure_prediction_runs_table(conn):
+    """Crea la tabla de escrituras de predicciones si no existe (no hace commit)."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {PREDICTION_RUNS_TABLE} (
+                escrito_en TIMESTAMPTZ PRIMARY KEY,   -- timestamp que quedó en las filas escritas
+                filas INTEGER NOT NULL
+            );
+        """)
+
+
+def write_predictions(conn, rows):
+    """
+    Escribe las predicciones con bulk_upsert_traffic_data y registra en la misma transacción
+    la marca de tiempo que quedó en esas filas. Retorna la cantidad de filas escritas.
+    """
+    import psycopg2
+
+    from populate_traffic_data import TRAFFIC_SPEED_COLUMNS, bulk_upsert_traffic_data
+
+    try:
+        written = bulk_upsert_traffic_data(conn, rows, update_columns=TRAFFIC_SPEED_COLUMNS, commit=False)
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO {PREDICTION_RUNS_TABLE} (escrito_en, filas) VALUES (CURRENT_TIMESTAMP, %s)
+                ON CONFLICT (escrito_en) DO UPDATE SET filas = EXCLUDED.filas;
+            """, (written,))
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error al registrar la escritura de predicciones: {e}")
+        conn.rollback()
+        raise
+    return written
+
+
+def load_speed_history(conn, edge_index) -> np.ndarray:
+    """
+    Velocidades observadas de datos_trafico como una matriz (aristas × 168 franjas), NaN
+    donde no hay datos. Las filas escritas por una predicción se descartan para que el
+    modelo no se entrene con sus propias salidas.
+    """
+    history = np.full((len(edge_index), N_SLOTS), np.nan, dtype=np.float32)
+    position = edge_index.position
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT u, v, edge_key, dia_de_semana, hora_del_dia, velocidad_promedio_kmh
+            FROM datos_trafico
+            WHERE velocidad_promedio_kmh IS NOT NULL
+              AND timestamp NOT IN (SELECT escrito_en FROM {PREDICTION_RUNS_TABLE});
+        """)
+        while True:
+            rows = cur.fetchmany(50_000)
+            if not rows:
+                break
+            for u, v, key, day, hour, speed in rows:
+                i = position.get((u, v, key))
+                if i is not None:
+                    history[i, day * 24 + hour] = speed
+    logger.info(f"Historial cargado: {int(np.count_nonzero(~np.isnan(history)))} (arista, franja) con datos.")
+    return history
+
+
+def _leave_one_out_mean(sums, counts, ratio, valid, fallback):
+    """
+    Media de cada celda a partir de sumas y conteos (ya difundidos a aristas × 168), sin la
+    propia celda cuando tiene dato: así la característica de una fila de entrenamiento no
+    contiene su objetivo. Donde no queda ningún otro dato se usa 'fallback'.
+    """
+    own = np.where(valid, ratio, 0.0)
+    counts = counts - valid
+    return np.divide(sums - own, counts, out=np.broadcast_to(fallback, ratio.shape).astype(np.float64),
+                     where=counts > 0)
+
+
+def build_feature_matrix(statics, history):
+    """
+    Matriz de características de todas las (arista, franja), una fila por par en orden
+    arista-mayor (fila = arista * 168 + franja), junto con la razón observada
+    velocidad / flujo libre (NaN sin historial), que es el objetivo del modelo.
+    Las medias históricas de la arista y de la clase excluyen la propia (arista, franja).
+    """
+    n_edges = len(statics)
+    ratio = history / statics.free_flow_kmh[:, None]
+    valid = ~np.isnan(ratio)
+    values = np.where(valid, ratio, 0.0)
+    global_mean = float(np.nanmean(ratio)) if valid.any() else 1.0
+
+    slot_mean = _leave_one_out_mean(values.sum(axis=0), valid.sum(axis=0), ratio, valid, global_mean)
+    edge_mean = _leave_one_out_mean(values.sum(axis=1)[:, None], valid.sum(axis=1)[:, None], ratio, valid,
+                                    global_mean)
+
+    n_classes = OTHER_HIGHWAY_CLASS + 1
+    class_sums = np.zeros((n_classes, N_SLOTS))
+    class_counts = np.zeros((n_classes, N_SLOTS))
+    np.add.at(class_sums, statics.highway_class, values)
+    np.add.at(class_counts, statics.highway_class, valid)
+    class_slot_mean = _leave_one_out_mean(class_sums[statics.highway_class], class_counts[statics.highway_class],
+                                          ratio, valid, slot_mean)
+
+    slots = np.arange(N_SLOTS)
+    day = slots // 24
+    columns = [
+        np.broadcast_to(statics.highway_class[:, None], (n_edges, N_SLOTS)),
+        np.broadcast_to(np.log1p(statics.length)[:, None], (n_edges, N_SLOTS)),
+        np.broadcast_to(statics.free_flow_kmh[:, None], (n_edges, N_SLOTS)),
+        np.broadcast_to(day, (n_edges, N_SLOTS)),
+        np.broadcast_to(slots % 24, (n_edges, N_SLOTS)),
+        np.broadcast_to(day >= 5, (n_edges, N_SLOTS)),
+        edge_mean,
+        class_slot_mean,
+    ]
+    features = np.empty((n_edges * N_SLOTS, len(FEATURE_NAMES)), dtype=np.float32)
+    for j, column in enumerate(columns):
+        features[:, j] = column.reshape(-1)
+    return features, ratio.reshape(-1)
+
+
+def train_model(features, target, seed=42):
+    """Entrena un HistGradientBoostingRegressor sobre las filas con historial."""
+    from sklearn.ensemble import HistGradientBoostingRegressor
+
+    rows = np.flatnonzero(~np.isnan(target))
+    if len(rows) == 0:
+        raise ValueError("No hay historial de velocidades para entrenar el modelo.")
+    if len(rows) > MAX_TRAINING_ROWS:
+        rows = np.random.default_rng(seed).choice(rows, MAX_TRAINING_ROWS, replace=False)
+    model = HistGradientBoostingRegressor(
+        max_iter=200,
+        learning_rate=0.1,
+        categorical_features=[FEATURE_NAMES.index("highway_class")],
+        random_state=seed,
+    )
+    model.fit(features[rows], target[rows])
+    logger.info(f"Modelo entrenado con {len(rows)} filas (R² en entrenamiento: {model.score(features[rows], target[rows]):.3f}).")
+    return model
+
+
+def save_model(model, path=TRAFFIC_MODEL_PATH):
+    import joblib
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    joblib.dump({"model": model, "features": FEATURE_NAMES, "trained_at": datetime.now().isoformat()}, path)
+    logger.info(f"Modelo guardado en {path}.")
+
+
+def load_model(path=TRAFFIC_MODEL_PATH):
+    """
+    Carga un artefacto guardado con save_model. Sirve cualquier regresor con predict(X)
+    entrenado sobre FEATURE_NAMES que prediga la razón velocidad / flujo libre.
+    """
+    import joblib
+
+    artifact = joblib.load(path)
+    if tuple(artifact["features"]) != FEATURE_NAMES:
+        raise ValueError(f"El modelo de {path} usa otras características: {artifact['features']}")
+    logger.info(f"Modelo de tráfico cargado desde {path} (entrenado el {artifact['trained_at']}).")
+    return artifact["model"]
+
+
+def predict_speeds(model, features, statics, history=None) -> np.ndarray:
+    """
+    Predice en un solo lote la velocidad (km/h) de todas las (arista, franja): matriz
+    aristas × 168. Con 'history' solo se predicen las celdas sin dato y las observadas
+    conservan su velocidad.
+    """
+    speeds = np.empty((len(statics), N_SLOTS), dtype=np.float32)
+    missing = np.ones(speeds.shape, dtype=bool) if history is None else np.isnan(history)
+    if history is not None:
+        speeds[~missing] = history[~missing]
+    if missing.any():
+        ratio = np.clip(model.predict(features[missing.reshape(-1)]), MIN_SPEED_RATIO, MAX_SPEED_RATIO)
+        edges = np.nonzero(missing)[0]
+        speeds[missing] = np.maximum(1.0, ratio * statics.free_flow_kmh[edges])
+    return speeds
+
+
+def derive_traffic_fields(statics, speeds):
+    """Congestión, tiempo de viaje y categoría de cada (arista, franja) a partir de las velocidades."""
+    congestion = np.clip(1.0 - speeds / statics.free_flow_kmh[:, None], 0.0, 1.0).astype(np.float32)
+    travel_time = (statics.length[:, None] / (speeds * 1000 / 3600)).astype(np.float32)
+    # Mismos umbrales que get_congestion_category; los códigos son índices de CATEGORIAS
+    category_code = np.where(congestion < 0.3, 1, np.where(congestion < 0.7, 2, 3)).astype(np.uint8)
+    return congestion, travel_time, category_code
+
+
+def prediction_rows(edge_index, statics, speeds, congestion, travel_time, category_code, cells=None):
+    """
+    Filas para bulk_upsert_traffic_data, en el orden de TRAFFIC_COLUMNS. 'cells' (matriz
+    booleana aristas × 168) limita las (arista, franja) a escribir; sin él, todas.
+    """
+    speeds, congestion, travel_time = speeds.tolist(), congestion.tolist(), travel_time.tolist()
+    category_code = category_code.tolist()
+    lengths = statics.length.tolist()
+    edges = edge_index.edges
+    if cells is None:
+        cells = np.ones((len(edges), N_SLOTS), dtype=bool)
+    for i, slot in zip(*(index.tolist() for index in np.nonzero(cells))):
+        u, v, key = edges[i]
+        highway = statics.highways[i]
+        yield (
+            u, v, key, slot // 24, slot % 24,
+            speeds[i][slot], congestion[i][slot], travel_time[i][slot],
+            CATEGORIAS[category_code[i][slot]], highway, lengths[i],
+        )
+
+
+def publish_to_store(traffic_store, statics, speeds, congestion, travel_time, category_code):
+    """Escribe las 168 franjas en el almacén compartido del servidor en una sola publicación."""
+    tipo_via_codes = {name: code for code, name in enumerate(TIPOS_VIA)}
+    tipo_via = np.array([tipo_via_codes.get(h, 0) for h in statics.highways], dtype=np.uint8)
+    with traffic_store.update():
+        for slot in range(N_SLOTS):
+            traffic_store.write_slot(slot, SlotWeights({
+                "travel_time": travel_time[:, slot],
+                "congestion_level": congestion[:, slot],
+                "speed_kmh": speeds[:, slot],
+                "length": statics.length,
+                "categoria_congestion": category_code[:, slot],
+                "tipo_via_osm": tipo_via,
+            }))
+
+
+if __name__ == "__main__":
+    from graph_snapshot import load_graph
+    from populate_traffic_data import GRAPH_PATH, get_db_connection
+    from traffic_store import TRAFFIC_STORE_PATH, EdgeIndex, SharedTrafficStore
+
+    parser = argparse.ArgumentParser(description="Entrena el modelo de tráfico y/o predice las (arista, franja) sin datos observados.")
+    parser.add_argument("command", choices=("train", "predict", "all"))
+    parser.add_argument("--model", default=TRAFFIC_MODEL_PATH, help="Ruta del artefacto del modelo.")
+    parser.add_argument("--dry-run", action="store_true", help="Predice sin escribir en la base de datos.")
+    args = parser.parse_args()
+
+    G = load_graph(GRAPH_PATH)
+    edge_index = EdgeIndex(G.edge_keys())
+    statics = EdgeStatics(G, edge_index)
+    conn = get_db_connection()
+    try:
+        ensure_prediction_runs_table(conn)
+        conn.commit()
+        start = time.perf_counter()
+        history = load_speed_history(conn, edge_index)
+        features, target = build_feature_matrix(statics, history)
+        logger.info(f"Matriz de características {features.shape} construida en {time.perf_counter() - start:.2f}s.")
+
+        if args.command in ("train", "all"):
+            start = time.perf_counter()
+            model = train_model(features, target)
+            save_model(model, args.model)
+            logger.info(f"Entrenamiento: {time.perf_counter() - start:.2f}s.")
+        else:
+            model = load_model(args.model)
+
+        if args.command in ("predict", "all"):
+            start = time.perf_counter()
+            # Las (arista, franja) con datos observados no se sobrescriben con la salida del modelo
+            missing = np.isnan(history)
+            speeds = predict_speeds(model, features, statics, history)
+            fields = derive_traffic_fields(statics, speeds)
+            logger.info(f"Inferencia de {int(missing.sum())} (arista, franja) sin datos: {time.perf_counter() - start:.2f}s.")
+            if not args.dry_run:
+                start = time.perf_counter()
+                written = write_predictions(conn, prediction_rows(edge_index, statics, speeds, *fields, cells=missing))
+                logger.info(f"{written} filas escritas en datos_trafico en {time.perf_counter() - start:.2f}s.")
+                store = SharedTrafficStore(TRAFFIC_STORE_PATH, edge_index)
+                if store.attach():
+                    publish_to_store(store, statics, speeds, *fields)
+    finally:
+        conn.close()
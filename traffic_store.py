@@ -0,0 +1,395 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+N_SLOTS = 7 * 24  # una franja por (día de la semana, hora del día)
+TRAFFIC_STORE_PATH = os.getenv("TRAFFIC_STORE_PATH", os.path.join("cache", "traffic_slots.bin"))
+
+MAGIC = b"HZTRAF01"
+STORE_VERSION = 2
+HEADER_SIZE = 4096
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("n_edges", "<u4"),
+    ("n_slots", "<u4"),
+    ("active_bank", "<u4"),
+    ("generation", "<u8"),
+    ("updated_at", "<f8"),
+    ("edges_digest", "S20"),
+    ("loaded", "u1", (2, N_SLOTS)),
+    # stale[bank][slot] = 1 si la franja de ese banco difiere de la del otro banco
+    ("stale", "u1", (2, N_SLOTS)),
+])
+
+# Campos por arista y franja. Los float32 van primero para mantener la alineación.
+FIELDS = (
+    ("travel_time", "<f4"),
+    ("congestion_level", "<f4"),
+    ("speed_kmh", "<f4"),
+    ("length", "<f4"),
+    ("categoria_congestion", "u1"),
+    ("tipo_via_osm", "u1"),
+)
+
+# Vocabularios de los campos de texto; lo que no esté aquí se guarda como el código 0
+CATEGORIAS = ("Desconocida", "Baja", "Media", "Alta")
+TIPOS_VIA = (
+    "N/A", "default", "closed", "very_slow", "slow", "fast_flow", "main_avenue",
+    "residential", "tertiary", "tertiary_link", "secondary", "secondary_link",
+    "primary", "primary_link", "trunk", "trunk_link", "unclassified", "living_street", "service",
+)
+_CATEGORIA_CODES = {name: code for code, name in enumerate(CATEGORIAS)}
+_TIPO_VIA_CODES = {name: code for code, name in enumerate(TIPOS_VIA)}
+
+
+def slot_index(day_of_week: int, hour_of_day: int) -> int:
+    return day_of_week * 24 + hour_of_day
+
+
+class EdgeIndex:
+    """Orden fijo de las aristas (u, v, key) del grafo; posición de cada arista en los arreglos."""
+
+    def __init__(self, edges):
+        self.edges = [(int(u), int(v), int(k)) for u, v, k in edges]
+        self.position = {edge: i for i, edge in enumerate(self.edges)}
+        self.digest = hashlib.sha1(repr(self.edges).encode()).digest()
+
+    @classmethod
+    def from_graph(cls, graph):
+        return cls(graph.edges(keys=True))
+
+    def __len__(self):
+        return len(self.edges)
+
+
+class SlotWeights:
+    """
+    Datos de tráfico de una franja alineados con un EdgeIndex.
+    travel_time es NaN para las aristas sin datos de tráfico.
+    """
+
+    __slots__ = tuple(name for name, _ in FIELDS) + ("generation",)
+
+    def __init__(self, arrays, generation=0):
+        for name, _ in FIELDS:
+            setattr(self, name, arrays[name])
+        self.generation = generation
+
+    @classmethod
+    def empty(cls, n_edges):
+        arrays = {name: np.zeros(n_edges, dtype=dtype) for name, dtype in FIELDS}
+        arrays["travel_time"][:] = np.nan
+        return cls(arrays)
+
+    @classmethod
+    def from_edge_dict(cls, edge_index, edge_data):
+        """Convierte el diccionario (u, v, key) -> atributos de get_edge_travel_times en arreglos."""
+        weights = cls.empty(len(edge_index))
+        position = edge_index.position
+        for edge_id, data in edge_data.items():
+            i = position.get(edge_id)
+            if i is None:
+                continue
+            weights.travel_time[i] = data.get('travel_time', 0.0)
+            weights.congestion_level[i] = data.get('congestion_level', 0.0)
+            weights.speed_kmh[i] = data.get('speed_kmh', 0.0)
+            weights.length[i] = data.get('length', 0.0)
+            weights.categoria_congestion[i] = _CATEGORIA_CODES.get(data.get('categoria_congestion'), 0)
+            weights.tipo_via_osm[i] = _TIPO_VIA_CODES.get(data.get('tipo_via_osm'), 0)
+        return weights
+
+    def has_data(self, i) -> bool:
+        return not np.isnan(self.travel_time[i])
+
+    def edge_attrs(self, i) -> dict:
+        """Atributos de tráfico de la arista i con los mismos nombres que usa el grafo."""
+        return {
+            'travel_time': float(self.travel_time[i]),
+            'congestion_level': float(self.congestion_level[i]),
+            'categoria_congestion': CATEGORIAS[self.categoria_congestion[i]],
+            'tipo_via_osm': TIPOS_VIA[self.tipo_via_osm[i]],
+            'length': float(self.length[i]),
+            'speed_kmh': float(self.speed_kmh[i]),
+        }
+
+
+class SharedTrafficStore:
+    """
+    Arreglos de tráfico de las 168 franjas en un archivo mapeado en memoria, compartido
+    por todos los workers de uvicorn. Hay dos bancos: las escrituras (serializadas entre
+    procesos con un lock de archivo) se hacen en el banco inactivo y al publicar se cambia
+    el banco activo y se incrementa la generación, de modo que todos los workers pasan a los
+    datos nuevos en el mismo instante. Los lectores copian la franja que necesitan
+    (unos pocos KB) y la cachean por generación.
+
+    El refrescador (un único proceso, elegido con otro lock de archivo) es el que crea el
+    archivo y lo llena desde PostgreSQL; cualquier worker puede aplicar actualizaciones
+    puntuales (por ejemplo, velocidades observadas) con update().
+    """
+
+    def __init__(self, path, edge_index):
+        self.path = path
+        self.edge_index = edge_index
+        self.n_edges = len(edge_index)
+        self._offsets = {}
+        offset = 0
+        for name, dtype in FIELDS:
+            self._offsets[name] = offset
+            offset += np.dtype(dtype).itemsize * N_SLOTS * self.n_edges
+        self._bank_size = offset
+        self.file_size = HEADER_SIZE + 2 * self._bank_size
+
+        self._mm = None
+        self._header = None
+        self._inode = None
+        self._writable = False
+        self._lock_file = None
+        self.is_leader = False
+        self._slot_cache = {}
+        self._cache_lock = threading.Lock()
+        self._pending_slots = set()
+
+    # --- Apertura y liderazgo ---
+
+    def try_acquire_leadership(self) -> bool:
+        """Intenta tomar el lock exclusivo del refrescador (no bloqueante). Se mantiene mientras viva el proceso."""
+        if self.is_leader:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        lock_file = open(self.path + ".lock", "a+b")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self.is_leader = True
+        self._open_for_writing()
+        logger.info(f"Este proceso (pid {os.getpid()}) es el refrescador de tráfico compartido.")
+        return True
+
+    def _open_for_writing(self):
+        valid = self._header_matches() if os.path.exists(self.path) else False
+        if not valid:
+            # Se crea en un archivo temporal y se reemplaza para que ningún lector vea un archivo a medias
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.truncate(self.file_size)
+            mm = np.memmap(tmp_path, dtype=np.uint8, mode="r+", shape=(self.file_size,))
+            header = mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+            header["magic"] = MAGIC
+            header["version"] = STORE_VERSION
+            header["n_edges"] = self.n_edges
+            header["n_slots"] = N_SLOTS
+            header["edges_digest"] = self.edge_index.digest
+            mm.flush()
+            del header, mm
+            os.replace(tmp_path, self.path)
+            logger.info(f"Archivo de tráfico compartido creado en {self.path} ({self.file_size / 1e6:.1f} MB).")
+        self._map("r+")
+
+    def attach(self) -> bool:
+        """Se conecta en solo lectura al archivo creado por el refrescador. Retorna False si aún no existe o no coincide con el grafo."""
+        if self.is_leader:
+            return True
+        if not os.path.exists(self.path) or not self._header_matches():
+            return False
+        inode = os.stat(self.path).st_ino
+        if self._mm is not None and inode == self._inode:
+            return True
+        self._map("r")
+        return True
+
+    def _map(self, mode):
+        self._mm = np.memmap(self.path, dtype=np.uint8, mode=mode, shape=(self.file_size,))
+        self._writable = mode == "r+"
+        self._header = self._mm[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)
+        self._inode = os.stat(self.path).st_ino
+        with self._cache_lock:
+            self._slot_cache.clear()
+
+    def _header_matches(self) -> bool:
+        try:
+            if os.path.getsize(self.path) != self.file_size:
+                return False
+            with open(self.path, "rb") as f:
+                header = np.frombuffer(f.read(HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)[0]
+        except OSError:
+            return False
+        return (header["magic"] == MAGIC and header["version"] == STORE_VERSION
+                and header["n_edges"] == self.n_edges and header["edges_digest"] == self.edge_index.digest)
+
+    @property
+    def attached(self) -> bool:
+        return self._mm is not None
+
+    @property
+    def generation(self) -> int:
+        return int(self._header["generation"][0]) if self.attached else 0
+
+    @property
+    def updated_at(self):
+        """Hora (time.time()) de la última publicación, o None si el almacén nunca se publicó."""
+        if not self.attached or self.generation == 0:
+            return None
+        return float(self._header["updated_at"][0])
+
+    def _field_view(self, bank, name, slot=None):
+        dtype = np.dtype(dict(FIELDS)[name])
+        start = HEADER_SIZE + bank * self._bank_size + self._offsets[name]
+        block = self._mm[start:start + dtype.itemsize * N_SLOTS * self.n_edges].view(dtype).reshape(N_SLOTS, self.n_edges)
+        return block if slot is None else block[slot]
+
+    # --- Lectura (todos los workers) ---
+
+    def read_slot(self, slot):
+        """
+        Copia de los datos de una franja del banco activo, o None si la franja no está cargada.
+        Si la generación cambia durante la copia, se reintenta (como un seqlock).
+        """
+        if not self.attached:
+            return None
+        for _ in range(3):
+            generation = self.generation
+            with self._cache_lock:
+                cached = self._slot_cache.get(slot)
+            if cached is not None and cached.generation == generation:
+                return cached
+
+            bank = int(self._header["active_bank"][0])
+            if not self._header["loaded"][0][bank][slot]:
+                return None
+            arrays = {name: np.array(self._field_view(bank, name, slot)) for name, _ in FIELDS}
+            if self.generation != generation:
+                continue
+            weights = SlotWeights(arrays, generation)
+            with self._cache_lock:
+                self._slot_cache[slot] = weights
+            return weights
+        return None
+
+    # --- Escritura ---
+
+    @contextmanager
+    def _write_lock(self):
+        with open(self.path + ".write.lock", "a+b") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def update(self):
+        """
+        Bloque de escritura atómico para todos los workers:
+
+            with store.update():
+                store.write_slot(slot, weights)
+
+        Toma el lock de escritura, prepara el banco inactivo y al salir lo publica.
+        Las escrituras dentro del bloque deben ser síncronas y breves.
+        """
+        if not self.attached:
+            raise RuntimeError("El almacén de tráfico compartido no está disponible.")
+        with self._write_lock():
+            if not self._writable:
+                self._map("r+")
+            self.begin_update()
+            yield self
+            self.publish()
+
+    def begin_update(self):
+        """
+        Prepara el banco inactivo para escribir franjas nuevas. Solo se copian del activo las
+        franjas en que difieren (las escritas desde que este banco dejó de ser el activo),
+        así el costo de una actualización depende de las franjas que cambian, no de las 168.
+        """
+        active = int(self._header["active_bank"][0])
+        inactive = 1 - active
+        stale = self._header["stale"][0][inactive]
+        for slot in np.flatnonzero(stale).tolist():
+            for name, _ in FIELDS:
+                np.copyto(self._field_view(inactive, name, slot), self._field_view(active, name, slot))
+        stale[:] = 0
+        self._header["loaded"][0][inactive] = self._header["loaded"][0][active]
+        self._pending_slots.clear()
+
+    def _mark_written(self, inactive, slot):
+        # Se marca antes de escribir: si la actualización no llega a publicarse, la próxima
+        # begin_update vuelve a copiar la franja desde el banco activo
+        self._header["stale"][0][inactive][slot] = 1
+        self._pending_slots.add(slot)
+
+    def write_slot(self, slot, weights):
+        inactive = 1 - int(self._header["active_bank"][0])
+        self._mark_written(inactive, slot)
+        for name, _ in FIELDS:
+            self._field_view(inactive, name, slot)[:] = getattr(weights, name)
+        self._header["loaded"][0][inactive][slot] = 1
+
+    def patch_edges(self, slot, positions, **values):
+        """
+        Actualiza solo algunas aristas de una franja (dentro de update()).
+        'values' son arreglos alineados con 'positions', con los nombres de FIELDS.
+        """
+        inactive = 1 - int(self._header["active_bank"][0])
+        self._mark_written(inactive, slot)
+        for name, field_values in values.items():
+            self._field_view(inactive, name, slot)[positions] = field_values
+        self._header["loaded"][0][inactive][slot] = 1
+
+    def publish(self):
+        """Activa el banco escrito: todos los workers ven los datos nuevos a partir de este momento."""
+        inactive = 1 - int(self._header["active_bank"][0])
+        written = sorted(self._pending_slots)
+        # El banco escrito queda al día en esas franjas y el que deja de estar activo, atrasado
+        self._header["stale"][0][inactive][written] = 0
+        self._header["stale"][0][1 - inactive][written] = 1
+        self._mm.flush()
+        self._header["updated_at"] = time.time()
+        self._header["active_bank"] = inactive
+        self._header["generation"] = self.generation + 1
+        self._mm.flush()
+        logger.info(f"Almacén de tráfico compartido publicado: generación {self.generation}, {len(self._pending_slots)} franjas actualizadas.")
+        self._pending_slots.clear()
+
+    def loaded_slots(self):
+        if not self.attached:
+            return 0
+        bank = int(self._header["active_bank"][0])
+        return int(self._header["loaded"][0][bank].sum())
+
+    def close(self):
+        self._mm = None
+        self._header = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+            self.is_leader = False
@@ -0,0 +1,123 @@
+import math
+import time
+
+# Penalización por cada segundo de llegada tarde a una parada: alta para que primero se
+# busquen órdenes que cumplan las ventanas y después los más cortos.
+LATENESS_PENALTY = 1000.0
+
+
+class TripProblem:
+    """
+    Problema de orden de visita sobre una matriz de duraciones (segundos, índice 0 = salida).
+    'windows' asigna a cada parada (earliest, latest) en segundos desde la salida, cualquiera
+    de los dos puede ser None; 'service' es el tiempo de atención en cada parada.
+    Si 'return_to_start' es True el recorrido termina en la salida.
+    """
+
+    def __init__(self, durations, windows=None, service=None, return_to_start=False):
+        self.durations = durations
+        self.n = len(durations)
+        self.windows = windows or {}
+        self.service = service or {}
+        self.return_to_start = return_to_start
+
+    def evaluate(self, order):
+        """Retorna (costo, duración total, retraso total, llegadas) de visitar las paradas en 'order'."""
+        d = self.durations
+        t = 0.0
+        lateness = 0.0
+        arrivals = []
+        previous = 0
+        for stop in order:
+            t += d[previous][stop]
+            earliest, latest = self.windows.get(stop, (None, None))
+            if earliest is not None and t < earliest:
+                t = earliest  # se espera a que abra la ventana
+            if latest is not None and t > latest:
+                lateness += t - latest
+            arrivals.append(t)
+            t += self.service.get(stop, 0.0)
+            previous = stop
+        if self.return_to_start:
+            t += d[previous][0]
+        return t + LATENESS_PENALTY * lateness, t, lateness, arrivals
+
+    def cost(self, order):
+        return self.evaluate(order)[0]
+
+
+def nearest_insertion(problem):
+    """
+    Construcción inicial: se agrega cada vez la parada más cercana a alguna de las ya
+    incluidas (o a la salida) en la posición que menos encarece el recorrido.
+    """
+    d = problem.durations
+    remaining = set(range(1, problem.n))
+    order = []
+    while remaining:
+        in_route = [0] + order
+        stop = min(remaining, key=lambda s: min(min(d[r][s], d[s][r]) for r in in_route))
+        # Si ninguna posición tiene costo finito (parada inalcanzable), queda al final y
+        # plan_trip lo informa por el tiempo total infinito
+        best_order = order + [stop]
+        best_cost = math.inf
+        for position in range(len(order) + 1):
+            candidate = order[:position] + [stop] + order[position:]
+            candidate_cost = problem.cost(candidate)
+            if candidate_cost < best_cost:
+                best_order, best_cost = candidate, candidate_cost
+        order = best_order
+        remaining.discard(stop)
+    return order
+
+
+def _two_opt_pass(problem, order, best_cost, deadline):
+    n = len(order)
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+            candidate_cost = problem.cost(candidate)
+            if candidate_cost < best_cost - 1e-9:
+                return candidate, candidate_cost
+            if time.perf_counter() > deadline:
+                return None, best_cost
+    return None, best_cost
+
+
+def _or_opt_pass(problem, order, best_cost, deadline):
+    n = len(order)
+    for length in (1, 2, 3):
+        for i in range(n - length + 1):
+            segment = order[i:i + length]
+            rest = order[:i] + order[i + length:]
+            for position in range(len(rest) + 1):
+                if position == i:
+                    continue
+                candidate = rest[:position] + segment + rest[position:]
+                candidate_cost = problem.cost(candidate)
+                if candidate_cost < best_cost - 1e-9:
+                    return candidate, candidate_cost
+                if time.perf_counter() > deadline:
+                    return None, best_cost
+    return None, best_cost
+
+
+def solve_visit_order(problem, time_budget_seconds=0.3):
+    """
+    Orden de visita de las paradas 1..n-1: inserción más cercana y luego mejora local con
+    movimientos 2-opt y Or-opt (mover tramos de 1 a 3 paradas) hasta que ninguno mejore
+    o se agote el tiempo. Las duraciones pueden ser asimétricas.
+    """
+    deadline = time.perf_counter() + time_budget_seconds
+    order = nearest_insertion(problem)
+    best_cost = problem.cost(order)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for local_search in (_two_opt_pass, _or_opt_pass):
+            candidate, candidate_cost = local_search(problem, order, best_cost, deadline)
+            if candidate is not None:
+                order, best_cost = candidate, candidate_cost
+                improved = True
+                break
+    return order